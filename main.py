@@ -1,36 +1,86 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import base64
-import crypt
+import concurrent.futures
+import fcntl
+import fnmatch
 from hashlib import sha256
+import importlib
 import io
 import ipaddress
 from ipaddress import IPv4Address, IPv6Address
+import itertools
+import json
+import logging
+import mmap
 import os
 from pathlib import Path
+import pickle
+import random
 import re
 import secrets  # needs sudo apt install python3-secretstorage but default on Ubuntu 18.04 Desktop
-from socket import gaierror
+import select
+import shlex
+import signal
+import socket
+import socketserver
+import sqlite3
+import struct
+import subprocess
 import sys
-import telnetlib
+import tarfile
+import tempfile
+import termios
 import textwrap
+import threading
 import time
+import tty
 from typing import Union
 import uuid
 
-from cryptography.hazmat.backends import default_backend as crypto_default_backend
-from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from dbus import exceptions
-import getmac
-import netifaces  # needs sudo apt install python3-netifaces but default on Ubuntu 18.04 Desktop
-import NetworkManager  # needs sudo apt install python3-networkmanager
-import paramiko
-from scp import SCPClient
 import yaml
 
 
+class LazyModule:
+    """Stands in for a module, which is imported the first time one of its attributes is used,
+    so that each command only pays for the imports it needs"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError as err:
+                raise CGError(_("Missing Python module {}: {}").format(self._name, err))
+        return getattr(self._module, attr)
+
+
+asyncio = LazyModule("asyncio")  # imports ssl; only for WiFi scans and port sweeps
+crypt = LazyModule("crypt")
+crypto_backends = LazyModule("cryptography.hazmat.backends")
+crypto_serialization = LazyModule("cryptography.hazmat.primitives.serialization")
+dbus = LazyModule("dbus")
+dbus_next = LazyModule("dbus_next")  # pip install dbus-next
+dbus_next_aio = LazyModule("dbus_next.aio")
+dbus_next_service = LazyModule("dbus_next.service")
+ed25519 = LazyModule("cryptography.hazmat.primitives.asymmetric.ed25519")
+getmac = LazyModule("getmac")
+gzip = LazyModule("gzip")
+http_server = LazyModule("http.server")
+netifaces = LazyModule("netifaces")  # needs sudo apt install python3-netifaces
+NetworkManager = LazyModule("NetworkManager")  # needs sudo apt install python3-networkmanager
+paramiko = LazyModule("paramiko")
+rsa = LazyModule("cryptography.hazmat.primitives.asymmetric.rsa")
+scp = LazyModule("scp")
+telnetlib = LazyModule("telnetlib")
+urllib_request = LazyModule("urllib.request")
+
+
 def _(s: str) -> str:
     """For future localization, mark all strings to be translated with _("string")"""
     return s
@@ -47,13 +97,184 @@ class RemoteExecutionError(Exception):
 # TODO: Use logging levels for this rather than a global int.
 verbose: int = None
 
+PROBE_TIMEOUT = 8  # seconds allowed for each network probe of a possible router
+SWEEP_TIMEOUT = 1.0  # seconds allowed for each TCP connection attempt when scanning networks
+SWEEP_RATE = 500  # maximum TCP connection attempts per second when scanning networks
+SWEEP_MAX_HOSTS = 1024  # larger local networks are only scanned near our own address
+KEYSCAN_TTL = 300  # seconds a host key stays cached for the same IP and MAC address
+TELNET_TIMEOUT = 5  # seconds allowed for a telnet login banner, and at most for any later reply
+TELNET_RTT_FACTOR = 20  # other telnet replies may take this many measured round-trip times...
+TELNET_MIN_WAIT = 0.5  # ...but no less than this many seconds
+PACKAGE_CACHE_MB = 512  # default size limit of the local opkg package cache
+PACKAGE_LIST_TTL = 3600  # seconds before cached opkg package lists are downloaded again
+PACKAGE_FETCH_TIMEOUT = 30  # seconds allowed for each download into the package cache
+REBOOT_DEADLINE = 300  # default seconds allowed for a router to come back after a reboot
+REBOOT_PROBE_MIN = 0.25  # seconds between the first probes of a rebooting router...
+REBOOT_PROBE_MAX = 4.0  # ...backing off to this
+REBOOT_PROBE_BACKOFF = 1.5  # factor by which the time between probes grows
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"  # Linux makes a new one at each boot
+STREAM_CHUNK = 32768  # bytes read from a command's output at a time
+STREAM_MAX_LINE = 65536  # longer output lines are passed on in pieces, to bound memory use
+EXEC_MAX_OUTPUT = 16 * 2**20  # output kept by Router.exec() and _run(); more is an error
+
+
+# Per-thread output settings: 'verbose' overrides the global above and 'prefix' is put in front
+# of each message, so that fleet workers don't share (or change) each other's output state.
+_output = threading.local()
+
 
 def print_msg(level, msg, end="\n"):
-    if verbose > level:
+    if getattr(_output, "verbose", verbose) > level:
+        prefix = getattr(_output, "prefix", "")
         if level == 0:
-            print("{}".format(msg), file=sys.stderr, end=end)
+            print("{}{}".format(prefix, msg), file=sys.stderr, end=end)
         else:
-            print("{}".format(msg), end=end)
+            print("{}{}".format(prefix, msg), end=end)
+
+
+class Tracer:
+    """
+    Timed spans for each phase of a run, each coterie, remote command and file transfer, with
+    the router they belong to. Spans can be written as JSON lines or in Chrome's trace event
+    format (load in chrome://tracing or https://ui.perfetto.dev), and summarized in a table.
+    While disabled, trace() returns a shared do-nothing span, so instrumentation is nearly free.
+    """
+
+    enabled = False
+    spans = list()  # dicts with 'name', 'cat', 'start' and 'dur' (seconds), 'thread', 'args'
+    origin = 0.0  # perf_counter() at start of tracing
+    wall_origin = 0.0  # time.time() at start of tracing
+
+    @staticmethod
+    def enable():
+        Tracer.enabled = True
+        Tracer.origin = time.perf_counter()
+        Tracer.wall_origin = time.time()
+
+    @staticmethod
+    def write_jsonl(path):
+        with open(path, "w") as trace_file:
+            for span in list(Tracer.spans):
+                record = dict(span, time=Tracer.wall_origin + span["start"])
+                trace_file.write(json.dumps(record, default=str) + "\n")
+
+    @staticmethod
+    def write_chrome(path):
+        """Write the Chrome trace event format: 'complete' events with times in microseconds"""
+        pid = os.getpid()
+        events = list()
+        threads = dict()
+        for span in list(Tracer.spans):
+            threads[span["tid"]] = span["thread"]
+            events.append(
+                {
+                    "name": span["name"],
+                    "cat": span["cat"],
+                    "ph": "X",
+                    "ts": round(span["start"] * 1e6),
+                    "dur": round(span["dur"] * 1e6),
+                    "pid": pid,
+                    "tid": span["tid"],
+                    "args": span["args"],
+                }
+            )
+        for tid, name in threads.items():
+            events.append(
+                {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            )
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file, default=str)
+
+    @staticmethod
+    def report(jsonl_path=None, chrome_path=None):
+        """Write the requested trace files and print the summary table; call at end of run"""
+        try:
+            if jsonl_path is not None:
+                Tracer.write_jsonl(jsonl_path)
+            if chrome_path is not None:
+                Tracer.write_chrome(chrome_path)
+        except OSError as err:
+            raise CGError(_("Error saving trace: {}").format(err))
+        print_msg(0, Tracer.summary())  # stderr, so it stays out of piped output
+
+    @staticmethod
+    def summary(rows=20, spans=None):
+        """Return a table of the spans (default: all) with the greatest total time, grouped by
+        name"""
+        totals = dict()  # (cat, name): [count, total, max]
+        for span in list(Tracer.spans) if spans is None else spans:
+            total = totals.setdefault((span["cat"], span["name"]), [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += span["dur"]
+            total[2] = max(total[2], span["dur"])
+        lines = [
+            "{:<10} {:<40} {:>6} {:>10} {:>10} {:>10}".format(
+                _("Category"), _("Name"), _("Count"), _("Total s"), _("Mean ms"), _("Max ms")
+            )
+        ]
+        ordered = sorted(totals.items(), key=lambda t: t[1][1], reverse=True)
+        for (cat, name), (count, total, longest) in ordered[0:rows]:
+            name = name if len(name) <= 40 else name[0:37] + "..."
+            lines.append(
+                "{:<10} {:<40} {:>6} {:>10.3f} {:>10.1f} {:>10.1f}".format(
+                    cat, name, count, total, total / count * 1000, longest * 1000
+                )
+            )
+        if len(ordered) > rows:
+            lines.append(_("({} more not shown)").format(len(ordered) - rows))
+        return "\n".join(lines)
+
+
+class _Span:
+    __slots__ = ("name", "cat", "args", "start")
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        thread = threading.current_thread()
+        Tracer.spans.append(  # list.append() is atomic, so no lock is needed
+            {
+                "name": self.name,
+                "cat": self.cat,
+                "start": self.start - Tracer.origin,
+                "dur": end - self.start,
+                "thread": thread.name,
+                "tid": thread.ident,
+                "args": self.args,
+            }
+        )
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def trace(name, category, router=None, **args):
+    """Return a context manager which records a span, if tracing is enabled. 'category' is
+    one of 'phase', 'probe', 'coterie', 'command', or 'transfer'; 'router' is a Router or IP."""
+    if not Tracer.enabled:
+        return _null_span
+    if router is not None:
+        args["router"] = getattr(router, "ip", router)
+    return _Span(name, category, args)
 
 
 def wifi_active_ssids():
@@ -71,11 +292,172 @@ def wifi_active_ssids():
     return macs_found
 
 
-def wifi_available_ssids():
-    """Initiate a new WiFi scan, wait for it to complete, and return a (possibly empty)
-    dict of MAC:SSID of available WiFi networks; usually takes a few seconds; it is normal
-    to have multiple MACs with the same SSID"""
-    # Based on: https://github.com/seveas/python-networkmanager/blob/master/examples/ssids.py
+NM_BUS_NAME = "org.freedesktop.NetworkManager"  # also the main interface name
+NM_PATH = "/org/freedesktop/NetworkManager"
+WIFI_SCAN_TIMEOUT = 10  # seconds
+
+
+def wifi_available_ssids(timeout=WIFI_SCAN_TIMEOUT, bus_address=None):
+    """Initiate a new WiFi scan, wait for NetworkManager to signal that it has completed, and
+    return a (possibly empty) dict of MAC:SSID of available WiFi networks; usually takes a few
+    seconds; it is normal to have multiple MACs with the same SSID. 'bus_address' selects a
+    D-Bus other than the system bus, e.g. for testing."""
+    try:
+        importlib.import_module("dbus_next")
+    except ImportError:
+        print_msg(2, _("dbus-next is not installed; polling for WiFi scan results"))
+        return wifi_available_ssids_polled()
+    loop = asyncio.new_event_loop()
+    try:
+        macs_found = loop.run_until_complete(wifi_scan(timeout, bus_address))
+    except (OSError, dbus_next.errors.DBusError) as err:
+        raise CGError(_("Unable to scan for WiFi networks: {}").format(err))
+    finally:
+        loop.close()
+    if macs_found is None:  # NetworkManager older than 1.12 has no 'LastScan'
+        return wifi_available_ssids_polled()
+    return macs_found
+
+
+async def wifi_scan(timeout, bus_address=None):
+    """Coroutine for wifi_available_ssids(); returns None if scan completion can't be detected"""
+    if bus_address is None:
+        bus = dbus_next_aio.MessageBus(bus_type=dbus_next.BusType.SYSTEM)
+    else:
+        bus = dbus_next_aio.MessageBus(bus_address=bus_address)
+    await bus.connect()
+    try:
+        introspection = await bus.introspect(NM_BUS_NAME, NM_PATH)
+        nm = bus.get_proxy_object(NM_BUS_NAME, NM_PATH, introspection).get_interface(NM_BUS_NAME)
+        devices = await nm.call_get_devices()
+        # Scan with all WiFi devices at the same time.
+        results = await asyncio.gather(*[wifi_scan_device(bus, d, timeout) for d in devices])
+    finally:
+        bus.disconnect()
+    if None in results:
+        return None
+    macs_found = dict()
+    for r in results:
+        macs_found.update(r)
+    return macs_found
+
+
+async def wifi_scan_device(bus, path, timeout):
+    """Scan with one device; return a dict of MAC:SSID (empty if not a WiFi device)"""
+    device_obj = bus.get_proxy_object(NM_BUS_NAME, path, await bus.introspect(NM_BUS_NAME, path))
+    if await device_obj.get_interface(NM_BUS_NAME + ".Device").get_device_type() != 2:
+        return dict()  # not NM_DEVICE_TYPE_WIFI
+    wireless = device_obj.get_interface(NM_BUS_NAME + ".Device.Wireless")
+    if not hasattr(wireless, "get_last_scan"):
+        return None
+    properties = device_obj.get_interface("org.freedesktop.DBus.Properties")
+    scan_done = asyncio.Event()
+    last_scan = await wireless.get_last_scan()
+
+    def on_properties_changed(interface, changed, invalidated):
+        if interface == NM_BUS_NAME + ".Device.Wireless" and "LastScan" in changed:
+            if changed["LastScan"].value != last_scan:
+                scan_done.set()
+
+    properties.on_properties_changed(on_properties_changed)
+    try:
+        start = time.time()
+        try:
+            await wireless.call_request_scan(dict())
+        except dbus_next.errors.DBusError as err:
+            # Usually a scan has just finished (NetworkManager then refuses to scan again for
+            # a few seconds), so the current list of access points is recent.
+            print_msg(2, _("WiFi scan not started: {}").format(err))
+        else:
+            try:
+                await asyncio.wait_for(scan_done.wait(), timeout)
+                print_msg(2, _("WiFi scan took {:.1f} seconds").format(time.time() - start))
+            except asyncio.TimeoutError:
+                print_msg(1, _("WiFi scan did not finish within {} seconds").format(timeout))
+    finally:
+        properties.off_properties_changed(on_properties_changed)
+    macs_found = dict()
+    ap_introspection = None  # the same for every access point
+    for ap_path in await wireless.call_get_all_access_points():
+        try:
+            if ap_introspection is None:
+                ap_introspection = await bus.introspect(NM_BUS_NAME, ap_path)
+            ap_obj = bus.get_proxy_object(NM_BUS_NAME, ap_path, ap_introspection)
+            ap = await ap_obj.get_interface("org.freedesktop.DBus.Properties").call_get_all(
+                NM_BUS_NAME + ".AccessPoint"
+            )
+        except dbus_next.errors.DBusError:  # access point vanished
+            continue
+        ssid = bytes(ap["Ssid"].value).decode(errors="replace")
+        macs_found[ap["HwAddress"].value.lower()] = ssid
+    return macs_found
+
+
+def fake_network_manager(access_points, scan_seconds=0.2):
+    """Return a list of (path, interface) for a minimal fake NetworkManager D-Bus service with
+    one WiFi device which sees the given dict of MAC:SSID, for testing wifi_scan()"""
+    svc = dbus_next_service
+    read = dbus_next.PropertyAccess.READ
+    device_path = NM_PATH + "/Devices/1"
+    ap_paths = [NM_PATH + "/AccessPoint/{}".format(n) for n in range(len(access_points))]
+
+    class Manager(svc.ServiceInterface):
+        @svc.method(name="GetDevices")
+        def get_devices(self) -> "ao":  # noqa: F821
+            return [device_path]
+
+    class Device(svc.ServiceInterface):
+        @svc.dbus_property(access=read, name="DeviceType")
+        def device_type(self) -> "u":  # noqa: F821
+            return 2
+
+    class Wireless(svc.ServiceInterface):
+        last_scan = 1000  # milliseconds, as CLOCK_BOOTTIME
+
+        @svc.method(name="RequestScan")
+        def request_scan(self, options: "a{sv}"):  # noqa: F722
+            asyncio.get_event_loop().call_later(scan_seconds, self.finish_scan)
+
+        def finish_scan(self):
+            self.last_scan += int(scan_seconds * 1000)
+            self.emit_properties_changed({"LastScan": self.last_scan})
+
+        @svc.method(name="GetAllAccessPoints")
+        def get_all_access_points(self) -> "ao":  # noqa: F821
+            return ap_paths
+
+        @svc.dbus_property(access=read, name="LastScan")
+        def last_scan_property(self) -> "x":  # noqa: F821
+            return self.last_scan
+
+    class AccessPoint(svc.ServiceInterface):
+        def __init__(self, mac, ssid):
+            super().__init__(NM_BUS_NAME + ".AccessPoint")
+            self.mac = mac
+            self.ssid = ssid
+
+        @svc.dbus_property(access=read, name="Ssid")
+        def ssid_property(self) -> "ay":  # noqa: F821
+            return self.ssid.encode()
+
+        @svc.dbus_property(access=read, name="HwAddress")
+        def hw_address(self) -> "s":  # noqa: F821
+            return self.mac
+
+    interfaces = [
+        (NM_PATH, Manager(NM_BUS_NAME)),
+        (device_path, Device(NM_BUS_NAME + ".Device")),
+        (device_path, Wireless(NM_BUS_NAME + ".Device.Wireless")),
+    ]
+    for path, (mac, ssid) in zip(ap_paths, access_points.items()):
+        interfaces.append((path, AccessPoint(mac, ssid)))
+    return interfaces
+
+
+def wifi_available_ssids_polled():
+    """Like wifi_available_ssids() but detect scan completion via changes in signal levels,
+    for systems without dbus-next or with NetworkManager older than 1.12"""
+    # Based: https://github.com/seveas/python-networkmanager/blob/master/examples/ssids.py
     macs_found = dict()
     os.system("nmcli dev wifi rescan 2>/dev/null")
     time.sleep(0.4)
@@ -91,7 +473,7 @@ def wifi_available_ssids():
                 #   /NetworkManager/stable/gdbus-org.freedesktop.NetworkManager.AccessPoint.html
                 aps = dev.GetAccessPoints()
                 new_sig_levels = [a.Strength for a in aps]  # list of WiFi signal levels for APs
-            except (exceptions.DBusException, NetworkManager.ObjectVanished):
+            except (dbus.exceptions.DBusException, NetworkManager.ObjectVanished):
                 # ~5% of the scans, we get: No such interface 'org.freedesktop.DBus.Properties'
                 time.sleep(0.1)
                 continue
@@ -179,10 +561,26 @@ def hashed_md5_password(password, salt=None):  # https://stackoverflow.com/a/272
     return crypt.crypt(password, salt)
 
 
-def generate_ssh_key_pair():  # based on: https://stackoverflow.com/a/39126754/10590519
-    """Return a tuple containing new public and private keys."""
+def generate_ssh_key_pair(key_type="rsa"):
+    """Return a tuple containing new public and private keys. 'key_type' is 'rsa' or 'ed25519'."""
+    # Based on: https://stackoverflow.com/a/39126754/10590519
+    if key_type == "ed25519":
+        key = ed25519.Ed25519PrivateKey.generate()
+        private_key = key.private_bytes(
+            crypto_serialization.Encoding.PEM,
+            crypto_serialization.PrivateFormat.OpenSSH,  # the only format paramiko reads
+            crypto_serialization.NoEncryption(),
+        ).decode()
+        public_key = (
+            key.public_key()
+            .public_bytes(
+                crypto_serialization.Encoding.OpenSSH, crypto_serialization.PublicFormat.OpenSSH
+            )
+            .decode()
+        )
+        return (public_key, private_key)
     key = rsa.generate_private_key(
-        backend=crypto_default_backend(), public_exponent=65537, key_size=2048
+        backend=crypto_backends.default_backend(), public_exponent=65537, key_size=2048
     )
     private_key = key.private_bytes(
         crypto_serialization.Encoding.PEM,
@@ -205,13 +603,149 @@ def generate_ssh_key_pair():  # based on: https://stackoverflow.com/a/39126754/1
     )
 
 
+def ssh_key_class(key_type_name):
+    """Return the paramiko class for an OpenSSH key type name such as 'ssh-rsa'"""
+    if key_type_name == "ssh-ed25519":
+        return paramiko.Ed25519Key
+    if key_type_name.startswith("ecdsa-"):
+        return paramiko.ECDSAKey
+    return paramiko.RSAKey
+
+
+class KeyPool:
+    """
+    Store of pre-generated ssh key pairs, so that a new router does not wait for a 2048-bit
+    RSA key to be generated. Each key pair is a file in conf_dir()/keypool, readable only by
+    the user; a pair is claimed by renaming its file, so several processes can share the pool.
+    A background thread tops the pool back up to 'size' pairs of each key type in use; at
+    exit, it is stopped after the pair it is writing. Partly written or claimed files left by
+    a process which was killed are removed once they are 'stale_after' seconds old.
+    """
+
+    size = 8  # pairs of each key type; 0 disables the pool
+    allow_ed25519 = False  # use Ed25519 keys on routers which support them
+    lock = threading.Lock()
+    refilling = None  # the background refill thread, if running
+    stopping = False  # set at exit, so the refill thread stops after the current pair
+    stale_after = 600  # seconds; generating and writing a pair takes well under one
+
+    @staticmethod
+    def path():
+        return os.path.join(ConfigSaver.conf_dir(), "keypool")
+
+    @staticmethod
+    def key_types():
+        return ["rsa", "ed25519"] if KeyPool.allow_ed25519 else ["rsa"]
+
+    @staticmethod
+    def _entries(key_type):
+        try:
+            names = os.listdir(KeyPool.path())
+        except FileNotFoundError:
+            return list()
+        return sorted(n for n in names if n.startswith(key_type + "-") and n.endswith(".key"))
+
+    @staticmethod
+    def add(key_type):
+        """Generate a key pair and add it to the pool"""
+        os.makedirs(KeyPool.path(), mode=0o700, exist_ok=True)
+        (pub, priv) = generate_ssh_key_pair(key_type)
+        name = "{}-{}.key".format(key_type, uuid.uuid4().hex)
+        temp_path = os.path.join(KeyPool.path(), name + ".0")
+        # Create with restricted permissions so the private key is never readable by others
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as key_file:
+            json.dump({"public": pub, "private": priv}, key_file)
+        os.rename(temp_path, os.path.join(KeyPool.path(), name))
+
+    @staticmethod
+    def take(key_type="rsa"):
+        """Return a (public, private) key pair from the pool, or a newly generated one if the
+        pool is empty, and start refilling the pool in the background."""
+        for name in KeyPool._entries(key_type):
+            path = os.path.join(KeyPool.path(), name)
+            claimed = path + ".{}".format(os.getpid())
+            try:
+                os.rename(path, claimed)  # atomic, so no other process can take this pair
+            except FileNotFoundError:
+                continue  # taken by another process
+            try:
+                with open(claimed, "r") as key_file:
+                    pair = json.load(key_file)
+            finally:
+                os.remove(claimed)
+            KeyPool.refill_in_background()
+            return (pair["public"], pair["private"])
+        KeyPool.refill_in_background()
+        return generate_ssh_key_pair(key_type)
+
+    @staticmethod
+    def remove_stale():
+        """Remove files other than complete pairs, e.g. '.key.0' from an interrupted add(),
+        which are more than 'stale_after' seconds old"""
+        try:
+            names = os.listdir(KeyPool.path())
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(KeyPool.path(), name)
+            try:
+                if not name.endswith(".key") and (
+                    time.time() - os.stat(path).st_mtime > KeyPool.stale_after
+                ):
+                    os.remove(path)
+            except FileNotFoundError:
+                pass  # removed by another process
+
+    @staticmethod
+    def fill():
+        """Generate key pairs until the pool is full; return the number generated"""
+        KeyPool.remove_stale()
+        added = 0
+        for key_type in KeyPool.key_types():
+            while len(KeyPool._entries(key_type)) < KeyPool.size and not KeyPool.stopping:
+                KeyPool.add(key_type)
+                added += 1
+        return added
+
+    @staticmethod
+    def refill_in_background():
+        """Start a thread to fill the pool, unless one is already running. At exit, the thread
+        finishes the pair it is writing (see _stop())."""
+        with KeyPool.lock:
+            if KeyPool.size <= 0 or (
+                KeyPool.refilling is not None and KeyPool.refilling.is_alive()
+            ):
+                return
+            if KeyPool.refilling is None:
+                atexit.register(KeyPool._stop)
+            # A daemon thread, as exit would otherwise wait for the pool to be full
+            KeyPool.refilling = threading.Thread(
+                target=KeyPool._refill, name="key pool", daemon=True
+            )
+            KeyPool.refilling.start()
+
+    @staticmethod
+    def _stop():
+        KeyPool.stopping = True
+        KeyPool.refilling.join()
+
+    @staticmethod
+    def _refill():
+        try:
+            KeyPool.fill()
+        except (OSError, CGError) as err:
+            print_msg(2, _("Unable to refill key pool: {}").format(err))
+
+
 def add_line_breaks(long_string, line_len=70):
     return "\n".join(long_string[i : i + line_len] for i in range(0, len(long_string), line_len))
 
 
-def possible_router_ips():
-    """Return a list of IP addresses which may be a router - currently first IP of each subnet."""
-    possible_routers = list()  # items are type ipaddress.ip_address
+def local_networks():
+    """Return a list of (network, our address) tuples for each network we are connected to,
+    as ipaddress objects. Loopback, link-local and single-address networks are skipped."""
+    networks = list()
     for intf in netifaces.interfaces():  # e.g. eth0, lo
         for ip_ver in [netifaces.AF_INET, netifaces.AF_INET6]:  # IPv4 then IPv6
             if ip_ver in netifaces.ifaddresses(intf):  # if this interface has at least one address
@@ -220,78 +754,566 @@ def possible_router_ips():
                         addr = a["addr"].split("%")[0]  # strip away '%' and interface name
                         prefix_len = bin(
                             int.from_bytes(
-                                ipaddress.ip_address(a["netmask"]).packed, byteorder="big"
+                                ipaddress.ip_address(a["netmask"].split("/")[0]).packed,
+                                byteorder="big",
                             )
                         ).count("1")
                         subnet = ipaddress.ip_network(addr + "/" + str(prefix_len), strict=False)
+                        address = ipaddress.ip_address(addr)
                         if (
                             prefix_len < subnet.max_prefixlen  # not a /32 (IPv4) address
-                            and not ipaddress.ip_address(addr).is_link_local
+                            and not address.is_link_local
+                            and not address.is_loopback
                         ):
-                            first_ip = subnet[1]  # assume router is first IP in subnet
-                            if not first_ip == ipaddress.ip_address(addr):  # if not our IP
-                                possible_routers.append(first_ip)
+                            networks.append((subnet, address))
+    return networks
+
+
+def possible_router_ips():
+    """Return a list of IP addresses which may be a router - the first IP of each subnet."""
+    possible_routers = list()  # items are type ipaddress.ip_address
+    for subnet, address in local_networks():
+        first_ip = subnet[1]  # assume router is first IP in subnet
+        if not first_ip == address:  # if not our IP
+            possible_routers.append(first_ip)
     return possible_routers
 
 
-def ssh_keyscan(ip, port=22):
+def sweep_targets(cidrs=None, max_hosts=SWEEP_MAX_HOSTS):
+    """Return a list of IP addresses to probe: every host in each of 'cidrs' (strings), or
+    in each local IPv4 network. A local network with more than 'max_hosts' addresses is
+    narrowed to the /24 around our address; for IPv6, only the first IP is used."""
+    targets = list()
+    if cidrs is not None:
+        for cidr in cidrs:
+            try:
+                network = ipaddress.ip_network(cidr, strict=False)
+            except ValueError as err:
+                raise CGError(_("Invalid network {}: {}").format(cidr, err))
+            if network.num_addresses > max_hosts * 64:
+                raise CGError(_("Network {} is too large to scan").format(cidr))
+            targets += list(network.hosts()) if network.num_addresses > 1 else [network[0]]
+    else:
+        for subnet, address in local_networks():
+            if subnet.version == 6:
+                targets.append(subnet[1])
+                continue
+            if subnet.num_addresses > max_hosts:
+                subnet = ipaddress.ip_network("{}/24".format(address), strict=False)
+                print_msg(1, _("Only scanning {}; use --cidr to scan more").format(subnet))
+            targets += [ip for ip in subnet.hosts() if ip != address]
+    return list(dict.fromkeys(targets))  # remove duplicates, keeping order
+
+
+def sweep_ports(targets, ports=(22, 23), timeout=SWEEP_TIMEOUT, rate=SWEEP_RATE):
+    """Try a TCP connection to each port of each IP address in 'targets', starting at most
+    'rate' connections per second. Return a dict of IP address: set of open ports."""
+    if len(targets) == 0:
+        return dict()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(sweep_ports_async(targets, ports, timeout, rate))
+    finally:
+        loop.close()
+
+
+async def sweep_ports_async(targets, ports, timeout, rate, max_open=256):
+    found = dict()
+    semaphore = asyncio.Semaphore(max_open)  # limit open sockets as well as the rate
+
+    async def probe(n, ip, port):
+        await asyncio.sleep(n / rate)
+        async with semaphore:
+            try:
+                __, writer = await asyncio.wait_for(
+                    asyncio.open_connection(str(ip), port), timeout
+                )
+            except (OSError, asyncio.TimeoutError):  # closed, filtered, or no host
+                return
+            writer.close()
+            found.setdefault(ip, set()).add(port)
+
+    probes = itertools.product(targets, ports)
+    await asyncio.gather(*[probe(n, ip, port) for n, (ip, port) in enumerate(probes)])
+    return found
+
+
+def neighbor_table():
+    """Return a dict of IP address (string): MAC address from the kernel's neighbor (ARP and
+    NDP) table, which a port sweep fills in for every host that answered"""
+    neighbors = dict()
+    try:
+        output = subprocess.run(
+            ["ip", "neigh", "show"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            timeout=5,
+        ).stdout
+        for line in output.splitlines():  # e.g. '192.168.8.1 dev wlan0 lladdr e4:95:... STALE'
+            fields = line.split()
+            if "lladdr" in fields:
+                neighbors[fields[0]] = fields[fields.index("lladdr") + 1].lower()
+        return neighbors
+    except (OSError, subprocess.SubprocessError):  # no 'ip' command
+        pass
+    try:
+        with open("/proc/net/arp", "r") as arp_file:
+            for line in arp_file.readlines()[1:]:  # IP, HW type, flags, HW address, mask, device
+                fields = line.split()
+                if len(fields) >= 4 and fields[2] != "0x0":  # 0x0 is an incomplete entry
+                    neighbors[fields[0]] = fields[3].lower()
+    except OSError:
+        pass
+    return neighbors
+
+
+def default_gateways():
+    """Return a set of the default gateway IP addresses (strings)"""
+    try:
+        defaults = netifaces.gateways().get("default", dict())
+    except (OSError, ValueError):
+        return set()
+    return {gateway[0] for gateway in defaults.values()}
+
+
+def quiet_probe_log():
+    """Return the name of a Paramiko log channel whose messages are dropped; failures are
+    expected when probing hosts"""
+    logger = logging.getLogger("cleargopher.keyscan")
+    if len(logger.handlers) == 0:
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+    return "cleargopher.keyscan"
+
+
+def ssh_keyscan(ip, port=22, timeout=None):
+    """Return the router's host key as an OpenSSH-format string, or None if it cannot be
+    retrieved within the given timeout (seconds)"""
+    log_channel = quiet_probe_log()
     try:
-        transport = paramiko.Transport((ip, port))
-        transport.connect()
+        sock = socket.create_connection((ip, port), timeout=timeout)
+    except OSError:  # includes socket.gaierror and socket.timeout
+        return None
+    try:
+        transport = paramiko.Transport(sock)
+        transport.set_log_channel(log_channel)
+        transport.banner_timeout = timeout
+        transport.start_client(timeout=timeout)
         key = transport.get_remote_server_key()
         transport.close()
         return key.get_name() + " " + key.get_base64()
-    except (paramiko.ssh_exception.SSHException, gaierror):
+    except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+        sock.close()
         return None
 
 
-def new_nickname(mac=None):
-    manuf = ""
-    known_macs = """
-        # Small subset of OUI database from:
-        # https://code.wireshark.org/review/gitweb?p=wireshark.git;a=blob_plain;f=manuf
-        # Note literal tab characters don't work.
+def ssh_auth_none(ip, port=22, timeout=None):
+    """Return True if the ssh server at ip lets 'root' log in with no authentication, as
+    OpenWrt's dropbear does after a factory reset, until a password is set"""
+    log_channel = quiet_probe_log()
+    try:
+        sock = socket.create_connection((ip, port), timeout=timeout)
+    except OSError:
+        return False
+    transport = paramiko.Transport(sock)
+    try:
+        transport.set_log_channel(log_channel)
+        transport.banner_timeout = timeout
+        transport.start_client(timeout=timeout)
+        transport.auth_none("root")
+        return transport.is_authenticated()
+    except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+        return False
+    finally:
+        transport.close()
+
+
+def hostkey_fingerprint(hostkey):
+    """Return the OpenSSH-style SHA256 fingerprint of a host key in 'type base64' form; line
+    breaks, as added by add_line_breaks(), are ignored"""
+    key_base64 = "".join(hostkey.split("\n")).split(" ")[1]
+    digest = sha256(base64.b64decode(key_base64)).digest()
+    return "SHA256:" + base64.b64encode(digest).decode().rstrip("=")
+
+
+def mac_address(ip):
+    """Return the MAC address of the given ipaddress.ip_address; None if unroutable and
+    '00:00:00:00:00:00' if unreachable"""
+    if isinstance(ip, ipaddress.IPv4Address):
+        return getmac.get_mac_address(ip=str(ip))
+    elif isinstance(ip, ipaddress.IPv6Address):
+        return getmac.get_mac_address(ip6=str(ip))
+    else:
+        raise TypeError("ip must be ipaddress")
+
+
+def probe_concurrently(probe, items, timeout, max_workers=32):
+    """Run probe(item) for each item in a bounded thread pool. Return a list of results in the
+    same order as items, so results never depend on scheduling order. A probe which raises
+    OSError or does not finish within 'timeout' seconds (per probe) gives None."""
+    if len(items) == 0:
+        return list()
+    workers = min(max_workers, len(items))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(probe, i) for i in items]
+        waves = -(-len(items) // workers)  # ceiling division; probes beyond 'workers' must queue
+        concurrent.futures.wait(futures, timeout=timeout * waves)
+        results = list()
+        for f in futures:
+            if not f.done():
+                f.cancel()  # too slow; the worker thread is abandoned
+                results.append(None)
+            elif isinstance(f.exception(), OSError):
+                results.append(None)
+            else:
+                results.append(f.result())  # re-raises any unexpected exception
+        return results
+    finally:
+        executor.shutdown(wait=False)
+
+
+class OuiIndex:
+    """
+    Vendor (OUI) database compiled into a compact binary index which can be memory-mapped.
+    The file is a header, then records sorted by MAC prefix, then NUL-terminated names:
+
+        header:  8-byte magic, record count (uint32), the prefix lengths in bits which are
+                 present (48 bytes, zero-padded)
+        record:  uint64 (48-bit prefix << 8 | prefix length), uint32 name offset
+
+    Looking up a MAC is a binary search for each prefix length present, longest first.
+    """
+
+    magic = b"CGOUI\x00\x02\x00"
+    header = struct.Struct(">8sI48s")
+    record = struct.Struct(">QI")
+    # Small subset of OUI database from:
+    # https://code.wireshark.org/review/gitweb?p=wireshark.git;a=blob_plain;f=manuf
+    embedded_manuf = """
         E4:95:6E:40:00:00/28  GL.iNet
         B8:27:EB              Raspberry Pi
         94:B8:6D              Intel
         9C:B6:D0              RivetNet
     """
-    if mac is not None and mac != "00:00:00:00:00:00":
-        digits_of_mac = mac.translate({ord(c): None for c in [":", "-", ".", " "]}).lower()
-        line_re = re.compile(r"^\s*([0-9a-fA-F:\.-]+)(/[0-9]+)?\s+([^#]+)$")
-        comment_re = re.compile(r"^\s*(#.*)?$")
-        for line in known_macs.split("\n"):
+    manuf_paths = ["/usr/share/wireshark/manuf", "/usr/share/wireshark/wireshark/manuf"]
+    _default = None
+
+    def __init__(self, data):
+        """'data' is the index as bytes or as an mmap"""
+        self.data = data
+        magic, self.count, lengths = OuiIndex.header.unpack_from(data, 0)
+        if magic != OuiIndex.magic:
+            raise CGError(_("Invalid OUI index"))
+        self.prefix_lengths = sorted((b for b in lengths if b > 0), reverse=True)
+        self.names_start = OuiIndex.header.size + self.count * OuiIndex.record.size
+
+    @staticmethod
+    def path():
+        return os.path.join(ConfigSaver.conf_dir(), "oui.idx")
+
+    @staticmethod
+    def parse_manuf(text):
+        """Return a dict of (prefix, prefix length): name from Wireshark 'manuf' format text.
+        Without a '/bits' mask, the prefix length is that of the address given, e.g. 48 bits
+        for a full address."""
+        line_re = re.compile(r"^\s*([0-9a-fA-F:\.-]+)(/[0-9]+)?\s+(.+)$")
+        comment_re = re.compile(r"(^|\s)#.*$")  # whole line, or after the fields
+        entries = dict()
+        for line in text.split("\n"):
+            line = comment_re.sub("", line)
             match = line_re.match(line)
             if match:
-                mask = 24 if match[2] is None else int(re.sub(r"\D", "", match[2]))
-                assert (mask / 4).is_integer(), _("mask not multiple of 4: {}").format(line)
-                mask_div_4 = int(mask / 4)  # ¼ of address mask is the number of hex digits needed
-                line_digits = (
-                    match[1].translate({ord(c): None for c in [":", "-", ".", " "]}).lower()
-                )
-                if digits_of_mac[0:mask_div_4] == line_digits[0:mask_div_4]:
-                    manuf = " " + match[3].rstrip()
-            elif not comment_re.match(line):
+                digits = match[1].translate({ord(c): None for c in [":", "-", ".", " "]})
+                bits = 4 * len(digits) if match[2] is None else int(match[2][1:])
+                if len(digits) > 12 or bits > 48 or bits < 1:
+                    raise CGError(_("Invalid OUI line: {}").format(line))
+                prefix = int(digits, 16) << (48 - 4 * len(digits)) & ~((1 << (48 - bits)) - 1)
+                # Fields are tab-separated: short name, then optional long name.
+                entries[(prefix, bits)] = match[3].rstrip().split("\t")[-1].strip()
+            elif line.strip() != "":
                 raise CGError(_("Invalid OUI line: {}").format(line))
-        return "new" + manuf + " device"
+        return entries
+
+    @staticmethod
+    def compile(entries):
+        """Return the binary index, as bytes, for a dict from parse_manuf()"""
+        lengths = sorted({bits for __, bits in entries})  # at most 48, as checked by parse_manuf()
+        records = io.BytesIO()
+        names = io.BytesIO()
+        name_offsets = dict()  # many prefixes share a name
+        for prefix, bits in sorted(entries):
+            name = entries[(prefix, bits)]
+            if name not in name_offsets:
+                name_offsets[name] = names.tell()
+                names.write(name.encode() + b"\x00")
+            records.write(OuiIndex.record.pack(prefix << 8 | bits, name_offsets[name]))
+        header = OuiIndex.header.pack(OuiIndex.magic, len(entries), bytes(lengths))
+        return header + records.getvalue() + names.getvalue()
+
+    @staticmethod
+    def rebuild(manuf_path=None):
+        """Compile a Wireshark 'manuf' file into the index file; return the number of entries"""
+        if manuf_path is None:
+            manuf_path = next((p for p in OuiIndex.manuf_paths if os.path.exists(p)), None)
+            if manuf_path is None:
+                raise CGError(_("No 'manuf' file found; install wireshark or use --manuf"))
+        try:
+            with open(manuf_path, "r", encoding="utf-8", errors="replace") as manuf_file:
+                entries = OuiIndex.parse_manuf(manuf_file.read())
+        except OSError as err:
+            raise CGError(_("Unable to read {}: {}").format(manuf_path, err))
+        for key, name in OuiIndex.parse_manuf(OuiIndex.embedded_manuf).items():
+            entries.setdefault(key, name)
+        os.makedirs(ConfigSaver.conf_dir(), mode=0o700, exist_ok=True)
+        with open(OuiIndex.path() + ".0", "wb") as index_file:
+            index_file.write(OuiIndex.compile(entries))
+        os.replace(OuiIndex.path() + ".0", OuiIndex.path())
+        OuiIndex._default = None
+        return len(entries)
+
+    @staticmethod
+    def open(path):
+        with open(path, "rb") as index_file:
+            return OuiIndex(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @staticmethod
+    def default():
+        """Return the index file if it has been built, otherwise the small embedded list"""
+        if OuiIndex._default is None:
+            try:
+                OuiIndex._default = OuiIndex.open(OuiIndex.path())
+            except (OSError, ValueError, struct.error, CGError):
+                entries = OuiIndex.parse_manuf(OuiIndex.embedded_manuf)
+                OuiIndex._default = OuiIndex(OuiIndex.compile(entries))
+        return OuiIndex._default
+
+    def _find(self, key):
+        """Return the name offset for the record with the given key, or None"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, offset = OuiIndex.record.unpack_from(
+                self.data, OuiIndex.header.size + mid * OuiIndex.record.size
+            )
+            if k == key:
+                return offset
+            if k < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def lookup(self, mac):
+        """Return the vendor name for the given MAC address, or None if unknown"""
+        digits = mac.translate({ord(c): None for c in [":", "-", ".", " "]})
+        if not re.fullmatch(r"[0-9a-fA-F]{12}", digits):
+            return None
+        value = int(digits, 16)
+        for bits in self.prefix_lengths:  # longest prefix first
+            offset = self._find((value & ~((1 << (48 - bits)) - 1)) << 8 | bits)
+            if offset is not None:
+                start = self.names_start + offset
+                return bytes(self.data[start : self.data.find(b"\x00", start)]).decode()
+        return None
+
+
+def new_nickname(mac=None, oui=None):
+    if mac is not None and mac != "00:00:00:00:00:00":
+        manuf = (oui if oui is not None else OuiIndex.default()).lookup(mac)
+        return "new" + ("" if manuf is None else " " + manuf) + " device"
+
+
+def oui_benchmark(entry_count=50000, lookup_count=100000) -> None:
+    """Time lookups in an index of 'entry_count' random entries, to show they stay fast"""
+    rand = random.Random(1)  # repeatable
+    entries = dict()
+    while len(entries) < entry_count:
+        bits = rand.choice([24, 24, 24, 28, 36])
+        prefix = rand.getrandbits(48) & ~((1 << (48 - bits)) - 1)
+        entries[(prefix, bits)] = "Vendor {}".format(len(entries) % 5000)
+    with tempfile.NamedTemporaryFile() as index_file:
+        start = time.perf_counter()
+        index_file.write(OuiIndex.compile(entries))
+        index_file.flush()
+        print(
+            _("Compiled {} entries in {:.0f} ms").format(
+                entry_count, (time.perf_counter() - start) * 1000
+            )
+        )
+        oui = OuiIndex.open(index_file.name)
+        macs = ["{:012x}".format(rand.getrandbits(48)) for __ in range(lookup_count // 2)]
+        macs += [
+            "{:012x}".format(p | rand.getrandbits(48 - b))
+            for p, b in list(entries)[0 : lookup_count // 2]
+        ]
+        start = time.perf_counter()
+        found = sum(1 for m in macs if oui.lookup(m) is not None)
+        per_lookup = (time.perf_counter() - start) / len(macs) * 1e6
+    print(_("{} lookups ({} found): {:.2f} µs per lookup").format(len(macs), found, per_lookup))
+
+
+def batch_script(commands, marker):
+    """Return a shell script which runs each (command, okay_to_fail) in 'commands' in turn.
+    After each command, a line with 'marker', the command index, and its exit status is
+    written to stdout, and a line with 'marker' and the index to stderr. The script stops after
+    the first command which fails and is not okay_to_fail."""
+    script = ""
+    for n, (command, okay_to_fail) in enumerate(commands):
+        # The ':' avoids an empty group (a syntax error) if the command is only a comment.
+        script += "{ :\n" + command + "\n}\n"
+        script += "__cg_rc=$?\n"
+        script += "printf '\\n%s %d %d\\n' {} {} $__cg_rc\n".format(marker, n)
+        script += "printf '\\n%s %d\\n' {} {} >&2\n".format(marker, n)
+        if not okay_to_fail:
+            script += "[ $__cg_rc -eq 0 ] || exit $__cg_rc\n"
+    return script
+
+
+def split_batch_output(stdout, stderr, marker):
+    """Split the output of a script from batch_script() into a list of (exit status, stdout,
+    stderr) tuples, one for each command which completed"""
+    out_parts = re.split(r"\n{} (\d+) (-?\d+)\n".format(re.escape(marker)), stdout)
+    err_parts = re.split(r"\n{} (\d+)\n".format(re.escape(marker)), stderr)
+    results = list()
+    for n in range((len(out_parts) - 1) // 3):
+        out = out_parts[n * 3]
+        exitc = int(out_parts[n * 3 + 2])
+        err = err_parts[n * 2] if n * 2 < len(err_parts) else ""
+        results.append((exitc, out, err))
+    return results
+
+
+def stream_channel(channel, timeout=None):
+    """Read a Paramiko channel running a command until the command exits. Yield a tuple
+    ('stdout', line) or ('stderr', line) for each line as it arrives, and finally ('exit',
+    exit status). Lines longer than STREAM_MAX_LINE are yielded in pieces. Raise
+    RemoteExecutionError if the command runs for more than 'timeout' seconds."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    readers = [
+        ("stdout", channel.recv_ready, channel.recv),
+        ("stderr", channel.recv_stderr_ready, channel.recv_stderr),
+    ]
+    pending = {"stdout": b"", "stderr": b""}
+
+    def lines(stream):
+        while True:
+            end = pending[stream].find(b"\n", 0, STREAM_MAX_LINE) + 1
+            if end == 0 and len(pending[stream]) < STREAM_MAX_LINE:
+                break
+            end = end or STREAM_MAX_LINE
+            yield stream, pending[stream][:end].decode(errors="replace")
+            pending[stream] = pending[stream][end:]
+
+    while True:
+        received = False
+        for stream, ready, recv in readers:
+            while ready():
+                pending[stream] += recv(STREAM_CHUNK)
+                received = True
+                yield from lines(stream)
+        if received:
+            continue
+        if channel.closed or (channel.eof_received and channel.exit_status_ready()):
+            break
+        wait = 0.1  # stdout and stderr wake select(); the exit status alone does not
+        if deadline is not None:
+            wait = min(wait, deadline - time.monotonic())
+            if wait <= 0:
+                raise RemoteExecutionError(_("Timed out after {} seconds").format(timeout))
+        select.select([channel], [], [], wait)
+    # Output may have arrived after the ready() checks above. Now that the channel has ended,
+    # recv() returns what is left without blocking, then b"".
+    for stream, __, recv in readers:
+        while True:
+            data = recv(STREAM_CHUNK)
+            if len(data) == 0:
+                break
+            pending[stream] += data
+            yield from lines(stream)
+        if pending[stream]:
+            yield stream, pending[stream].decode(errors="replace")
+    yield "exit", channel.recv_exit_status()
+
+
+def relay_channel(sock, channel):
+    """Copy data both ways between a socket and a Paramiko channel until either end closes
+    its connection, then close the channel; return the number of bytes copied"""
+    copied = 0
+    try:
+        closed = False
+        while not closed:
+            readable, __, __ = select.select([sock, channel], [], [])
+            for source, send in [(sock, channel.sendall), (channel, sock.sendall)]:
+                if source in readable:
+                    data = source.recv(STREAM_CHUNK)
+                    send(data)
+                    copied += len(data)
+                    closed = closed or len(data) == 0  # one end closed its connection
+    except OSError:
+        pass
+    finally:
+        channel.close()
+    return copied
+
+
+def too_much_output(command):
+    return _("More than {} MiB of output from command: {}").format(
+        EXEC_MAX_OUTPUT // 2**20, command
+    )
 
 
-class SSHClientNoAuth(paramiko.SSHClient):
-    # The work-around below is because paramiko does not support the "auth_none"
-    # option (SSH requiring no authentication at all). For more details, see
-    # https://stackoverflow.com/a/32986895/10590519
-    # Instead of this work-around, one could modify "paramiko/client.py" and
-    # change the last line of "_auth()"
-    # from: raise SSHException("No authentication methods available")
-    # to:   self._transport.auth_none(username)
+def ssh_client(methods, router=None):
+    """Return a new paramiko.SSHClient which logs in by trying each of 'methods' ("none",
+    "ssh key" and "password", the latter two using router's credentials) in turn on one
+    connection. The method which worked is kept in the client's 'auth_method', and those the
+    router refused in 'refused_methods'."""
 
-    def _auth(self, username, *args):
-        self._transport.auth_none(username)
+    class SSHClientMultiAuth(paramiko.SSHClient):  # defined here so paramiko is imported lazily
+        # Paramiko's SSHClient.connect() does not support the "auth_none" option (SSH
+        # requiring no authentication at all), and a failed login means connecting again to
+        # try another method. For more details, see
+        # https://stackoverflow.com/a/32986895/10590519 and
+        # https://stackoverflow.com/questions/54296230
+        auth_method = None
+        refused_methods = ()
+
+        def _auth(self, username, *args):
+            allowed = None  # auth types the server accepts, from its first refusal
+            self.refused_methods = list()
+            for method in methods:
+                if method == "ssh key" and allowed is not None and "publickey" not in allowed:
+                    continue
+                self.refused_methods.append(method)  # until it succeeds
+                try:
+                    if method == "none":
+                        self._transport.auth_none(username)
+                    elif method == "ssh key":
+                        self._transport.auth_publickey(username, router.private_key())
+                    else:
+                        self._transport.auth_password(username, router.router_password)
+                except paramiko.ssh_exception.BadAuthenticationType as err:
+                    allowed = err.allowed_types
+                    continue
+                except paramiko.ssh_exception.AuthenticationException:
+                    continue
+                self.refused_methods.pop()
+                self.auth_method = method
+                return
+            raise paramiko.ssh_exception.AuthenticationException(
+                _("Tried {}").format(", ".join(methods))
+            )
+
+    return SSHClientMultiAuth()
 
 
 class Router(yaml.YAMLObject):
     yaml_loader = yaml.SafeLoader
     yaml_tag = "!Router"  # https://stackoverflow.com/a/2890073/10590519
+    ssh_port = 22  # may be set per router, e.g. for a SimulatedRouter
+    telnet_port = 23
+    hostkey_changes = 0  # count of set_hostkey() calls, so Config can tell its index is stale
 
     def __init__(self, ip: Union[IPv4Address, IPv6Address], mac: str) -> None:
         assert mac is not None and mac != "00:00:00:00:00:00"
@@ -300,8 +1322,12 @@ class Router(yaml.YAMLObject):
         self.nickname = new_nickname(mac)
         self.create = time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime())
         self.version_map = dict()
+        self.content_map = dict()  # coterie id: fingerprint of the coterie as last applied
         self.router_password = None
+        # ssh login method which worked last time; tried first, unless it was the password
+        self.auth_method = None
         self.client = None
+        self._secrets = dict()
 
     def generate_passwords(self):
         self.first_password = generate_new_password(length=12)
@@ -312,12 +1338,44 @@ class Router(yaml.YAMLObject):
         # Instead of ssh-keyscan, a safer option would be to convert
         # /etc/dropbear/dropbear_rsa_host_key to OpenSSH format. See:
         # https://github.com/mkj/dropbear/blob/master/dropbearconvert.c
-        self.ssh_hostkey = add_line_breaks(ssh_keyscan(self.ip), line_len=64)
+        if getattr(self, "ssh_hostkey", None) is None:  # not already found during discovery
+            self.set_hostkey(add_line_breaks(ssh_keyscan(self.ip, self.ssh_port), line_len=64))
         # 64 (above) matches the privkey width
-        (pub, priv) = generate_ssh_key_pair()
+        # A dropbear which offers an Ed25519 host key (2020.79 or later) accepts Ed25519 user keys
+        if KeyPool.allow_ed25519 and self.ssh_hostkey.startswith("ssh-ed25519 "):
+            (pub, priv) = KeyPool.take("ed25519")
+        else:
+            (pub, priv) = KeyPool.take("rsa")
         self.ssh_pubkey = add_line_breaks(pub, line_len=64)
         self.ssh_privkey = priv
 
+    def known_hosts_name(self):
+        """Return the name used for the router's host key, as in ~/.ssh/known_hosts"""
+        return self.ip if self.ssh_port == 22 else "[{}]:{}".format(self.ip, self.ssh_port)
+
+    def secret(self, name, salt=None):
+        """Return a secret derived from the router password or ssh key: 'root_shadow_line',
+        'http_password_sha256', or 'authorized_keys_line'. Each is computed once per router (and
+        salt), and recomputed only if the password or key changes."""
+        source = self.ssh_pubkey if name == "authorized_keys_line" else self.router_password
+        if not hasattr(self, "_secrets"):  # Router loaded from the configuration file
+            self._secrets = dict()
+        key = (name, salt, source)
+        if key not in self._secrets:
+            if name == "root_shadow_line":
+                # With no salt, hashed_md5_password() picks a random one; that is done once, so
+                # every coterie on this router gets the same line.
+                p = "root:" + hashed_md5_password(source, salt) + ":0:0:99999:7:::"
+            elif name == "http_password_sha256":
+                p = sha256(source.encode()).hexdigest()
+            elif name == "authorized_keys_line":
+                # Remove all whitespace except a space by itself
+                p = re.sub(r"(\s{2,})|([\t\r\n]+)|(\s+$)", "", source)
+            else:
+                raise KeyError(name)
+            self._secrets[key] = p
+        return self._secrets[key]
+
     def set_password_on_router(self, phase2):
         # It is also possible to set the router password via http, but this is
         # programmatically more complex, plus on older GL-iNet firmware, this
@@ -332,46 +1390,33 @@ class Router(yaml.YAMLObject):
         }
         # After a hard reset, some routers and firmware version listen for a telnet connection,
         # while others listen for an ssh connection with no authentication for 'root'. Try ssh
-        # with no authentication first.
-        tmp_client = SSHClientNoAuth()
-        tmp_client.set_missing_host_key_policy(paramiko.RejectPolicy)  # ensure correct host key
-        hostkey = self.ssh_hostkey.split(" ")
-        tmp_client.get_host_keys().add(
-            self.ip, hostkey[0], paramiko.RSAKey(data=base64.b64decode(hostkey[1]))
-        )
+        # with no authentication first, and keep that connection for the coteries which follow.
         try:
-            tmp_client.connect(
-                hostname=self.ip,
-                username="root",
-                pkey=None,
-                password=None,
-                allow_agent=False,
-                look_for_keys=False,
-            )
+            self._ssh_login(["none"])
         except paramiko.ssh_exception.NoValidConnectionsError:
             print_msg(1, _("Initial connection via ssh failed - trying telnet."))
         except paramiko.ssh_exception.AuthenticationException:
             pass  # router was reset and telnet will work -OR- it is already set up
         else:  # ssh connected
-            for to_send in phase2.splitlines():
-                print_msg(1, "Router cmd:    " + to_send)
-                __, stdout, stderr = tmp_client.exec_command(to_send)
-                exitc = stdout.channel.recv_exit_status()
-                print_msg(1, "Router stdout: ".join([""] + list(stdout)), end="")
-                print_msg(1, "Router stderr: ".join([""] + list(stderr)), end="")
-                if exitc != 0:
-                    tmp_client.close()
-                    raise RemoteExecutionError(to_send)
-            tmp_client.close()
+            commands = [(line, False) for line in phase2.splitlines() if line.strip() != "exit"]
+            results = self.exec_batch(commands)
+            failed = next((n for n, r in enumerate(results) if r[0] != 0), len(results))
+            if failed < len(commands):
+                raise RemoteExecutionError(commands[failed][0])
             return
         phase1_prompts = [re.compile(p.encode()) for p in phase1]
         esc_seq_re = re.compile(r"\x1b\[[0-9;]+m")
         print_msg(1, "<telnet_log>")
         try:
-            with telnetlib.Telnet(self.ip, timeout=5) as t:
+            with telnetlib.Telnet() as t, trace("telnet", "phase", router=self):
+                start = time.monotonic()
+                t.open(self.ip, self.telnet_port, timeout=TELNET_TIMEOUT)
+                rtt = time.monotonic() - start  # TCP handshake, refined during login
+                wait = TELNET_TIMEOUT  # the banner may wait for a login process to start
                 cycles = 0
                 while cycles < 7:  # phase 1 - logging into router
-                    (index, __, data) = t.expect(phase1_prompts, timeout=5)
+                    start = time.monotonic()
+                    (index, __, data) = t.expect(phase1_prompts, timeout=wait)
                     print_msg(1, "".join(esc_seq_re.split(data.decode())), end="")
                     if index >= 0:
                         to_send = phase1[phase1_prompts[index].pattern.decode()]
@@ -380,17 +1425,35 @@ class Router(yaml.YAMLObject):
                         t.write(to_send.encode())
                     else:
                         raise CGError(_("Timeout connecting to {}").format(self.nickname))
+                    if cycles > 0:  # time from our reply to the next prompt
+                        rtt = max(rtt, time.monotonic() - start)
+                    wait = min(TELNET_TIMEOUT, max(TELNET_MIN_WAIT, TELNET_RTT_FACTOR * rtt))
                     cycles += 1
                 if cycles >= 7:
                     raise CGError(_("Unable to log in to {}").format(self.nickname))
-                for to_send in phase2.splitlines():  # phase 2 - commands to send router
-                    try:
-                        t.write((to_send + "\n").encode())
-                        (__, __, data) = t.expect([re.compile(prompt.encode())], timeout=3)
-                    except EOFError:
-                        pass
-                    print_msg(1, "".join(esc_seq_re.split(data.decode())), end="")
-                print_msg(1, "")  # make sure we end with a newline
+                # Phase 2 - send all commands in one write, as a here-document, rather than
+                # waiting for a prompt after each line. The marker line with the exit status
+                # shows they are done; the terminal's echo of the command has '$?' instead.
+                marker = "__cg_" + secrets.token_hex(8)
+                t.write(
+                    "sh <<'{0}'; echo \"{0} $?\"\n{1}\n{0}\n".format(
+                        marker, phase2.rstrip("\n")
+                    ).encode()
+                )
+                done_re = re.compile(r"{} (-?\d+)\r?\n".format(marker).encode())
+                (index, match, data) = t.expect(
+                    [done_re], timeout=wait * (len(phase2.splitlines()) + 1)
+                )
+                print_msg(1, "".join(esc_seq_re.split(data.decode(errors="replace"))))
+                if index < 0:
+                    raise CGError(_("Timeout running commands on {}").format(self.nickname))
+                t.write(b"exit\n")
+                if int(match[1]) != 0:
+                    raise RemoteExecutionError(
+                        _("Commands sent via telnet exited with status {}").format(
+                            match[1].decode()
+                        )
+                    )
         except (ConnectionRefusedError, EOFError):
             # The 'official' instructions to reset: Press and hold the "Reset" button for
             # 10 seconds, then release your finger. You will see LEDs flash in a
@@ -402,90 +1465,329 @@ class Router(yaml.YAMLObject):
         finally:
             print_msg(1, "</telnet_log>")
 
-    def connect_ssh(self):
+    def connect_ssh(self, use_broker=True, methods=("ssh key", "password")):
         if self.client is not None:
             return
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.RejectPolicy)  # ensure correct host key
-        # Host key is normally a line in ~/.ssh/known_hosts
+        with trace("connect_ssh", "phase", router=self):
+            self._connect_ssh(use_broker, methods)
+
+    def _connect_ssh(self, use_broker, methods):
+        if use_broker:
+            attached = BrokerClient.attach(self)
+            if attached is not None:  # a connection broker is running; use it
+                self.client, connect_method = attached
+                self.last_connect = time.strftime(
+                    "%Y-%m-%d_%H:%M:%S", time.gmtime()
+                ) + " {}".format(connect_method)
+                print_msg(
+                    1,
+                    _("Connected to {} via {} (connection broker)").format(
+                        self.nickname, connect_method
+                    ),
+                )
+                return
+        try:
+            self._ssh_login(methods)
+        except paramiko.ssh_exception.AuthenticationException:
+            raise CGError(_("Unable to connect to {} at {}.").format(self.nickname, self.ip))
+        if "ssh key" in self.client.refused_methods:
+            print_msg(1, _("Warning: connecting via ssh key failed"))
+
+    def _ssh_login(self, methods):
+        """Connect directly (not via a broker), trying each of 'methods' ("none", "ssh key",
+        "password") in turn on one connection, starting with the one which worked last time
+        unless that was the password: the key is always tried first, as it may have been
+        installed since. Raise Paramiko's AuthenticationException if none work."""
+        # Host key is normally a line in ~/.ssh/known_hosts
         try:
             hostkey = self.ssh_hostkey.split(" ")
         except AttributeError:
             raise CGError(_("Router has not yet been configured for ssh."))
-        self.client.get_host_keys().add(
-            self.ip, hostkey[0], paramiko.RSAKey(data=base64.b64decode(hostkey[1]))
+        remembered = getattr(self, "auth_method", None)
+        if remembered == "password":
+            remembered = None
+        client = ssh_client(sorted(methods, key=lambda m: m != remembered), router=self)
+        client.set_missing_host_key_policy(paramiko.RejectPolicy)  # ensure correct host key
+        client.get_host_keys().add(
+            self.known_hosts_name(),
+            hostkey[0],
+            ssh_key_class(hostkey[0])(data=base64.b64decode(hostkey[1])),
         )
-        # Private key is normally in ~/.ssh/id_rsa
-        privkey_file = io.StringIO()
-        privkey_file.write(self.ssh_privkey)
-        privkey_file.seek(0)
-        privkey = paramiko.RSAKey.from_private_key(privkey_file)
-        connect_method = "none"
-        try:  # first try to connect using private ssh key
-            self.client.connect(
+        try:
+            client.connect(
                 hostname=self.ip,
+                port=self.ssh_port,
                 username="root",
-                pkey=privkey,
-                # Don't use password this time because we want to know if ssh key fails.
-                # Could improve speed by using low-level class, but key should normally
-                # work so not worth it. See: https://stackoverflow.com/questions/54296230
-                password=None,
                 allow_agent=False,
                 look_for_keys=False,
             )
-            connect_method = "ssh key"
-        except paramiko.ssh_exception.AuthenticationException:
-            try:  # if private ssh key fails, try the password
-                self.client.connect(
-                    hostname=self.ip,
-                    username="root",
-                    pkey=None,
-                    password=self.router_password,
-                    allow_agent=False,
-                    look_for_keys=False,
-                )
-                print_msg(1, _("Warning: connecting via ssh key failed"))
-                connect_method = "password"
-            except paramiko.ssh_exception.AuthenticationException:
-                self.client = None
-                raise CGError(_("Unable to connect to {} at {}.").format(self.nickname, self.ip))
+        except paramiko.ssh_exception.BadHostKeyException:
+            client.close()
+            ConfigSaver.forget_hostkey(self.ip)  # so the next run does a fresh ssh_keyscan()
+            raise CGError(
+                _("The host key of {} at {} has changed.").format(self.nickname, self.ip)
+            )
+        except:  # noqa: E722
+            client.close()
+            raise
+        self.close()  # any earlier connection, which would otherwise be left open
+        self.client = client
+        self.auth_method = client.auth_method
         self.last_connect = time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime()) + " {}".format(
-            connect_method
+            client.auth_method
         )
-        print_msg(1, _("Connected to {} via {}").format(self.nickname, connect_method))
+        print_msg(1, _("Connected to {} via {}").format(self.nickname, client.auth_method))
+
+    def private_key(self):
+        """Return our private ssh key for this router as a Paramiko key, parsed only once"""
+        # Private key is normally in ~/.ssh/id_rsa
+        cached = getattr(self, "_private_key", None)
+        if cached is None or cached[0] != self.ssh_privkey:
+            key_class = ssh_key_class(self.ssh_pubkey.split(" ")[0])
+            cached = (self.ssh_privkey, key_class.from_private_key(io.StringIO(self.ssh_privkey)))
+            self._private_key = cached
+        return cached[1]
 
-    def exec(self, command, okay_to_fail=False):
+    def exec_batch(self, commands):
+        """Run a list of (command, okay_to_fail) tuples as one script over a single channel.
+        Return a list of (exit status, stdout, stderr) tuples, one per command which completed;
+        this is shorter than 'commands' if a command failed and was not okay_to_fail, or if the
+        connection was lost."""
+        marker = "__cg_" + secrets.token_hex(8)
+        with trace("batch of {} commands".format(len(commands)), "command", router=self):
+            __, out, err = self._run(batch_script(commands, marker))
+        results = split_batch_output(out, err, marker)
+        for (command, __), (exitc, out, err) in zip(commands, results):
+            print_msg(1, "Router cmd:    " + command)
+            for line in out.splitlines():
+                print_msg(1, "Router stdout: " + line.rstrip())
+            for line in err.splitlines():
+                print_msg(1, "Router stderr: " + line.rstrip())
+        return results
+
+    def exec_stream(self, command, stdin_data=None, timeout=None):
+        """Run a command on the router, optionally sending bytes to its stdin. Yield its output
+        as it arrives, as described in stream_channel(). The command is stopped if the caller
+        stops iterating or 'timeout' seconds pass."""
+        if isinstance(self.client, BrokerClient):
+            yield from self.client.run_stream(command, stdin_data, timeout)
+            return
+        channel = self.client.get_transport().open_session()
+        try:
+            channel.exec_command(command)
+            if stdin_data is not None:
+                channel.sendall(stdin_data)
+            channel.shutdown_write()  # commands reading stdin get EOF
+            yield from stream_channel(channel, timeout)
+        finally:
+            channel.close()
+
+    def _run(self, command, stdin_data=None, timeout=None):
+        """Run a command on the router, optionally sending bytes to its stdin. Return a tuple
+        (exit status, stdout, stderr). More than EXEC_MAX_OUTPUT of output is an error."""
+        output = {"stdout": list(), "stderr": list()}
+        size = 0
+        for stream, data in self.exec_stream(command, stdin_data, timeout):
+            if stream == "exit":
+                exitc = data
+            else:
+                size += len(data)
+                if size > EXEC_MAX_OUTPUT:
+                    raise RemoteExecutionError(too_much_output(command))
+                output[stream].append(data)
+        return exitc, "".join(output["stdout"]), "".join(output["stderr"])
+
+    def exec(self, command, okay_to_fail=False, timeout=None):
         print_msg(1, "Router cmd:    " + command)
-        __, stdout, stderr = self.client.exec_command(command)
-        exitc = stdout.channel.recv_exit_status()
-        out = ""
-        for line in stdout:
-            out += line
-            print_msg(1, "Router stdout: " + line.rstrip())
-        err0 = ""
-        err_count = 0
-        for line in stderr:
-            if err_count == 0:
-                err0 = line.rstrip()
-            err_count += 1
-            print_msg(1, "Router stderr: " + line.rstrip())
+        out = list()
+        size = 0
+        err0 = None
+        with trace(command, "command", router=self):
+            for stream, data in self.exec_stream(command, timeout=timeout):
+                if stream == "stdout":
+                    size += len(data)
+                    if size > EXEC_MAX_OUTPUT:
+                        raise RemoteExecutionError(too_much_output(command))
+                    out.append(data)
+                    print_msg(1, "Router stdout: " + data.rstrip())
+                elif stream == "stderr":
+                    if err0 is None:
+                        err0 = data.rstrip()
+                    print_msg(1, "Router stderr: " + data.rstrip())
+                else:
+                    exitc = data
+        err0 = err0 or ""
         if exitc != 0:
             if okay_to_fail:
                 return err0
             else:
                 raise RemoteExecutionError(err0)
-        return out
+        return "".join(out)
+
+    def open_shell(self):
+        """Start an interactive shell on the router, with a pseudo-terminal the size of ours;
+        return its Paramiko channel"""
+        size = os.get_terminal_size(sys.stdout.fileno())
+        channel = self.client.get_transport().open_session()
+        channel.get_pty(
+            term=os.environ.get("TERM", "vt100"), width=size.columns, height=size.lines
+        )
+        channel.invoke_shell()
+        return channel
 
     def put(self, data, remote_path):
+        with trace(remote_path, "transfer", router=self, bytes=len(data)):
+            self._put(data, remote_path)
+
+    def _put(self, data, remote_path):
+        if isinstance(self.client, BrokerClient):
+            self.client.put(data, remote_path)
+            return
         # SFTP would be nice, but OpenWrt only supports SCP
-        scp = SCPClient(self.client.get_transport())  # https://github.com/jbardin/scp.py
+        scp_client = scp.SCPClient(self.client.get_transport())  # github.com/jbardin/scp.py
         data_file = io.BytesIO()  # in-memory file-like object
         data_file.write(data)
         data_file.seek(0)
-        scp.putfo(data_file, remote_path)
-        scp.close()
+        scp_client.putfo(data_file, remote_path)
+        scp_client.close()
         data_file.close()
 
+    def put_bundle(self, files):
+        """Copy a list of (data, remote_path) tuples to the router as one compressed archive
+        over a single channel. Every file's checksum is verified before any file is replaced,
+        and each file is replaced via an atomic rename. Existing files keep their mode; new
+        files get mode 644, the same as with put()."""
+        archive = io.BytesIO()
+        script = "d=$(mktemp -d /tmp/cg.XXXXXX) || exit 1\n"
+        cleanup = 'rm -rf "$d" ' + " ".join(shlex.quote(p + ".cg-new") for __, p in files)
+        script += "trap {} EXIT\n".format(shlex.quote(cleanup))
+        script += 'tar -xzf - -C "$d" || exit 1\n'
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+            for n, (data, remote_path) in enumerate(files):
+                info = tarfile.TarInfo(str(n))
+                info.size = len(data)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(data))
+                checksum = sha256(data).hexdigest()
+                script += 'echo "{}  $d/{}" |sha256sum -c >/dev/null || exit 1\n'.format(
+                    checksum, n
+                )
+        for n, (__, remote_path) in enumerate(files):  # stage next to target so 'mv' is atomic
+            target = shlex.quote(remote_path)
+            staged = shlex.quote(remote_path + ".cg-new")
+            script += 'if [ -e {t} ] ; then cp -p {t} {s} && cat "$d/{n}" >{s} ; '.format(
+                t=target, s=staged, n=n
+            )
+            script += 'else cp "$d/{n}" {s} && chmod 644 {s} ; fi || exit 1\n'.format(
+                s=staged, n=n
+            )
+        for __, remote_path in files:
+            script += "mv {} {} || exit 1\n".format(
+                shlex.quote(remote_path + ".cg-new"), shlex.quote(remote_path)
+            )
+        print_msg(1, _("Copying {} files to router in one archive").format(len(files)))
+        name = "archive of {} files".format(len(files))
+        with trace(name, "transfer", router=self, bytes=len(archive.getvalue())):
+            exitc, __, err = self._run(script, stdin_data=archive.getvalue())
+        for line in err.splitlines():
+            print_msg(1, "Router stderr: " + line.rstrip())
+        if exitc != 0:
+            raise RemoteExecutionError(err.splitlines()[0].rstrip() if err else "")
+
+    def reboot(self, command, deadline=REBOOT_DEADLINE):
+        """Run 'command', which reboots the router, then drop the connection and reconnect as
+        soon as the router's ssh server is back. Probes are quick at first and back off; raise
+        CGError if the router is not back within 'deadline' seconds, or RemoteExecutionError if
+        'command' fails."""
+        give_up = time.monotonic() + deadline
+        if isinstance(self.client, BrokerClient):
+            self.close()  # the broker's connection would go stale; use one of our own
+        self.connect_ssh(use_broker=False)
+        print_msg(1, "Router cmd:    " + command)
+        old_boot_id = None
+        exitc = None  # unless the connection is lost before the command exits
+        err0 = ""
+        script = "cat {} 2>/dev/null\n{}".format(BOOT_ID_PATH, command)
+        try:
+            for stream, data in self.exec_stream(script, timeout=give_up - time.monotonic()):
+                if stream == "stdout" and old_boot_id is None:
+                    old_boot_id = data.strip()
+                elif stream == "stderr" and err0 == "":
+                    err0 = data.rstrip()
+                elif stream == "exit":
+                    exitc = data
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+            pass  # the connection was lost as the router went down
+        except RemoteExecutionError:
+            pass  # timed out; the deadline has passed, which the loop below reports
+        self.close()
+        if exitc is not None and exitc != 0:
+            raise RemoteExecutionError(err0 or _("Exit status {}").format(exitc))
+        interval = REBOOT_PROBE_MIN
+        with trace("wait_for_reboot", "phase", router=self):
+            while True:
+                if self._probe_ssh(give_up):
+                    try:  # until the router has gone down, this reaches the old system
+                        # A changed host key was reported by _probe_ssh(); CGError here means
+                        # login failed, e.g. as the old system went down during authentication
+                        self.connect_ssh(use_broker=False)
+                        timeout = min(PROBE_TIMEOUT, max(give_up - time.monotonic(), 0.01))
+                        __, boot_id, __ = self._run("cat " + BOOT_ID_PATH, timeout=timeout)
+                        if not old_boot_id or boot_id.strip() != old_boot_id:
+                            return
+                    except (
+                        paramiko.ssh_exception.SSHException,
+                        EOFError,
+                        OSError,
+                        CGError,
+                        RemoteExecutionError,
+                    ):
+                        pass
+                    self.close()
+                remaining = give_up - time.monotonic()
+                if remaining <= 0:
+                    raise CGError(
+                        _("{} did not come back within {} seconds of rebooting.").format(
+                            self.nickname, deadline
+                        )
+                    )
+                time.sleep(min(interval, remaining))
+                interval = min(interval * REBOOT_PROBE_BACKOFF, REBOOT_PROBE_MAX)
+
+    def _probe_ssh(self, give_up):
+        """Return True if the router accepts a TCP connection on its ssh port and then presents
+        the stored host key, without waiting past 'give_up' (a time.monotonic() value). Raise
+        CGError if a different host key is presented."""
+        remaining = max(give_up - time.monotonic(), 0.01)
+        try:  # a quick check first; while the router is down, this fails or times out
+            socket.create_connection(
+                (str(self.ip), self.ssh_port), timeout=min(SWEEP_TIMEOUT, remaining)
+            ).close()
+        except OSError:
+            return False
+        remaining = max(give_up - time.monotonic(), 0.01)
+        hostkey = ssh_keyscan(str(self.ip), self.ssh_port, timeout=min(PROBE_TIMEOUT, remaining))
+        if hostkey is None:  # e.g. dropbear is not yet accepting connections
+            return False
+        if not self.hostkey_matches(hostkey):
+            ConfigSaver.forget_hostkey(self.ip)
+            raise CGError(
+                _("The host key of {} at {} has changed.").format(self.nickname, self.ip)
+            )
+        return True
+
+    def set_hostkey(self, hostkey):
+        """Set 'ssh_hostkey'; use this rather than assigning it, so Config.router_by_hostkey()
+        reindexes"""
+        self.ssh_hostkey = hostkey
+        Router.hostkey_changes += 1
+
+    def hostkey_matches(self, hostkey):
+        """Return True if 'hostkey' (e.g. from ssh_keyscan()) is this router's stored host key;
+        line breaks, as added by add_line_breaks(), are ignored"""
+        stored = getattr(self, "ssh_hostkey", None)
+        return stored is not None and "".join(hostkey.split()) == "".join(stored.split())
+
     def close(self):
         if self.client:
             print_msg(1, _("Closing client connection"))
@@ -506,8 +1808,72 @@ class Config(yaml.YAMLObject):
         self.default_vpn_password = input(_("Enter the PIA password to use on routers: "))
         self.default_vpn_server_host = input(_("Enter the PIA region to use on routers: "))
 
+    def router_by_hostkey(self, hostkey):
+        """Return the router with the given host key, or None. Routers are indexed by host key
+        fingerprint; routers appended to 'routers' since the last call are added to the index,
+        and it is rebuilt if any router's host key has been set or forgotten since."""
+        if getattr(self, "_indexed_changes", None) != Router.hostkey_changes:
+            self._by_fingerprint = dict()
+            self._indexed = 0
+            self._indexed_changes = Router.hostkey_changes
+        for r in self.routers[self._indexed :]:
+            if getattr(r, "ssh_hostkey", None) is not None:
+                self._by_fingerprint.setdefault(hostkey_fingerprint(r.ssh_hostkey), r)
+        self._indexed = len(self.routers)
+        return self._by_fingerprint.get(hostkey_fingerprint(hostkey))
+
 
 class ConfigSaver:
+    """
+    Configuration store: an SQLite database with a row for each router, indexed by host key,
+    MAC and IP, and a row for each router field. Saving writes only the fields which changed
+    since they were loaded or last saved, so several processes (e.g. fleet runs on different
+    networks) can share the database without overwriting each other's changes; the maps of
+    coteries applied are merged entry by entry with the database's. WAL mode lets readers
+    continue while another process is writing.
+
+    The old YAML configuration file is imported the first time the database is used, and can
+    be exported and imported again for hand-editing.
+
+    Progress between saves (coteries applied, secrets generated) is appended to a journal,
+    one per process, which is flushed to disk after each record. After a save, the journal is
+    emptied. The journals of processes which were killed are replayed by the next load().
+    """
+
+    lock = threading.RLock()  # serializes saves and changes to Config.routers between threads
+    schema = """
+        CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS routers (
+            id INTEGER PRIMARY KEY,
+            ssh_hostkey TEXT,
+            mac TEXT,
+            ip TEXT
+        );
+        CREATE INDEX IF NOT EXISTS routers_ssh_hostkey ON routers (ssh_hostkey);
+        CREATE INDEX IF NOT EXISTS routers_mac ON routers (mac);
+        CREATE INDEX IF NOT EXISTS routers_ip ON routers (ip);
+        CREATE TABLE IF NOT EXISTS router_fields (
+            router_id INTEGER NOT NULL REFERENCES routers (id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (router_id, name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS keyscan_cache (
+            ip TEXT NOT NULL,
+            mac TEXT NOT NULL,
+            hostkey TEXT NOT NULL,
+            time REAL NOT NULL,
+            PRIMARY KEY (ip, mac)
+        ) WITHOUT ROWID;
+        PRAGMA user_version = 2;
+    """
+    schema_version = 2
+    indexed_fields = ("ssh_hostkey", "mac", "ip")
+    merged_fields = ("version_map", "content_map")  # maps updated by entry, not as a whole
+    _db = None
+    _journal = None  # file object of this process's journal, locked while we run
+    _journaling = False  # only for routers of a configuration from load()
+
     @staticmethod
     def long_str_representer(dumper, data):  # https://stackoverflow.com/a/33300001/10590519
         if len(data.splitlines()) > 1:  # check for multiline string
@@ -522,26 +1888,407 @@ class ConfigSaver:
     def _conf_path():
         return os.path.join(ConfigSaver.conf_dir(), "cleapher.conf")
 
+    @staticmethod
+    def _db_path():
+        return os.path.join(ConfigSaver.conf_dir(), "cleapher.db")
+
+    @staticmethod
+    def _journal_path(pid):
+        return os.path.join(ConfigSaver.conf_dir(), "journal-{}.jsonl".format(pid))
+
+    @staticmethod
+    def connect():
+        """Return the database connection, shared by all threads (use ConfigSaver.lock)"""
+        if ConfigSaver._db is None:
+            db_path = ConfigSaver._db_path()
+            try:
+                os.makedirs(ConfigSaver.conf_dir(), mode=0o700, exist_ok=True)
+                # Restrict file permissions to protect passwords, keys from other users; SQLite
+                # gives the -wal and -shm files the same permissions.
+                os.close(os.open(db_path, os.O_WRONLY | os.O_CREAT, 0o600))
+                db = sqlite3.connect(
+                    db_path, timeout=30, isolation_level=None, check_same_thread=False
+                )
+                db.execute("PRAGMA journal_mode = WAL")
+                db.execute("PRAGMA synchronous = NORMAL")  # safe in WAL mode
+                db.execute("PRAGMA foreign_keys = ON")
+                if db.execute("PRAGMA user_version").fetchone()[0] < ConfigSaver.schema_version:
+                    db.executescript(ConfigSaver.schema)  # only creates what is missing
+            except (OSError, sqlite3.Error) as err:
+                raise CGError(_("Error opening configuration {}: {}").format(db_path, err))
+            ConfigSaver._db = db
+        return ConfigSaver._db
+
+    @staticmethod
+    def _fields(obj):
+        """Return the fields of a Router or Config to be saved, each encoded as JSON"""
+        state = dict(obj.__dict__)  # dict() copies are atomic, so other threads can continue
+        return {
+            k: json.dumps(dict(v) if isinstance(v, dict) else v, default=str)
+            for k, v in state.items()
+            if not k.startswith("_") and k not in ("client", "routers")  # not saved
+        }
+
+    @staticmethod
+    def _router_from_fields(row_id, fields):
+        router = Router.__new__(Router)
+        router.__dict__.update({k: json.loads(v) for k, v in fields.items()})
+        router.client = None
+        if not hasattr(router, "content_map"):  # configuration from an older version
+            router.content_map = dict()
+        router._row = row_id
+        router._saved = fields
+        return router
+
+    @staticmethod
+    def _load_router(db, row_id):
+        rows = db.execute("SELECT name, value FROM router_fields WHERE router_id = ?", (row_id,))
+        return ConfigSaver._router_from_fields(row_id, dict(rows.fetchall()))
+
     @staticmethod
     def load() -> Config:
-        config = Config()
-        conf_path = ConfigSaver._conf_path()
+        with ConfigSaver.lock:
+            db = ConfigSaver.connect()
+            empty = db.execute("SELECT count(*) FROM settings").fetchone()[0] == 0
+            if empty and os.path.exists(ConfigSaver._conf_path()):  # from an older version
+                print_msg(1, _("Importing {}").format(ConfigSaver._conf_path()))
+                ConfigSaver.import_yaml(ConfigSaver._conf_path())
+            config = Config()
+            try:
+                db.execute("BEGIN")  # read a consistent snapshot
+                settings = dict(db.execute("SELECT name, value FROM settings").fetchall())
+                fields = dict()
+                for row_id, name, value in db.execute(
+                    "SELECT router_id, name, value FROM router_fields ORDER BY router_id"
+                ):
+                    fields.setdefault(row_id, dict())[name] = value
+                db.execute("COMMIT")
+            except sqlite3.Error as err:
+                raise CGError(
+                    _("Error reading configuration {}: {}").format(ConfigSaver._db_path(), err)
+                )
+        config.__dict__.update({k: json.loads(v) for k, v in settings.items()})
+        config._saved = settings
+        if len(settings) == 0 and len(fields) == 0:  # new configuration - start fresh
+            config.set_defaults()
+        else:
+            config.routers = [ConfigSaver._router_from_fields(i, f) for i, f in fields.items()]
+        ConfigSaver._replay(config)
+        ConfigSaver._journaling = True
+        return config
+
+    @staticmethod
+    def journal(router, event):
+        """Append the router's fields which changed since they were last saved or journaled
+        to this process's journal, and flush it to disk. 'event' describes what was done."""
+        if not ConfigSaver._journaling:
+            return
+        with ConfigSaver.lock:
+            fields = ConfigSaver._fields(router)
+            logged = getattr(router, "_journaled", getattr(router, "_saved", dict()))
+            changed = {k: v for k, v in fields.items() if logged.get(k) != v}
+            if len(changed) == 0:
+                return
+            record = {
+                "event": event,
+                "time": time.time(),
+                "ssh_hostkey": getattr(router, "ssh_hostkey", None),
+                "mac": getattr(router, "mac", None),
+                "fields": changed,
+            }
+            try:
+                if ConfigSaver._journal is None:
+                    path = ConfigSaver._journal_path(os.getpid())
+                    journal = open(
+                        os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "w"
+                    )
+                    fcntl.flock(journal, fcntl.LOCK_EX)  # tells load() that we are running
+                    ConfigSaver._journal = journal
+                    atexit.register(ConfigSaver._close_journal)
+                ConfigSaver._journal.write(json.dumps(record) + "\n")
+                ConfigSaver._journal.flush()
+                os.fsync(ConfigSaver._journal.fileno())
+            except OSError as err:
+                print_msg(1, _("Unable to write journal: {}").format(err))
+                return
+            router._journaled = fields
+
+    @staticmethod
+    def _close_journal():
+        """Remove this process's journal if everything in it has been saved"""
+        with ConfigSaver.lock:
+            journal = ConfigSaver._journal
+            if os.fstat(journal.fileno()).st_size == 0:
+                os.unlink(ConfigSaver._journal_path(os.getpid()))
+            journal.close()
+            ConfigSaver._journal = None
+
+    @staticmethod
+    def _replay(config):
+        """Apply to config the journals of processes which did not exit cleanly, save the
+        result, and remove those journals"""
+        for name in os.listdir(ConfigSaver.conf_dir()):
+            match = re.fullmatch(r"journal-(\d+)\.jsonl", name)
+            if match is None:
+                continue
+            path = os.path.join(ConfigSaver.conf_dir(), name)
+            try:
+                journal = open(path, "r")
+            except FileNotFoundError:  # replayed by another process
+                continue
+            with journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # its process is still running
+                try:
+                    if os.stat(path).st_ino != os.fstat(journal.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:  # replayed by another process meanwhile
+                    continue
+                count = 0
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # cut short by a crash
+                        break
+                    router = None
+                    if record["ssh_hostkey"] is not None:
+                        router = ConfigSaver.find_router(
+                            config, "ssh_hostkey", record["ssh_hostkey"]
+                        )
+                    if router is None and record["mac"] is not None:
+                        router = ConfigSaver.find_router(config, "mac", record["mac"])
+                    if router is None:
+                        router = Router.__new__(Router)
+                        router.client = None
+                        router.content_map = dict()
+                        config.routers.append(router)
+                    router.__dict__.update({k: json.loads(v) for k, v in record["fields"].items()})
+                    count += 1
+                if count > 0:
+                    print_msg(1, _("Resuming {} steps of an interrupted run").format(count))
+                    ConfigSaver.save(config)
+                os.unlink(path)
+
+    @staticmethod
+    def find_router(config, field, value):
+        """Return the router with the given 'ssh_hostkey', 'mac' or 'ip', or None. A router
+        saved by another process since config was loaded is loaded and added to config."""
+        assert field in ConfigSaver.indexed_fields
+        with ConfigSaver.lock:
+            if field == "ssh_hostkey":
+                found = config.router_by_hostkey(value)
+                if found is not None:
+                    return found
+            else:
+                for r in config.routers:  # routers not yet saved
+                    if not hasattr(r, "_row") and getattr(r, field, None) == value:
+                        return r
+            db = ConfigSaver.connect()
+            row = db.execute(
+                "SELECT id FROM routers WHERE {} = ? ORDER BY id".format(field), (value,)
+            ).fetchone()
+            if row is None:
+                return None
+            found = next((r for r in config.routers if getattr(r, "_row", None) == row[0]), None)
+            if found is None:
+                found = ConfigSaver._load_router(db, row[0])
+                config.routers.append(found)
+            return found
+
+    @staticmethod
+    def cached_hostkey(ip, mac, ttl=KEYSCAN_TTL):
+        """Return the host key found at (ip, mac) within the last 'ttl' seconds, or None"""
+        with ConfigSaver.lock:
+            row = (
+                ConfigSaver.connect()
+                .execute(
+                    "SELECT hostkey FROM keyscan_cache WHERE ip = ? AND mac = ? AND time > ?",
+                    (str(ip), mac, time.time() - ttl),
+                )
+                .fetchone()
+            )
+        return None if row is None else row[0]
+
+    @staticmethod
+    def cache_hostkey(ip, mac, hostkey):
+        with ConfigSaver.lock:
+            ConfigSaver.connect().execute(
+                "INSERT OR REPLACE INTO keyscan_cache VALUES (?, ?, ?, ?)",
+                (str(ip), mac, hostkey, time.time()),
+            )
+
+    @staticmethod
+    def forget_hostkey(ip):
+        """Remove cached host keys for ip, e.g. because the router's host key has changed"""
+        Router.hostkey_changes += 1
+        with ConfigSaver.lock:
+            ConfigSaver.connect().execute("DELETE FROM keyscan_cache WHERE ip = ?", (str(ip),))
+
+    @staticmethod
+    def save(config: Config) -> None:
+        """Write the fields which have changed to the database, in a single transaction"""
+        with ConfigSaver.lock, trace("save_config", "phase"):
+            db = ConfigSaver.connect()
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    done = ConfigSaver._write(db, config)
+                    db.execute("COMMIT")
+                except:  # noqa: E722
+                    db.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as err:
+                raise CGError(
+                    _("Error saving configuration {}: {}").format(ConfigSaver._db_path(), err)
+                )
+            for obj, row_id, fields in done:  # only once committed
+                if row_id is not None:
+                    obj._row = row_id
+                obj._saved = fields
+                obj._journaled = fields
+            if ConfigSaver._journal is not None:
+                try:
+                    ConfigSaver._journal.truncate(0)  # everything in it is saved
+                    ConfigSaver._journal.seek(0)
+                except OSError as err:
+                    print_msg(1, _("Unable to empty journal: {}").format(err))
+
+    @staticmethod
+    def _write(db, config):
+        """Write changed fields within a transaction; return a list of (object, row id, fields)
+        to record once the transaction is committed"""
+        done = list()
+        fields = ConfigSaver._fields(config)
+        saved = getattr(config, "_saved", dict())
+        for name, value in fields.items():
+            if saved.get(name) != value:
+                db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (name, value))
+        done.append((config, None, fields))
+        for r in list(config.routers):
+            fields = ConfigSaver._fields(r)
+            saved = getattr(r, "_saved", dict())
+            row_id = getattr(r, "_row", None)
+            indexed = [json.loads(fields.get(f, "null")) for f in ConfigSaver.indexed_fields]
+            if row_id is None and indexed[0] is not None:  # maybe added by another process
+                row = db.execute(
+                    "SELECT id FROM routers WHERE ssh_hostkey = ?", (indexed[0],)
+                ).fetchone()
+                if row is not None:
+                    row_id = row[0]
+                    # Write only what differs from that row; maps are merged with it below
+                    saved = dict(
+                        db.execute(
+                            "SELECT name, value FROM router_fields WHERE router_id = ?",
+                            (row_id,),
+                        ).fetchall()
+                    )
+                    for name in ConfigSaver.merged_fields:
+                        saved.pop(name, None)
+            if row_id is None:
+                row_id = db.execute(
+                    "INSERT INTO routers (ssh_hostkey, mac, ip) VALUES (?, ?, ?)", indexed
+                ).lastrowid
+            elif any(saved.get(f) != fields.get(f) for f in ConfigSaver.indexed_fields):
+                db.execute(
+                    "UPDATE routers SET ssh_hostkey = ?, mac = ?, ip = ? WHERE id = ?",
+                    indexed + [row_id],
+                )
+            for name, value in fields.items():
+                if saved.get(name) == value:
+                    continue
+                if name in ConfigSaver.merged_fields:
+                    value = ConfigSaver._merge(db, row_id, name, saved.get(name), value)
+                    if value is None:
+                        continue
+                db.execute(
+                    "INSERT OR REPLACE INTO router_fields VALUES (?, ?, ?)",
+                    (row_id, name, value),
+                )
+            done.append((r, row_id, fields))
+        return done
+
+    @staticmethod
+    def _merge(db, row_id, name, saved, value):
+        """Apply the entries of the map field 'name' which changed from 'saved' to 'value' to
+        the map in the database, which another process may have changed meanwhile; return the
+        result encoded as JSON, or None if the database already has it"""
+        row = db.execute(
+            "SELECT value FROM router_fields WHERE router_id = ? AND name = ?", (row_id, name)
+        ).fetchone()
+        if row is None:
+            return value
+        old, new, merged = json.loads(saved or "{}"), json.loads(value), json.loads(row[0])
+        for k in old.keys() - new.keys():
+            merged.pop(k, None)
+        merged.update({k: v for k, v in new.items() if old.get(k) != v})
+        merged = json.dumps(merged, default=str)
+        return None if merged == row[0] else merged
+
+    @staticmethod
+    def import_yaml(path) -> None:
+        """Replace the contents of the database with the given YAML configuration file"""
         try:
-            with open(conf_path, "r") as conf_file:
+            with open(path, "r") as conf_file:
                 try:
                     config = yaml.safe_load(conf_file.read())
                 except yaml.YAMLError as yaml_err:
-                    raise CGError(_("Error parsing {}: {}").format(conf_path, yaml_err))
-        except FileNotFoundError:  # missing config file
-            pass
-        if config.routers is None:  # missing or empty config file - start fresh
-            config.set_defaults()
+                    raise CGError(_("Error parsing {}: {}").format(path, yaml_err))
+        except OSError as err:
+            raise CGError(_("Error reading configuration {}: {}").format(path, err))
+        if not isinstance(config, Config) or config.routers is None:
+            raise CGError(_("No configuration found in {}").format(path))
         for r in config.routers:
             r.client = None
-        return config
+        with ConfigSaver.lock:
+            db = ConfigSaver.connect()
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    db.execute("DELETE FROM settings")
+                    db.execute("DELETE FROM routers")  # and router_fields via ON DELETE CASCADE
+                    ConfigSaver._write(db, config)
+                    db.execute("COMMIT")
+                except:  # noqa: E722
+                    db.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as err:
+                raise CGError(
+                    _("Error saving configuration {}: {}").format(ConfigSaver._db_path(), err)
+                )
 
     @staticmethod
-    def save(config: Config) -> None:
+    def _snapshot(config: Config) -> Config:
+        """Return a copy of config which other threads cannot change while it is being saved"""
+        snapshot = Config()
+        snapshot.__dict__.update(
+            {k: v for k, v in config.__dict__.items() if not k.startswith("_")}
+        )
+        snapshot.routers = list()
+        for r in list(config.routers):
+            router = Router.__new__(Router)
+            # dict() copies are atomic, so fleet workers can keep updating the originals.
+            state = dict(r.__dict__)
+            router.__dict__.update(
+                {
+                    k: dict(v) if isinstance(v, dict) else v
+                    for k, v in state.items()
+                    if not k.startswith("_")  # derived secrets, database bookkeeping
+                }
+            )
+            router.client = None  # never save a live connection
+            snapshot.routers.append(router)
+        return snapshot
+
+    @staticmethod
+    def export_yaml(config: Config) -> None:
+        """Write the configuration to the YAML file, for hand-editing"""
+        with ConfigSaver.lock:
+            ConfigSaver._export_yaml(ConfigSaver._snapshot(config))
+
+    @staticmethod
+    def _export_yaml(config: Config) -> None:
         conf_path = ConfigSaver._conf_path()
         try:
             os.mkdir(ConfigSaver.conf_dir())
@@ -580,6 +2327,558 @@ class ConfigSaver:
             raise CGError(_("Error saving configuration {}: {}").format(conf_path, err))
 
 
+class SessionBroker:
+    """
+    A local process which keeps authenticated ssh connections to routers open between runs of
+    this program, so that back-to-back commands skip the connection set-up. Other runs attach
+    via a Unix socket in the configuration directory and send one JSON object per line:
+
+        {"op": "connect", "router": {...}}  -> {"ok": true, "method": "ssh key"}
+        {"op": "exec", "command": "...", "stdin": "<base64, optional>", "timeout": null}
+                                            -> {"ok": true, "stdout": "line\n"}
+                                               {"ok": true, "stderr": "line\n"} ...
+                                               {"ok": true, "exit": 0}
+        {"op": "put", "path": "...", "data": "<base64>"}  -> {"ok": true}
+
+    Errors are returned as {"ok": false, "error": "..."}, with "remote": true if the error is
+    from the router (e.g. a command timed out). Connections are keyed by the router's
+    host key, checked for liveness before reuse, closed after 'idle_timeout' seconds of
+    non-use, and limited to 'max_connections' (least recently used is closed first). A
+    connection is never closed while a request is using it; a client whose connection was
+    closed between requests is connected again.
+    """
+
+    router_fields = (
+        "ip",
+        "ssh_port",
+        "nickname",
+        "ssh_hostkey",
+        "ssh_pubkey",
+        "ssh_privkey",
+        "router_password",
+        "auth_method",
+    )
+    liveness_after = 10  # seconds idle after which a connection is checked before reuse
+    liveness_timeout = 5  # seconds to wait for the router to answer a liveness check
+
+    def __init__(self, idle_timeout=600, max_connections=16):
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.sessions = dict()  # host key: [Router, time last used, lock, requests running]
+        self.lock = threading.Lock()  # guards self.sessions
+
+    @staticmethod
+    def socket_path():
+        return os.path.join(ConfigSaver.conf_dir(), "broker.sock")
+
+    def _is_alive(self, router):
+        transport = router.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:  # opening a channel is a full round trip but much cheaper than a new connection
+            transport.open_session(timeout=self.liveness_timeout).close()
+        except (paramiko.ssh_exception.SSHException, OSError):
+            return False
+        return True
+
+    def _close_session(self, hostkey):
+        """Close a connection; the caller holds self.lock"""
+        router, __, session_lock, __ = self.sessions.pop(hostkey)
+        with session_lock:  # e.g. wait for a reconnection by session() to finish
+            router.close()
+
+    def session(self, fields):
+        """Return a connected Router matching the given fields, reusing a cached connection
+        if possible, and a string describing how it was connected. The connection is kept
+        open until release() is called."""
+        hostkey = fields["ssh_hostkey"]
+        with self.lock:
+            if hostkey not in self.sessions:
+                idle = [k for k in self.sessions if self.sessions[k][3] == 0]
+                while len(self.sessions) >= self.max_connections and len(idle) > 0:
+                    lru = min(idle, key=lambda k: self.sessions[k][1])
+                    print_msg(1, _("Closing least recently used connection"))
+                    self._close_session(lru)
+                    idle.remove(lru)
+                router = Router.__new__(Router)
+                router.client = None
+                self.sessions[hostkey] = [router, time.time(), threading.Lock(), 0]
+            entry = self.sessions[hostkey]
+            idle = time.time() - entry[1]
+            entry[1] = time.time()
+            entry[3] += 1
+        router, __, session_lock, __ = entry
+        try:
+            with session_lock:
+                if router.client is not None:
+                    if router.ip == fields["ip"] and (
+                        idle < self.liveness_after or self._is_alive(router)
+                    ):
+                        return router, router.last_connect.split(" ", 1)[1] + ", cached"
+                    router.close()  # stale connection or router has a new IP
+                router.__dict__.update(fields)
+                router.connect_ssh(use_broker=False)
+                return router, router.last_connect.split(" ", 1)[1]
+        except:  # noqa: E722
+            self.release(hostkey)
+            raise
+
+    def release(self, hostkey):
+        """Allow the connection returned by session() to be closed again"""
+        with self.lock:
+            entry = self.sessions.get(hostkey)
+            if entry is not None:
+                entry[1] = time.time()
+                entry[3] -= 1
+
+    def evict_idle(self):
+        """Close connections which have not been used for 'idle_timeout' seconds"""
+        with self.lock:
+            for hostkey in list(self.sessions):
+                entry = self.sessions[hostkey]
+                if entry[3] == 0 and time.time() - entry[1] > self.idle_timeout:
+                    print_msg(1, _("Closing idle connection"))
+                    self._close_session(hostkey)
+
+    def handle(self, rfile, wfile):
+        """Answer requests from one attached client until it disconnects"""
+        fields = None  # of the router the client connected to
+        for line in rfile:
+            try:
+                request = json.loads(line.decode())
+                if request["op"] == "connect":
+                    fields = request["router"]
+                elif fields is None:
+                    raise CGError(_("Not connected to a router"))
+                # Looked up for each request, as the connection may have been closed since
+                router, method = self.session(fields)
+                try:
+                    reply = self._answer(request, router, method, wfile)
+                finally:
+                    self.release(fields["ssh_hostkey"])
+            except (CGError, KeyError, ValueError, OSError) as err:
+                reply = {"ok": False, "error": str(err)}
+            except RemoteExecutionError as err:  # e.g. a command timed out
+                reply = {"ok": False, "error": str(err), "remote": True}
+            except (paramiko.ssh_exception.SSHException, EOFError) as err:
+                reply = {"ok": False, "error": _("Lost connection to router: {}").format(err)}
+            wfile.write((json.dumps(reply) + "\n").encode())
+            wfile.flush()
+
+    def _answer(self, request, router, method, wfile):
+        """Carry out one request on router; return the final reply"""
+        if request["op"] == "connect":
+            reply = {"method": method}
+        elif request["op"] == "exec":
+            stdin_data = request.get("stdin")
+            if stdin_data is not None:
+                stdin_data = base64.b64decode(stdin_data)
+            command, timeout = request["command"], request.get("timeout")
+            for stream, data in router.exec_stream(command, stdin_data, timeout):
+                if stream == "exit":
+                    reply = {"exit": data}
+                    break
+                wfile.write((json.dumps({stream: data, "ok": True}) + "\n").encode())
+                wfile.flush()
+        elif request["op"] == "put":
+            router.put(base64.b64decode(request["data"]), request["path"])
+            reply = dict()
+        else:
+            raise CGError(_("Unknown broker request {}").format(request["op"]))
+        reply["ok"] = True
+        return reply
+
+    def serve(self):
+        """Run the broker until interrupted"""
+        server = self.start()
+        print_msg(1, _("Connection broker listening on {}").format(server.server_address))
+        try:
+            while True:
+                time.sleep(5)
+                self.evict_idle()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop(server)
+
+    def start(self):
+        """Listen on the broker's socket in a background thread; return the server"""
+        path = SessionBroker.socket_path()
+        os.makedirs(ConfigSaver.conf_dir(), mode=0o700, exist_ok=True)
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)  # left over from a broker which did not exit cleanly
+            else:
+                raise CGError(_("A connection broker is already running on {}").format(path))
+            finally:
+                probe.close()
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                broker.handle(self.rfile, self.wfile)
+
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        os.chmod(path, 0o600)  # only our user may use our routers' credentials
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def stop(self, server):
+        """Stop listening and close all sessions"""
+        server.shutdown()
+        server.server_close()
+        os.unlink(server.server_address)
+        with self.lock:
+            for hostkey in list(self.sessions):
+                self._close_session(hostkey)
+
+
+class BrokerClient:
+    """Stands in for the Paramiko client in Router when a SessionBroker is running. Replies
+    carry no request id, so one request and all its replies are exchanged at a time."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile("rwb")
+        self.lock = threading.Lock()  # held for each whole exchange
+
+    @staticmethod
+    def attach(router):
+        """Connect to router via the broker; return a tuple (BrokerClient, connect method),
+        or None if no broker is running"""
+        path = SessionBroker.socket_path()
+        if not os.path.exists(path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:  # stale socket file
+            sock.close()
+            return None
+        client = BrokerClient(sock)
+        fields = {k: getattr(router, k, None) for k in SessionBroker.router_fields}
+        try:
+            reply = client.request({"op": "connect", "router": fields})
+        except CGError:
+            client.close()
+            raise
+        return client, reply["method"]
+
+    def request(self, message):
+        try:
+            self.file.write((json.dumps(message) + "\n").encode())
+            self.file.flush()
+        except OSError as err:
+            raise CGError(_("Lost connection to connection broker: {}").format(err))
+        return self.reply()
+
+    def reply(self):
+        """Read the next reply from the broker"""
+        try:
+            line = self.file.readline()
+        except OSError as err:
+            raise CGError(_("Lost connection to connection broker: {}").format(err))
+        if not line:
+            raise CGError(_("Connection broker closed the connection"))
+        reply = json.loads(line.decode())
+        if not reply["ok"]:
+            if reply.get("remote"):
+                raise RemoteExecutionError(reply["error"])
+            raise CGError(reply["error"])
+        return reply
+
+    def run_stream(self, command, stdin_data=None, timeout=None):
+        """Run a command via the broker; yield its output as in stream_channel()"""
+        request = {"op": "exec", "command": command, "timeout": timeout}
+        if stdin_data is not None:
+            request["stdin"] = base64.b64encode(stdin_data).decode()
+        with self.lock:
+            reply = self.request(request)
+            try:
+                while "exit" not in reply:
+                    stream = "stdout" if "stdout" in reply else "stderr"
+                    yield stream, reply[stream]
+                    reply = self.reply()
+            except GeneratorExit:  # caller stopped early; skip to the end of the replies
+                while "exit" not in reply:
+                    reply = self.reply()
+                raise
+        yield "exit", reply["exit"]
+
+    def put(self, data, remote_path):
+        request = {"op": "put", "path": remote_path, "data": base64.b64encode(data).decode()}
+        with self.lock:
+            self.request(request)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class PackageCache:
+    """
+    A cache on this computer of the opkg package lists and packages which routers download,
+    so that setting up many routers fetches each file from the internet only once. Files are
+    kept in 'opkg-cache' in the configuration directory (or 'directory', if set) under the
+    router's OpenWrt release (from /etc/openwrt_release) and architecture (from opkg), then the
+    feed URL:
+
+        opkg-cache/19.07.7/mips_24kc/http/downloads.openwrt.org/releases/.../Packages.gz
+
+    Routers reach the cache, a local HTTP server, via an ssh reverse tunnel to a port on the
+    router's loopback interface. Package lists are downloaded again after PACKAGE_LIST_TTL
+    seconds; when the cache is larger than 'max_bytes', the least recently used files are
+    removed.
+    """
+
+    max_bytes = PACKAGE_CACHE_MB * 2**20
+    directory = None  # instead of the configuration directory's, e.g. for benchmark-provision
+    part_re = re.compile(r"[A-Za-z0-9][A-Za-z0-9._~+:-]*$")  # a release, host, or path item
+    package_re = re.compile(r"[a-z0-9][a-z0-9._+-]*$")
+    condition_re = re.compile(r"release (<|>=) ([0-9]+)$")
+    feed_re = re.compile(r"^src/gz +[^ ]+ +https?://([^/\s]+)", re.MULTILINE)
+    _server = None
+    _lock = threading.Lock()
+    _feed_hosts = dict()  # (ip, port) of each tunnelled connection: hosts it may fetch from
+
+    @staticmethod
+    def cache_dir():
+        if PackageCache.directory is not None:
+            return PackageCache.directory
+        return os.path.join(ConfigSaver.conf_dir(), "opkg-cache")
+
+    @staticmethod
+    def parse(data):
+        """Return the packages in the data of a 'packages' coterie as a list of (package,
+        condition) tuples, where condition is None or a tuple ("<" or ">=", release). Raise
+        ValueError, with the item which is not valid, for invalid data."""
+        packages = list()
+        for line in data.splitlines():
+            names, __, condition = line.partition(" if ")
+            if condition != "":
+                match = PackageCache.condition_re.match(condition.strip())
+                if match is None:
+                    raise ValueError(condition.strip())
+                condition = (match[1], int(match[2]))
+            for p in names.split():
+                if not PackageCache.package_re.match(p):
+                    raise ValueError(p)
+                packages.append((p, condition or None))
+        return packages
+
+    @staticmethod
+    def install_script(packages, port=None):
+        """Return a script which installs 'packages', a list of (package, condition) tuples
+        from parse(), with one opkg command, downloading via the cache if 'port' (the router
+        end of the tunnel from open_tunnel()) is given. If the cache cannot be used, the
+        packages are installed directly."""
+        unconditional = " ".join(p for p, condition in packages if condition is None)
+        choose = ["pkgs={}".format(shlex.quote(unconditional))]
+        if any(condition is not None for __, condition in packages):
+            # The major release, as in the coteries which used to check it themselves. Since
+            # OpenWrt 18.06 the file holds the revision instead, which counts as the newest.
+            choose.append("release=$(grep -o '^[0-9]*' /etc/openwrt_version)")
+        for p, condition in packages:
+            if condition is not None:
+                test = '[ "$release" -lt {} ]'.format(condition[1])
+                if condition[0] == ">=":
+                    test = "! " + test
+                choose.append('if {} ; then pkgs="$pkgs {}" ; fi'.format(test, p))
+        choose = "\n".join(choose) + "\n"
+        # Coteries used to install each package by a separate command, which is more reliable;
+        # fall back to that if installing them together fails
+        install = (
+            "opkg install $pkgs || { rc=0 ; for p in $pkgs ; do opkg install $p || rc=$? ; done ;"
+            + " (exit $rc) ; }"
+        )
+        if port is None:
+            return (
+                choose
+                + "if ! ( [ -f /tmp/opkg-lists/packages ] || [ -f /tmp/opkg-lists/*_packages ] )"
+                + " ; then opkg update; fi\n"
+                + install
+                + "\n"
+            )
+        # opkg runs with a copy of its configuration in which the feeds point at the cache,
+        # so the router's own is never changed. OPKG_CONF_DIR, an empty directory, stops it
+        # also reading the original feeds from /etc/opkg/*.conf. /etc/openwrt_release has no
+        # DISTRIB_ARCH before OpenWrt 17.01, so the architecture comes from opkg itself.
+        return (
+            choose
+            + textwrap.dedent(
+                """\
+            . /etc/openwrt_release
+            arch=$(opkg print-architecture |awk '$3 > p {{p = $3 ; a = $2}} END {{print a}}')
+            mkdir -p /tmp/cg-opkg.d
+            sed -E "s#^(src/gz [^ ]+) (https?)://#\\1 http://127.0.0.1:{}/$DISTRIB_RELEASE/$arch/\\2/#" /etc/opkg.conf /etc/opkg/*.conf >/tmp/cg-opkg.conf
+            cached="env OPKG_CONF_DIR=/tmp/cg-opkg.d opkg -f /tmp/cg-opkg.conf"
+            if ! {{ $cached update && $cached install $pkgs ; }} ; then
+                opkg update  # the cache or the tunnel failed; install directly
+                {}
+            fi
+            """  # noqa: E501
+            ).format(port, install)
+        )
+
+    @staticmethod
+    def open_tunnel(router):
+        """Forward a port on the router's loopback interface to the cache, once per ssh
+        connection; return the port on the router, or None if this is not possible"""
+        if isinstance(router.client, BrokerClient):
+            return None  # the broker owns the ssh connection
+        transport = router.client.get_transport()
+        tunnel = getattr(router, "_package_tunnel", None)
+        if tunnel is not None and tunnel[0] is transport:
+            return tunnel[1]
+        local_port = PackageCache.server_port()
+        # Only the feeds in the router's opkg configuration are fetched on its behalf, so that
+        # the tunnel does not reach anything else from this computer
+        __, feeds, __ = router._run("cat /etc/opkg.conf /etc/opkg/*.conf 2>/dev/null")
+        hosts = frozenset(PackageCache.feed_re.findall(feeds))
+
+        def handler(channel, origin, server):  # called by Paramiko for each connection
+            threading.Thread(
+                target=PackageCache._relay, args=(channel, local_port, hosts), daemon=True
+            ).start()
+
+        try:
+            port = transport.request_port_forward("127.0.0.1", 0, handler)
+        except paramiko.ssh_exception.SSHException as err:
+            print_msg(1, _("Not using the package cache: {}").format(err))
+            return None
+        router._package_tunnel = (transport, port)
+        return port
+
+    @staticmethod
+    def _relay(channel, port, hosts):
+        """Copy data between a tunnelled connection and the local HTTP server, which may fetch
+        files from 'hosts' for it"""
+        try:
+            with socket.create_connection(("127.0.0.1", port)) as sock:
+                address = sock.getsockname()
+                PackageCache._feed_hosts[address] = hosts
+                try:
+                    relay_channel(sock, channel)
+                finally:
+                    del PackageCache._feed_hosts[address]
+        except OSError:
+            channel.close()
+
+    @staticmethod
+    def server_port():
+        """Start the local HTTP server, if it is not running; return its port"""
+        with PackageCache._lock:
+            if PackageCache._server is None:
+
+                class Handler(http_server.BaseHTTPRequestHandler):
+                    def do_GET(self):  # noqa: N802 (name is set by http.server)
+                        hosts = PackageCache._feed_hosts.get(self.client_address, ())
+                        try:
+                            path = PackageCache.fetch(self.path, hosts)
+                        except CGError as err:
+                            self.send_error(404, str(err))
+                            return
+                        self.send_response(200)
+                        self.send_header("Content-Length", str(os.path.getsize(path)))
+                        self.end_headers()
+                        with open(path, "rb") as f:
+                            while True:
+                                chunk = f.read(STREAM_CHUNK)
+                                if len(chunk) == 0:
+                                    break
+                                self.wfile.write(chunk)
+
+                    def log_message(self, fmt, *args):
+                        print_msg(2, _("Package cache: ") + fmt % args)
+
+                class Server(socketserver.ThreadingMixIn, http_server.HTTPServer):
+                    daemon_threads = True
+
+                PackageCache._server = Server(("127.0.0.1", 0), Handler)
+                threading.Thread(target=PackageCache._server.serve_forever, daemon=True).start()
+            return PackageCache._server.server_address[1]
+
+    @staticmethod
+    def fetch(url_path, hosts):
+        """Return the path of the cached copy of the file at 'url_path', of the form
+        '/<release>/<arch>/<http or https>/<host>/<path>', downloading it first if needed.
+        Files are only downloaded from 'hosts'."""
+        parts = url_path.split("?")[0].split("/")[1:]
+        if (
+            len(parts) < 5
+            or parts[2] not in ["http", "https"]
+            or not all(PackageCache.part_re.match(p) for p in parts)
+        ):
+            raise CGError(_("Invalid package cache request {}").format(url_path))
+        if parts[3] not in hosts:
+            raise CGError(_("Not a package feed of the router: {}").format(parts[3]))
+        path = os.path.join(PackageCache.cache_dir(), *parts)
+        try:
+            downloaded = os.stat(path).st_mtime
+        except FileNotFoundError:
+            downloaded = None
+        if downloaded is None or (
+            not path.endswith(".ipk") and time.time() - downloaded > PACKAGE_LIST_TTL
+        ):
+            url = "{}://{}".format(parts[2], "/".join(parts[3:]))
+            try:
+                PackageCache._download(url, path)
+                print_msg(1, _("Package cache: downloaded {}").format(url))
+            except (OSError, ValueError) as err:
+                if downloaded is None:
+                    raise CGError(_("Unable to download {}: {}").format(url, err))
+                print_msg(1, _("Package cache: using old copy of {}: {}").format(url, err))
+            PackageCache.evict(keep=path)
+        now = time.time()
+        os.utime(path, (now, os.stat(path).st_mtime))  # access time orders eviction
+        return path
+
+    @staticmethod
+    def _download(url, path):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with urllib_request.urlopen(url, timeout=PACKAGE_FETCH_TIMEOUT) as response:
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                try:
+                    while True:
+                        chunk = response.read(STREAM_CHUNK)
+                        if len(chunk) == 0:
+                            break
+                        f.write(chunk)
+                except BaseException:
+                    os.unlink(f.name)
+                    raise
+        os.replace(f.name, path)  # other routers never see a partial file
+
+    @staticmethod
+    def evict(keep=None):
+        """Remove the least recently used files until the cache fits in 'max_bytes'"""
+        with PackageCache._lock:
+            files = list()
+            for parent, __, names in os.walk(PackageCache.cache_dir()):
+                for name in names:
+                    path = os.path.join(parent, name)
+                    try:
+                        info = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((info.st_atime, info.st_size, path))
+            total = sum(size for __, size, __ in files)
+            for __, size, path in sorted(files):
+                if total <= PackageCache.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.unlink(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+
 def wifi_hunt(conf, factory_wifi=""):
     """Scan and connect to router's WiFi network. Return SSID, password."""
     line_re = re.compile(r" {2,}: +")  # wifi_re and password separated by '  : ', one per line
@@ -591,7 +2890,8 @@ def wifi_hunt(conf, factory_wifi=""):
         if len(two_items) != 2:
             raise CGError(_("Invalid factory_wifi data line: {}").format(line))
         factory_ssids[two_items[0]] = two_items[1]
-    nets = wifi_available_ssids()  # scan for nearby WiFi networks
+    with trace("wifi_available_ssids", "phase"):
+        nets = wifi_available_ssids()  # scan for nearby WiFi networks
     known_ssids = dict()  # SSID : password
     for s in list(set(nets.values())):  # for each unique SSID
         for r in conf.routers:  # test SSIDs from conf file _first_
@@ -609,26 +2909,32 @@ def wifi_hunt(conf, factory_wifi=""):
         raise CGError(err + _("Multiple possible networks found"))
     ssid = list(known_ssids.keys())[0]
     ssid_password = known_ssids[ssid]
-    wifi_connect(ssid, ssid_password)
+    with trace("wifi_connect", "phase", ssid=ssid):
+        wifi_connect(ssid, ssid_password)
     return ssid, ssid_password
 
 
-def network_hunt(conf, ssid):
-    """Scan local networks for router. Return existing or new Router() instance."""
-    ip_list_full = [ipaddress.ip_address(r.ip) for r in conf.routers]  # IPs from config file
-    ip_list_full += possible_router_ips()  # first IP of each detected network
-    # Note ip_list_full will normally include 192.168.8.1
-    ip_list_no_dups = [i for n, i in enumerate(ip_list_full) if i not in ip_list_full[:n]]
+def router_candidates(conf, cidrs=None):
+    """Scan networks (by default, the local networks) for hosts with ssh or telnet open.
+    Return a list of existing or new Router() instances, each with a value for 'ssh_hostkey'
+    (None if no ssh server was found), most likely router first. The score used for ranking is
+    in each router's '_discovery_score'."""
+    targets = sweep_targets(cidrs)
+    targets += [ipaddress.ip_address(r.ip) for r in conf.routers]  # IPs from config file
+    targets = list(dict.fromkeys(targets))  # remove duplicates, keeping order
+    with trace("port_sweep", "phase", count=len(targets)):
+        open_ports = sweep_ports(targets)
+    hosts = [ip for ip in targets if ip in open_ports]
+    # Read MACs from the neighbor table in one go; ask only for those which are missing.
+    neighbors = neighbor_table()
+    missing = [ip for ip in hosts if str(ip) not in neighbors]
+    with trace("mac_address", "phase", count=len(missing)):
+        macs = probe_concurrently(mac_address, missing, timeout=PROBE_TIMEOUT)
+    neighbors.update({str(ip): mac for ip, mac in zip(missing, macs) if mac is not None})
     mac_to_ip = dict()
-    router_options = list()  # computed list of what could be a router
-    for ip in ip_list_no_dups:  # for each IP that might be a router
-        if isinstance(ip, ipaddress.IPv4Address):
-            mac = getmac.get_mac_address(ip=str(ip))
-        elif isinstance(ip, ipaddress.IPv6Address):
-            mac = getmac.get_mac_address(ip6=str(ip))
-        else:
-            raise TypeError("ip must be ipaddress")
-        if mac is None:  # unroutable IP
+    for ip in hosts:  # for each IP that might be a router
+        mac = neighbors.get(str(ip))
+        if mac is None:  # unroutable IP (or probe timed out)
             continue
         if mac == "00:00:00:00:00:00":  # unreachable (no host at IP)
             continue
@@ -641,49 +2947,215 @@ def network_hunt(conf, ssid):
             )
             continue
         mac_to_ip[mac] = ip
-        found = False
-        hostkey = add_line_breaks(ssh_keyscan(str(ip)), line_len=64)  # takes a few seconds
+    # Grab all host keys in parallel; each takes a few seconds.
+    candidates = list(mac_to_ip.items())
+
+    def keyscan(mac_ip):
+        mac, ip = mac_ip
+        cached = ConfigSaver.cached_hostkey(ip, mac)
+        if cached is not None:  # same IP and MAC seen recently; skip the ssh handshake
+            return cached
+        with trace("ssh_keyscan", "probe", router=str(ip)):
+            key = ssh_keyscan(str(ip), timeout=PROBE_TIMEOUT)
+        if key is not None:
+            ConfigSaver.cache_hostkey(ip, mac, key)
+        return key
+
+    with_ssh = [(mac, ip) for mac, ip in candidates if 22 in open_ports[ip]]
+    with trace("ssh_keyscan", "phase", count=len(with_ssh)):
+        keys = probe_concurrently(keyscan, with_ssh, PROBE_TIMEOUT)
+    hostkeys = {ip: key for (__, ip), key in zip(with_ssh, keys)}
+    gateways = default_gateways()
+    first_ips = set(possible_router_ips()) if cidrs is None else set()
+    router_options = list()  # computed list of what could be a router
+    for mac, ip in candidates:
+        key = hostkeys.get(ip)
+        hostkey = add_line_breaks(key, line_len=64) if key is not None else None
         # Note we don't match based on MAC because routers can be reset, plus some
         # routers generate the MAC address for certain interfaces at _boot_ time.
-        for r in conf.routers:  # look for matching hostkey in conf data
-            if r.ssh_hostkey == hostkey:
-                r.ip = str(ip)  # update IP if it has changed since config file was saved
-                r.mac = mac  # update MAC if it has changed
-                router_options.append(r)
-                found = True
-                break
-        if not found:
+        r = None if hostkey is None else ConfigSaver.find_router(conf, "ssh_hostkey", hostkey)
+        if r is not None:  # matching hostkey in conf data
+            r.ip = str(ip)  # update IP if it has changed since config file was saved
+            r.mac = mac  # update MAC if it has changed
+            router_options.append(r)
+        else:
             r = Router(ip, mac)  # previously-unknown router
+            r.set_hostkey(hostkey)
             router_options.append(r)
-    if len(router_options) > 1:
-        err = "\n".join(_("Possible router: {} (ip {})").format(r.nickname, r.ip)) + "\n"
-        raise CGError(err + _("Multiple possible routers found"))
-    if len(router_options) == 0:
-        raise CGError(_("No possible routers found"))
-    router = router_options[0]  # the chosen router
+        r._discovery_score = (
+            (8 if r.router_password else 0)  # known router
+            + (4 if str(ip) in gateways else 0)
+            + (2 if ip in first_ips else 0)
+            + (2 if hostkey is not None else 0)
+            + (1 if 23 in open_ports[ip] else 0)  # telnet, as after a factory reset
+        )
+        r._open_ports = open_ports[ip]
+    # sorted() is stable, so equal scores stay in address order
+    return sorted(router_options, key=lambda r: r._discovery_score, reverse=True)
+
+
+def adopt_router(conf, router, ssid, add=True):
+    """Generate passwords and keys for a new router and, if 'add', add it to conf. Otherwise it
+    is added by set_up_one_router() once its routerauth coterie has been applied."""
     router.ssid = ssid
     if not router.router_password:
         router.generate_passwords()
-        router.generate_ssh_keys()
+        with trace("generate_ssh_keys", "phase", router=router):
+            router.generate_ssh_keys()
         router.vpn_username = conf.default_vpn_username
         router.vpn_password = conf.default_vpn_password
         router.vpn_server_host = conf.default_vpn_server_host
         # If router also serves as AP, once we have connected to the router via ssh, this
         # could be used instead of above line:
         # router.ssid = router.exec('uci get wireless.@wifi-iface[0].ssid').rstrip()
-        conf.routers.append(router)
-    print_msg(1, _("Using router {} (ip {})").format(router.nickname, router.ip))
-    return router
+        if add:
+            with ConfigSaver.lock:
+                conf.routers.append(router)
+            ConfigSaver.journal(router, "new router")  # before its password is changed
 
 
-class Coteries:
-    """
-    A coterie is a group of gophers, or in this context, a group of commands or a file
-    which changes the state of the router. A coterie module is a YAML file which contains
-    some metadata plus an ordered set of coteries which can be used to set up a router
-    for a particular purpose.
+def known_router(conf):
+    """Return the configured router which answers at its last known IP with its stored host
+    key, preferring the most recently connected, or None. This needs no WiFi or network
+    search (or their imports)."""
+    routers = [r for r in conf.routers if getattr(r, "ssh_hostkey", None) and r.router_password]
+    routers.sort(key=lambda r: getattr(r, "last_connect", None) or "", reverse=True)
 
-    Example of the beginning of a .coterie file with line numbers added:
+    def keyscan(r):
+        with trace("ssh_keyscan", "probe", router=str(r.ip)):
+            return ssh_keyscan(str(r.ip), r.ssh_port, timeout=SWEEP_TIMEOUT)
+
+    with trace("known_router", "phase", count=len(routers)):
+        keys = probe_concurrently(keyscan, routers, PROBE_TIMEOUT)
+    for r, key in zip(routers, keys):
+        if key is not None and r.hostkey_matches(key):
+            print_msg(1, _("Using known router {} (ip {})").format(r.nickname, r.ip))
+            return r
+    return None
+
+
+def network_hunt(conf, ssid, cidrs=None):
+    """Scan local networks for router. Return existing or new Router() instance."""
+    router_options = router_candidates(conf, cidrs)
+    if (
+        len(router_options) > 1
+        and router_options[0]._discovery_score == router_options[1]._discovery_score
+    ):
+        err = "\n".join(
+            _("Possible router: {} (ip {})").format(r.nickname, r.ip) for r in router_options
+        )
+        raise CGError(err + "\n" + _("Multiple possible routers found"))
+    if len(router_options) == 0:
+        raise CGError(_("No possible routers found"))
+    router = router_options[0]  # the chosen router
+    for r in router_options[1:]:
+        print_msg(1, _("Less likely router: {} (ip {})").format(r.nickname, r.ip))
+    adopt_router(conf, router, ssid)
+    print_msg(1, _("Using router {} (ip {})").format(router.nickname, router.ip))
+    return router
+
+
+class CoterieCache:
+    """
+    Cache of validated coterie modules in compiled (pickle) form, plus an index of each
+    module's metadata. Index entries are keyed by file path and are valid while the file's
+    size and mtime are unchanged; otherwise the content hash is compared, so a file which was
+    only touched keeps its compiled module. The whole cache is discarded when this program
+    changes, because validation rules may have changed. Any problem with the cache is treated
+    as a miss.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "coteries.index")
+        self.changed = False
+        st = os.stat(os.path.abspath(__file__))
+        self.program = (st.st_size, st.st_mtime_ns)
+        try:
+            with open(self.index_path, "rb") as index_file:
+                program, self.index = pickle.load(index_file)
+            if program != self.program:
+                self.index = dict()
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            self.index = dict()
+
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def entry(self, path):
+        """Return a tuple (index entry, content) for the given file; content is None if the
+        file did not need to be read"""
+        st = os.stat(path)
+        entry = self.index.get(path)
+        if entry is not None and (entry["size"], entry["mtime"]) == (st.st_size, st.st_mtime_ns):
+            return entry, None
+        content = CoterieCache.read(path)
+        content_hash = sha256(content).hexdigest()
+        if entry is None or entry["hash"] != content_hash:
+            entry = {"hash": content_hash, "metadata": None}
+        entry.update({"size": st.st_size, "mtime": st.st_mtime_ns})
+        self.index[path] = entry
+        self.changed = True
+        return entry, content
+
+    def prune(self, paths):
+        """Drop index entries for files other than 'paths', e.g. deleted modules"""
+        for path in set(self.index) - set(paths):
+            del self.index[path]
+            self.changed = True
+
+    def _module_path(self, entry):
+        return os.path.join(self.cache_dir, entry["hash"] + ".module")
+
+    def module(self, entry):
+        """Return the compiled module for the given index entry, or None if not cached"""
+        if not entry.get("compiled"):
+            return None
+        try:
+            with open(self._module_path(entry), "rb") as module_file:
+                return pickle.load(module_file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            return None
+
+    def store_module(self, entry, module):
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            with open(self._module_path(entry) + ".0", "wb") as module_file:
+                pickle.dump(module, module_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(self._module_path(entry) + ".0", self._module_path(entry))
+            entry["compiled"] = True
+            self.changed = True
+        except OSError as err:
+            print_msg(2, _("Unable to cache coterie module: {}").format(err))
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            with open(self.index_path + ".0", "wb") as index_file:
+                pickle.dump(
+                    (self.program, self.index), index_file, protocol=pickle.HIGHEST_PROTOCOL
+                )
+            os.replace(self.index_path + ".0", self.index_path)
+            in_use = {e["hash"] + ".module" for e in self.index.values()}
+            for f in os.listdir(self.cache_dir):  # remove modules of old file versions
+                if f.endswith(".module") and f not in in_use:
+                    os.unlink(os.path.join(self.cache_dir, f))
+        except OSError as err:
+            print_msg(2, _("Unable to save coterie cache index: {}").format(err))
+
+
+class Coteries:
+    """
+    A coterie is a group of gophers, or in this context, a group of commands or a file
+    which changes the state of the router. A coterie module is a YAML file which contains
+    some metadata plus an ordered set of coteries which can be used to set up a router
+    for a particular purpose.
+
+    Example of the beginning of a .coterie file with line numbers added:
 
      1  !CoterieModule
      2  module_type: router_hardware
@@ -702,7 +3174,11 @@ class Coteries:
     Line explanations:
     - 1: required header
     - 7: the name of the coterie
-    - 8: 2 integers separated by a space, representing the from and to version for this coterie
+    - 8: |
+        2 integers separated by a space, representing the from and to version for this coterie.
+        Several coteries may share an id if their deltas differ, e.g. '0 2' to set up a new
+        router and '1 2' to migrate one at version 1; list them in order of 'from' version. A
+        router is brought to the highest 'to' version via the shortest chain of deltas.
     - 9: |
         This integer defines the sequence in which coteries are applied. Coteries with the
         same 'sort' will be done in the order listed in the .coterie file. The primary
@@ -722,11 +3198,35 @@ class Coteries:
         commands: list of shell commands to be run one-at-a-time on router
         exploration: like 'commands' but okay for commands to fail
         routerauth: like 'commands' but connect to router without authentication
+        reboot: command(s) which reboot the router; the connection is dropped, and the
+          coteries after it run once the router's ssh server is back with the same host key
+          (see --reboot-deadline)
         file: file that is to be copied to router; must define 'path' and (in another coterie)
           commands to set permissions
+        packages: opkg packages to install, separated by spaces or newlines; consecutive
+          'packages' coteries are installed with one opkg command, downloading via the local
+          package cache (see PackageCache) when possible. A line ending in 'if release < N'
+          or 'if release >= N' is only installed when the OpenWrt major release (from
+          /etc/openwrt_version) is, or is not, older than N.
         factory_wifi: list of WiFi SSIDs (regular expression), followed by '  : ' (additional
           spaces are ignored), followed by the default WiFi password for the given SSID; one
           SSID/password per line
+
+    A coterie with delta '0 n' is run again on routers at version n when its content (as
+    rendered for the router) has changed, so it must be safe to run twice: e.g. use named uci
+    sections ('uci set firewall.cg_name=rule') rather than 'uci add', and 'uci del_list' before
+    'uci add_list'. Optional item for a coterie which cannot be run again, e.g. a check of the
+    factory state:
+    - reapply: false
+
+    Optional items in a coterie, used only when running several coteries at the same time
+    (--channels greater than 1); coteries are only run concurrently with others in the same
+    'sort' band, and a band finishes before the next one starts:
+    - after: list of ids of coteries which must be finished before this one starts
+    - resources: list of tags, e.g. [uci] or [file:/etc/sysctl.conf], naming the state this
+        coterie changes; coteries sharing a tag run one at a time, in the order listed. A
+        coterie without 'resources' runs by itself; use 'resources: []' for one which can run
+        alongside anything.
     """
 
     class CoterieModule(yaml.YAMLObject):
@@ -737,169 +3237,1475 @@ class Coteries:
         yaml_loader = yaml.SafeLoader
         yaml_tag = "!Coterie"
 
-        def exec(self, router):
-            if self.type == "factory_wifi":
-                return
-            version_now = router.version_map.get(self.id, 0)
-            version_available = int(self.delta.split(" ")[1])  # 'from' version not yet implemented
-            if version_now >= version_available:
-                return
-            print_msg(1, _("Updating to {} {}").format(self.id, version_available))
+        # Salt used for password hashes in fingerprint(); a random salt would make every
+        # fingerprint different.
+        fingerprint_salt = "$1$cgfprint"
+
+        def versions(self):
+            """Return the 'from' and 'to' versions of this coterie's delta, as integers"""
+            version_from, version_to = self.delta.split(" ")
+            return int(version_from), int(version_to)
+
+        def content_changed(self, router):
+            """Return True if the router is at the version this coterie installs from scratch
+            (delta '0 n'), but its rendered content has changed since it was applied"""
+            # routerauth is for fresh routers only, and a reboot leaves nothing to redo
+            if self.type in ["factory_wifi", "routerauth", "reboot"]:
+                return False
+            if not getattr(self, "reapply", True):
+                return False
+            if self.versions() != (0, router.version_map.get(self.id, 0)):
+                return False
+            applied = router.content_map.get(self.id)
+            # Routers set up before fingerprints were kept have no entry; trust the version.
+            return applied is not None and applied != self.fingerprint(router)
+
+        def render(self, router, salt=None):
+            """Return the coterie data with all parameters filled in"""
             data_no_params = self.data
-            if "{root_shadow_line}" in data_no_params:
-                p = "root:" + hashed_md5_password(router.router_password) + ":0:0:99999:7:::"
-                data_no_params = data_no_params.replace("{root_shadow_line}", p)
-            if "{authorized_keys_line}" in data_no_params:
-                # Remove all whitespace except a space by itself
-                p = re.sub(r"(\s{2,})|([\t\r\n]+)|(\s+$)", "", router.ssh_pubkey)
-                data_no_params = data_no_params.replace("{authorized_keys_line}", p)
-            if "{http_password_sha256}" in data_no_params:
-                p = sha256(router.router_password.encode()).hexdigest()
-                data_no_params = data_no_params.replace("{http_password_sha256}", p)
+            for name in ["root_shadow_line", "authorized_keys_line", "http_password_sha256"]:
+                if "{" + name + "}" in data_no_params:
+                    p = router.secret(name, salt if name == "root_shadow_line" else None)
+                    data_no_params = data_no_params.replace("{" + name + "}", p)
             # Alternatively, we could ignore the KeyError exception -
             # see https://stackoverflow.com/a/17215533/10590519
             try:
-                data_no_params = data_no_params.format(**vars(router))
+                return data_no_params.format(**vars(router))
             except (KeyError, IndexError) as err:
                 raise CGError(_("Unknown named parameter in coterie {}: {}").format(self.id, err))
+
+        def fingerprint(self, router):
+            """Return a short hash of this coterie as rendered for the given router"""
+            content = "\0".join(
+                [self.type, getattr(self, "path", ""), self.render(router, self.fingerprint_salt)]
+            )
+            return sha256(content.encode()).hexdigest()[0:16]
+
+        def mark_applied(self, router, version):
+            """Record that this coterie has been successfully applied to router"""
+            router.version_map[self.id] = version
+            if self.versions()[0] == 0:
+                router.content_map[self.id] = self.fingerprint(router)
+            else:  # after a migration, the content no longer matches any one coterie
+                router.content_map.pop(self.id, None)
+            ConfigSaver.journal(router, "coterie {} {}".format(self.id, version))
+
+        def exec(self, router):
+            Coteries.exec_all([self], router)
+
+    batched_types = {"commands", "exploration", "packages"}  # can share a single channel
+    exclusive_types = {"routerauth", "reboot"}  # never run alongside another coterie
+    reboot_deadline = REBOOT_DEADLINE
+    _plans = dict()  # (coterie ids and deltas, version map): indexes of coteries to apply
+    _plans_lock = threading.Lock()
+
+    @staticmethod
+    def plan(coteries, version_map):
+        """Return the indexes in 'coteries' of those which bring a router with the given
+        version map to the newest version of each coterie id. For each id, the shortest chain
+        of deltas from the router's version is taken. Plans are kept, so routers with the same
+        version map share one."""
+        key = (
+            tuple((c.id, c.delta) for c in coteries),
+            tuple(
+                sorted((i, v) for i, v in version_map.items() if any(c.id == i for c in coteries))
+            ),
+        )
+        with Coteries._plans_lock:
+            if key in Coteries._plans:
+                return Coteries._plans[key]
+        steps = set()
+        for coterie_id in {c.id for c in coteries if c.type != "factory_wifi"}:
+            deltas = [(n, c.versions()) for n, c in enumerate(coteries) if c.id == coterie_id]
+            target = max(version_to for __, (__, version_to) in deltas)
+            if version_map.get(coterie_id, 0) >= target:
+                continue  # up to date
+            chains = {version_map.get(coterie_id, 0): list()}  # version reached: indexes
+            while target not in chains:  # breadth-first, so the first chain found is shortest
+                reached = dict()
+                for version, chain in chains.items():
+                    for n, (version_from, version_to) in deltas:
+                        if version_from == version and version_to not in chains:
+                            reached.setdefault(version_to, chain + [n])
+                if len(reached) == 0:
+                    raise CGError(
+                        _("No migration for coterie {} from version {} to {}").format(
+                            coterie_id, version_map.get(coterie_id, 0), target
+                        )
+                    )
+                chains.update(reached)
+            steps.update(chains[target])
+        with Coteries._plans_lock:
+            Coteries._plans[key] = steps
+        return steps
+
+    @staticmethod
+    def pending(coteries, router):
+        """Return, in order, the coteries to apply to router: the migrations chosen by plan(),
+        plus coteries at the current version whose content has changed, to be re-applied"""
+        steps = Coteries.plan(coteries, router.version_map)
+        return [c for n, c in enumerate(coteries) if n in steps or c.content_changed(router)]
+
+    @staticmethod
+    def exec_all(coteries, router):
+        """Apply the pending coteries (see pending()) of the given coteries in order. Runs of
+        consecutive 'commands', 'exploration' and 'packages' coteries are sent to the router
+        as one script over a single channel, and runs of consecutive 'file' coteries as one
+        archive."""
+        batch = list()  # items are tuples: (coterie, version_available, data_no_params)
+        for c in Coteries.pending(coteries, router):
+            version_available = c.versions()[1]
+            if router.version_map.get(c.id, 0) >= version_available:
+                print_msg(1, _("Re-applying {} (content has changed)").format(c.id))
+            else:
+                print_msg(1, _("Updating to {} {}").format(c.id, version_available))
+            data_no_params = c.render(router)
+            if len(batch) > 0 and (c.type == "file") != (batch[0][0].type == "file"):
+                Coteries._flush(batch, router)
+                batch = list()
+            if c.type in Coteries.batched_types or c.type == "file":
+                batch.append((c, version_available, data_no_params))
+                continue
+            Coteries._flush(batch, router)
+            batch = list()
             try:
-                if self.type == "routerauth":
-                    router.set_password_on_router(data_no_params)
-                elif self.type == "exploration":
-                    router.connect_ssh()
-                    for line in data_no_params.splitlines():
-                        router.exec(line, okay_to_fail=True)
-                elif self.type == "commands":
-                    router.connect_ssh()
-                    for line in data_no_params.splitlines():
-                        router.exec(line, okay_to_fail=False)
-                elif self.type == "file":
-                    router.connect_ssh()
-                    router.put(data_no_params.encode(), self.path)
+                if c.type == "routerauth":
+                    # Journal a router which is not yet in the configuration (see
+                    # adopt_router()) before its password is changed
+                    ConfigSaver.journal(router, "new router")
+                    with trace(c.id, "coterie", router=router, type=c.type):
+                        router.set_password_on_router(data_no_params)
+                elif c.type == "reboot":
+                    with trace(c.id, "coterie", router=router, type=c.type):
+                        router.reboot(data_no_params, Coteries.reboot_deadline)
             except RemoteExecutionError as err:
-                raise CGError(_("Failed to execute coterie {}: {}").format(self.id, err))
-            router.version_map[self.id] = version_available  # we have now successfully upgraded
+                raise CGError(_("Failed to execute coterie {}: {}").format(c.id, err))
+            c.mark_applied(router, version_available)  # we have now successfully upgraded
+        Coteries._flush(batch, router)
+
+    @staticmethod
+    def conflict(a, b):
+        """Return True if coteries a and b must not run at the same time"""
+        if Coteries.exclusive_types & {a.type, b.type} or a.id == b.id:
+            return True
+        if getattr(a, "resources", None) is None or getattr(b, "resources", None) is None:
+            return True
+        return len(set(a.resources) & set(b.resources)) > 0
+
+    @staticmethod
+    def exec_scheduled(coteries, router, channels=1):
+        """Apply the given coteries, which must be sorted, running up to 'channels' coteries in
+        each 'sort' band at the same time on separate channels of one ssh connection"""
+        if channels <= 1:
+            Coteries.exec_all(coteries, router)
+            return
+        pending = Coteries.pending(coteries, router)
+        for __, band in itertools.groupby(pending, key=lambda c: c.sort):
+            band = list(band)
+            if len(band) <= 1 or any(c.type in Coteries.exclusive_types for c in band):
+                Coteries.exec_all(band, router)
+                continue
+            if isinstance(router.client, BrokerClient):  # carries one command at a time
+                router.close()
+            # Before starting threads, which share the connection's channels
+            router.connect_ssh(use_broker=False)
+            Coteries._exec_band(band, router, channels)
+
+    @staticmethod
+    def _exec_band(band, router, channels):
+        """Run the coteries of one 'sort' band, respecting 'after' and 'resources'. After a
+        failure, no more coteries are started and, once running coteries have finished, the
+        error of the first failed coterie (in sort order) is raised."""
+        waits_for = list()  # for each coterie, indexes of those which must be finished first
+        for j, c in enumerate(band):
+            after = getattr(c, "after", list())
+            waits_for.append(
+                {i for i in range(j) if Coteries.conflict(band[i], c) or band[i].id in after}
+            )
+        verbosity = getattr(_output, "verbose", verbose)
+        prefix = getattr(_output, "prefix", "")
+
+        def run(c):
+            _output.verbose = verbosity
+            _output.prefix = "{}[{}] ".format(prefix, c.id)
+            Coteries.exec_all([c], router)
+
+        started = set()
+        finished = set()
+        failures = dict()  # index in band: exception
+        running = dict()  # future: index in band
+        with concurrent.futures.ThreadPoolExecutor(max_workers=channels) as executor:
+            while True:
+                for j, c in enumerate(band):
+                    if len(failures) == 0 and j not in started and waits_for[j] <= finished:
+                        running[executor.submit(run, c)] = j
+                        started.add(j)
+                if len(running) == 0:
+                    break
+                done, __ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for f in done:
+                    j = running.pop(f)
+                    if f.exception() is not None:
+                        failures[j] = f.exception()
+                    else:
+                        finished.add(j)
+        if len(failures) > 0:
+            raise failures[min(failures)]
+
+    @staticmethod
+    def _flush(batch, router):
+        if len(batch) == 0:
+            return
+        ids = ", ".join(c.id for c, __, __ in batch)
+        with trace(ids, "coterie", router=router, type=batch[0][0].type):
+            if batch[0][0].type == "file":
+                Coteries._put_bundle(batch, router)
+            else:
+                Coteries._exec_batch(batch, router)
+
+    @staticmethod
+    def _put_bundle(batch, router):
+        """Copy a list of (coterie, version_available, data_no_params) tuples, all of type
+        'file', as one archive"""
+        router.connect_ssh()
+        try:
+            router.put_bundle([(data.encode(), c.path) for c, __, data in batch])
+        except RemoteExecutionError as err:
+            ids = ", ".join(c.id for c, __, __ in batch)
+            raise CGError(_("Failed to execute coterie {}: {}").format(ids, err))
+        for c, version_available, __ in batch:
+            c.mark_applied(router, version_available)  # we have now successfully upgraded
 
     @staticmethod
-    def load():
-        """Load and validate coterie modules."""
+    def _exec_batch(batch, router):
+        """Run a list of (coterie, version_available, data_no_params) tuples as one script.
+        Consecutive 'packages' coteries become a single opkg command."""
+        if len(batch) == 0:
+            return
+        router.connect_ssh()
+        commands = list()  # items are tuples: (command, okay_to_fail)
+        owners = list()  # set of indexes into 'batch' for each item in 'commands'
+        packages = list()  # of the current run of 'packages' coteries
+        for n, (c, __, data_no_params) in enumerate(batch):
+            if c.type == "packages":
+                if n == 0 or batch[n - 1][0].type != "packages":
+                    packages = list()
+                    commands.append(None)  # filled in below
+                    owners.append(set())
+                packages += [p for p in PackageCache.parse(data_no_params) if p not in packages]
+                port = PackageCache.open_tunnel(router)
+                commands[-1] = (PackageCache.install_script(packages, port), False)
+                owners[-1].add(n)
+                continue
+            for line in data_no_params.splitlines():
+                commands.append((line, c.type == "exploration"))
+                owners.append({n})
+        results = router.exec_batch(commands)
+        for n, (c, version_available, __) in enumerate(batch):
+            for i in [i for i, owner in enumerate(owners) if n in owner]:
+                if i >= len(results):
+                    raise CGError(
+                        _("Failed to execute coterie {}: {}").format(
+                            c.id, _("no exit status from router")
+                        )
+                    )
+                exitc, __, err = results[i]
+                if exitc != 0 and not commands[i][1]:
+                    err0 = err.splitlines()[0].rstrip() if err else ""
+                    raise CGError(_("Failed to execute coterie {}: {}").format(c.id, err0))
+            c.mark_applied(router, version_available)  # we have now successfully upgraded
+
+    valid_module_types = {"vpn_provider", "router_hardware"}
+    valid_vpn_types = {"openvpn"}
+    valid_types = {
+        "commands",
+        "exploration",
+        "routerauth",
+        "reboot",
+        "file",
+        "packages",
+        "factory_wifi",
+    }
+
+    @staticmethod
+    def load(modules=None):
+        """Load and validate coterie modules. 'modules', if given, is a list of the names of
+        the modules to use: a file name without '.coterie', or a display_name. Only the
+        metadata index is read for the other modules, which are never fully parsed. Validated
+        modules are kept in a compiled cache, so unchanged files are not re-parsed."""
         self = Coteries()
-        valid_module_types = {"vpn_provider", "router_hardware"}
-        valid_vpn_types = {"openvpn"}
-        valid_types = {"commands", "exploration", "routerauth", "file", "factory_wifi"}
-        valid_id_re = re.compile(r"[a-zA-Z0-9\._-]+$")
-        valid_display_name_re = re.compile(r"[^\t\r\n]+$")
         self.modules = list()
         our_dir = os.path.dirname(Path(sys.argv[0]).resolve())
         coteries_dir = os.path.join(our_dir, "coteries")
-        for f in os.listdir(coteries_dir):
+        cache = CoterieCache(os.path.join(ConfigSaver.conf_dir(), "cache"))
+        unknown = set(modules or list())
+        files = sorted(f for f in os.listdir(coteries_dir) if f.endswith(".coterie"))
+        cache.prune([os.path.join(coteries_dir, f) for f in files])
+        for f in files:
             f_path = os.path.join(coteries_dir, f)
-            with open(f_path, "r") as coterie_file:
-                try:
-                    module = yaml.safe_load(coterie_file)
-                except (yaml.YAMLError, yaml.constructor.ConstructorError) as yaml_err:
-                    raise CGError(_("Error parsing {}: {}").format(f, yaml_err))
-            try:
-                if module.module_type not in valid_module_types:
-                    raise CGError(_("Invalid module_type in {}: {}").format(f, module.module_type))
-                if module.vpn_type not in valid_vpn_types:
-                    raise CGError(_("Invalid vpn_type in {}: {}").format(f, module.vpn_type))
-                if not valid_display_name_re.match(module.display_name):
-                    raise CGError(
-                        _("Invalid display_name in {}: {}").format(f, module.display_name)
-                    )
-            except AttributeError as err:
-                raise CGError(_("Missing item in {}: {}").format(f, err))
-            sort_max = 0
-            ids = set()
-            for c in module.coteries:
-                try:
-                    if not valid_id_re.match(c.id):
-                        raise CGError(_("Invalid id in {}: {}").format(f, c.id))
-                    if c.id in ids:
-                        raise CGError(_("Duplicate id in {}: {}").format(f, c.id))
-                    ids.add(c.id)
-                except AttributeError:
-                    raise CGError(_("Missing id for a coterie in {}").format(f))
-                try:
-                    if int(c.delta.split(" ")[0]) >= int(c.delta.split(" ")[1]):
-                        raise CGError(_("Invalid delta in {}#{}: {}").format(f, c.id, c.delta))
-                    if c.sort < sort_max:
-                        raise CGError(_("Coterie {}#{} is not in sort order").format(f, c.id))
-                    sort_max = c.sort
-                    if c.type not in valid_types:
-                        raise CGError(_("Invalid type in {}#{}: {}").format(f, c.id, c.type))
-                    if c.type == "file" and c.path[0] != "/":
-                        raise CGError(_("Invalid path in {}#{}: {}").format(f, c.id, c.path))
-                    if c.data[-1][-1] != "\n":
-                        raise CGError(_("Data does not end in a newline in {}#{}").format(f, c.id))
-                except AttributeError as err:
-                    raise CGError(_("Missing item in {}#{}: {}").format(f, c.id, err))
-            print_msg(2, _("Loaded module {} ({} coteries)").format(f_path, len(module.coteries)))
-            module.elected = True  # selecting a subset of modules is not yet implemented
+            entry, content = cache.entry(f_path)
+            if entry.get("metadata") is None:
+                if content is None:
+                    content = cache.read(f_path)
+                entry["metadata"] = Coteries._parse_metadata(f, content)
+            names = {f[0 : -len(".coterie")], entry["metadata"]["display_name"]}
+            unknown -= names
+            if modules is not None and len(names & set(modules)) == 0:
+                module = Coteries.CoterieModule()
+                module.__dict__.update(entry["metadata"])
+                module.coteries = list()
+                module.elected = False
+                print_msg(2, _("Skipped module {} (not elected)").format(f_path))
+                self.modules.append(module)
+                continue
+            module = cache.module(entry)
+            if module is None:
+                if content is None:
+                    content = cache.read(f_path)
+                module = Coteries._parse_module(f, content)
+                cache.store_module(entry, module)
+                print_msg(
+                    2, _("Loaded module {} ({} coteries)").format(f_path, len(module.coteries))
+                )
+            else:
+                print_msg(
+                    2,
+                    _("Loaded module {} ({} coteries, cached)").format(
+                        f_path, len(module.coteries)
+                    ),
+                )
+            module.elected = True
             self.modules.append(module)
+        cache.save()
+        if len(unknown) > 0:
+            raise CGError(_("Unknown coterie module: {}").format(", ".join(sorted(unknown))))
         return self
 
+    @staticmethod
+    def _check_metadata(f, module):
+        valid_display_name_re = re.compile(r"[^\t\r\n]+$")
+        try:
+            if module.module_type not in Coteries.valid_module_types:
+                raise CGError(_("Invalid module_type in {}: {}").format(f, module.module_type))
+            if module.vpn_type not in Coteries.valid_vpn_types:
+                raise CGError(_("Invalid vpn_type in {}: {}").format(f, module.vpn_type))
+            if not valid_display_name_re.match(module.display_name):
+                raise CGError(_("Invalid display_name in {}: {}").format(f, module.display_name))
+        except AttributeError as err:
+            raise CGError(_("Missing item in {}: {}").format(f, err))
+
+    @staticmethod
+    def _parse_metadata(f, content):
+        """Return the metadata of a coterie module, parsing only the part before 'coteries:'"""
+        text = content.decode()
+        end = text.find("\ncoteries:")
+        try:
+            module = yaml.safe_load(text if end < 0 else text[0 : end + 1])
+        except (yaml.YAMLError, yaml.constructor.ConstructorError) as yaml_err:
+            raise CGError(_("Error parsing {}: {}").format(f, yaml_err))
+        Coteries._check_metadata(f, module)
+        return {k: getattr(module, k) for k in ("module_type", "vpn_type", "display_name")}
+
+    @staticmethod
+    def _parse_module(f, content):
+        """Parse and validate a complete coterie module"""
+        valid_id_re = re.compile(r"[a-zA-Z0-9\._-]+$")
+        try:
+            module = yaml.safe_load(content.decode())
+        except (yaml.YAMLError, yaml.constructor.ConstructorError) as yaml_err:
+            raise CGError(_("Error parsing {}: {}").format(f, yaml_err))
+        Coteries._check_metadata(f, module)
+        sort_max = 0
+        deltas = set()  # an id may appear more than once, for migrations between versions
+        for c in module.coteries:
+            try:
+                if not valid_id_re.match(c.id):
+                    raise CGError(_("Invalid id in {}: {}").format(f, c.id))
+                if (c.id, c.delta) in deltas:
+                    raise CGError(_("Duplicate id in {}: {}").format(f, c.id))
+                deltas.add((c.id, c.delta))
+            except AttributeError:
+                raise CGError(_("Missing id for a coterie in {}").format(f))
+            try:
+                if int(c.delta.split(" ")[0]) >= int(c.delta.split(" ")[1]):
+                    raise CGError(_("Invalid delta in {}#{}: {}").format(f, c.id, c.delta))
+                if c.sort < sort_max:
+                    raise CGError(_("Coterie {}#{} is not in sort order").format(f, c.id))
+                sort_max = c.sort
+                if c.type not in Coteries.valid_types:
+                    raise CGError(_("Invalid type in {}#{}: {}").format(f, c.id, c.type))
+                if c.type == "file" and c.path[0] != "/":
+                    raise CGError(_("Invalid path in {}#{}: {}").format(f, c.id, c.path))
+                if c.type == "packages":
+                    try:
+                        PackageCache.parse(c.data)
+                    except ValueError as err:
+                        raise CGError(_("Invalid package in {}#{}: {}").format(f, c.id, err))
+                if not isinstance(getattr(c, "reapply", True), bool):
+                    raise CGError(_("Invalid reapply in {}#{}").format(f, c.id))
+                if c.data[-1][-1] != "\n":
+                    raise CGError(_("Data does not end in a newline in {}#{}").format(f, c.id))
+                for item in ("after", "resources"):
+                    value = getattr(c, item, list())
+                    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                        raise CGError(_("Invalid {} in {}#{}").format(item, f, c.id))
+            except AttributeError as err:
+                raise CGError(_("Missing item in {}#{}: {}").format(f, c.id, err))
+        return module
+
     def elected_coteries(self):
         """Return a list of coteries from all elected modules"""
         coteries_from_elected_modules = list()
         for m in self.modules:
             if m.elected:
                 coteries_from_elected_modules += m.coteries
-        ids = set()
+        deltas = set()
         for c in coteries_from_elected_modules:  # be certain we have no duplicate IDs here
-            if c.id in ids:
+            if (c.id, c.delta) in deltas:
                 raise CGError(_("Duplicate coterie id {}").format(c.id))
+            deltas.add((c.id, c.delta))
+        elected = sorted(coteries_from_elected_modules, key=lambda c: c.sort)
+        version_from = dict()  # of the last coterie with each id
+        for c in elected:  # migrations are applied in the order listed
+            if c.versions()[0] < version_from.get(c.id, 0):
+                raise CGError(_("Migrations of coterie {} are not in version order").format(c.id))
+            version_from[c.id] = c.versions()[0]
+        ids = set()
+        for c in elected:  # 'after' may only name coteries which come earlier
+            for a in getattr(c, "after", list()):
+                if a not in ids:
+                    raise CGError(
+                        _("Coterie {} must come after unknown coterie {}").format(c.id, a)
+                    )
             ids.add(c.id)
-        return sorted(coteries_from_elected_modules, key=lambda c: c.sort)
+        return elected
 
 
-def do_router_set_up():
-    coteries = Coteries.load()
+def do_router_set_up(channels: int, cidrs=None, modules=None) -> None:
+    KeyPool.refill_in_background()  # while searching for the router
+    with trace("load_coteries", "phase"):
+        coteries = Coteries.load(modules)
     elected = coteries.elected_coteries()
     conf = ConfigSaver.load()
     try:
         factory_wifi = next((c.data for c in elected if c.type == "factory_wifi"), None)
         ssid, ssid_password = wifi_hunt(conf, factory_wifi)
-        router = network_hunt(conf, ssid)
+        router = network_hunt(conf, ssid, cidrs)
     except:  # noqa: E722
         ConfigSaver.save(conf)
         raise
     try:
-        for c in elected:
-            c.exec(router)
+        with trace("apply_coteries", "phase", router=router):
+            Coteries.exec_scheduled(elected, router, channels)
         print_msg(1, _("Set-up successful"))
     finally:
         router.close()  # docs emphasize importance of closing Paramiko client
         ConfigSaver.save(conf)
 
 
-def do_shell(verbosity: int) -> None:
-    """Execute shell commands on the router. This is mostly for testing and as example code."""
+def set_up_one_router(conf, router, elected, verbosity: int, channels: int) -> None:
+    """Apply coteries to one router of a fleet; runs in a worker thread. A router which is not
+    yet in conf is added once its routerauth coterie has been applied: its password is then
+    ours, so must be kept even if a later coterie fails."""
+    _output.verbose = verbosity
+    _output.prefix = "[{}] ".format(router.ip)
+    try:
+        with trace("apply_coteries", "phase", router=router):
+            Coteries.exec_scheduled(elected, router, channels)
+    finally:
+        router.close()  # docs emphasize importance of closing Paramiko client
+        with ConfigSaver.lock:
+            if "routerauth" in router.version_map and router not in conf.routers:
+                conf.routers.append(router)
+        ConfigSaver.save(conf)
+
+
+def fleet_eligible(routers):
+    """Return the routers which may be set up by 'fleet': those already in the configuration
+    with a password, and those in factory state, with telnet open or an ssh server which lets
+    root log in with no authentication. Print why each of the others is skipped."""
+    unknown = [r for r in routers if not r.router_password and 23 not in r._open_ports]
+
+    def probe(r):
+        with trace("ssh_auth_none", "probe", router=r.ip):
+            return ssh_auth_none(r.ip, r.ssh_port, timeout=PROBE_TIMEOUT)
+
+    with trace("ssh_auth_none", "phase", count=len(unknown)):
+        results = probe_concurrently(probe, unknown, PROBE_TIMEOUT)
+    open_logins = [r for r, ok in zip(unknown, results) if ok]
+    eligible = list()
+    for r in routers:
+        if r.router_password or 23 in r._open_ports or r in open_logins:
+            eligible.append(r)
+        else:
+            print_msg(
+                1,
+                _("Skipping {} (ip {}): not a router in factory state").format(r.nickname, r.ip),
+            )
+    return eligible
+
+
+def do_fleet_set_up(verbosity: int, workers: int, channels: int, cidrs=None, modules=None) -> None:
+    """Set up every router found on 'cidrs', several routers at a time. Hosts are set up only if
+    they are known routers, or in factory state (see fleet_eligible()). Routers are saved to
+    the configuration once their password has been set."""
+    KeyPool.refill_in_background()  # while searching for routers
+    with trace("load_coteries", "phase"):
+        coteries = Coteries.load(modules)
+    elected = coteries.elected_coteries()
     conf = ConfigSaver.load()
-    ssid, ssid_password = wifi_hunt(conf)
-    router = network_hunt(conf, ssid)
     try:
-        router.connect_ssh()
-        if verbosity > 1:
-            global verbose
-            verbose = 1  # reduce verbosity for shell processing
-        cmd = ""
-        while cmd != "exit":
+        routers = [r for r in router_candidates(conf, cidrs) if r.ssh_hostkey is not None]
+        routers = fleet_eligible(routers)
+        if len(routers) == 0:
+            raise CGError(_("No possible routers found"))
+        for r in routers:
+            adopt_router(conf, r, ssid=None, add=False)  # found via wired LAN, not WiFi
+            print_msg(1, _("Using router {} (ip {})").format(r.nickname, r.ip))
+    except:  # noqa: E722
+        ConfigSaver.save(conf)
+        raise
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(set_up_one_router, conf, r, elected, verbosity, channels)
+            for r in routers
+        ]
+        for r, f in zip(routers, futures):  # report in discovery order
             try:
-                cmd = input("router> ")
-            except (EOFError, KeyboardInterrupt):
-                cmd = "exit"
-            if cmd == "":
-                continue
+                f.result()
+                print_msg(1, _("Set-up successful for {} (ip {})").format(r.nickname, r.ip))
+            except (CGError, OSError, EOFError, paramiko.ssh_exception.SSHException) as err:
+                failures += 1
+                reason = str(err) or type(err).__name__  # e.g. EOFError has no message
+                print_msg(
+                    0, _("Set-up failed for {} (ip {}): {}").format(r.nickname, r.ip, reason)
+                )
+    if failures > 0:
+        raise CGError(_("Set-up failed on {} of {} routers").format(failures, len(routers)))
+
+
+def do_update(verbosity: int, workers: int, channels: int, modules=None) -> None:
+    """Bring every router in the configuration up to date with the elected coteries, several
+    routers at a time. Only routers which were set up (routerauth applied, so they have a
+    password of ours) are updated. Routers are reached at their last known IP address, with
+    no WiFi or network search. Migration plans are worked out once for each distinct set of
+    coterie versions, and shared by the routers which have it."""
+    with trace("load_coteries", "phase"):
+        coteries = Coteries.load(modules)
+    elected = coteries.elected_coteries()
+    conf = ConfigSaver.load()
+    plans = dict()  # tuple of (id, delta) to apply: routers
+    for r in conf.routers:
+        if (
+            getattr(r, "ssh_hostkey", None) is None
+            or "routerauth" not in getattr(r, "version_map", dict())
+            or getattr(r, "router_password", None) is None
+        ):
+            print_msg(1, _("Skipping {} (ip {}): not set up").format(r.nickname, r.ip))
+            continue
+        steps = tuple((c.id, c.delta) for c in Coteries.pending(elected, r))
+        plans.setdefault(steps, list()).append(r)
+    routers = list()
+    for steps, group in plans.items():
+        names = ", ".join(r.nickname for r in group)
+        if len(steps) == 0:
+            print_msg(1, _("Up to date: {}").format(names))
+            continue
+        print_msg(
+            1,
+            _("Plan for {}: {}").format(names, ", ".join("{} {}".format(*d) for d in steps)),
+        )
+        routers += group
+    if len(routers) == 0:
+        return
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(set_up_one_router, conf, r, elected, verbosity, channels)
+            for r in routers
+        ]
+        for r, f in zip(routers, futures):
             try:
-                print(router.exec(cmd).rstrip())
-            except RemoteExecutionError as err:
-                print(err)
+                f.result()
+                print_msg(1, _("Update successful for {} (ip {})").format(r.nickname, r.ip))
+            except (CGError, OSError, EOFError, paramiko.ssh_exception.SSHException) as err:
+                failures += 1
+                reason = str(err) or type(err).__name__  # e.g. EOFError has no message
+                print_msg(
+                    0, _("Update failed for {} (ip {}): {}").format(r.nickname, r.ip, reason)
+                )
+    if failures > 0:
+        raise CGError(_("Update failed on {} of {} routers").format(failures, len(routers)))
+
+
+def do_shell(verbosity: int, cidrs=None) -> None:
+    """Execute shell commands on the router. This is mostly for testing and as example code.
+    From a terminal, this is an interactive shell on the router. Otherwise, commands are read
+    from stdin, one per line, and sent to the router as one script; the exit status of each
+    command which fails is reported. Unless 'cidrs' is given, a known router which answers at
+    its last IP address is used without searching for one."""
+    conf = ConfigSaver.load()
+    router = known_router(conf) if cidrs is None else None
+    if router is None:
+        ssid, ssid_password = wifi_hunt(conf)
+        router = network_hunt(conf, ssid, cidrs)
+    interactive = sys.stdin.isatty()
+    try:
+        router.connect_ssh(use_broker=not interactive)  # the broker cannot relay a terminal
+        if verbosity > 1:
+            _output.verbose = 1  # reduce verbosity for shell processing
+        if interactive:
+            channel = router.open_shell()
+            try:
+                relay_terminal(channel)
+            finally:
+                channel.close()
+            return
+        commands = [(line, True) for line in sys.stdin.read().splitlines() if line.strip()]
+        results = router.exec_batch(commands)
+        failed = 0
+        for (command, __), (exitc, out, err) in zip(commands, results):
+            print(out, end="", flush=True)
+            print(err, end="", file=sys.stderr, flush=True)
+            if exitc != 0:
+                failed += 1
+                print(_("Exit status {}: {}").format(exitc, command), file=sys.stderr)
+        if len(results) < len(commands):
+            raise CGError(
+                _("Connection lost after {} of {} commands").format(len(results), len(commands))
+            )
+        if failed > 0:
+            raise CGError(_("{} of {} commands failed").format(failed, len(commands)))
     finally:
         router.close()  # docs emphasize importance of closing Paramiko client
 
 
+def relay_terminal(channel):
+    """Connect our terminal to 'channel', a shell with a pseudo-terminal, until either side
+    closes. Keys are sent as they are typed and output is shown as it arrives."""
+    stdin_fd = sys.stdin.fileno()
+    saved_mode = termios.tcgetattr(stdin_fd)
+
+    def resize(signum, frame):
+        size = os.get_terminal_size(sys.stdout.fileno())
+        channel.resize_pty(width=size.columns, height=size.lines)
+
+    saved_handler = signal.signal(signal.SIGWINCH, resize)
+    try:
+        tty.setraw(stdin_fd)  # e.g. Ctrl-C and Tab go to the router's shell
+        while True:
+            readable, __, __ = select.select([channel, stdin_fd], [], [])
+            if channel in readable:
+                data = channel.recv(STREAM_CHUNK)
+                if len(data) == 0:
+                    break
+                sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+            if stdin_fd in readable:
+                data = os.read(stdin_fd, STREAM_CHUNK)
+                if len(data) == 0:
+                    break
+                channel.sendall(data)
+    finally:
+        termios.tcsetattr(stdin_fd, termios.TCSADRAIN, saved_mode)
+        signal.signal(signal.SIGWINCH, saved_handler)
+
+
+class SimulatedRouter:
+    """
+    Local stand-in for a factory-reset OpenWrt router, for benchmark-provision. It has:
+
+    * an ssh server (paramiko) accepting auth-none (if 'auth_none' is set), password and public
+      key logins for 'root', with exec requests and SCP uploads
+    * a telnet server with OpenWrt's login-free root prompt
+    * a fake shell with a small in-memory file system, which understands the scripts built by
+      batch_script() and Router.put_bundle() and waits 'latency' seconds for each command
+    * a 'reboot' command, which drops all ssh connections and, for 'boot_time' seconds,
+      accepts TCP connections without answering them, as dropbear does not yet run
+    * remote port forwarding, as used by PackageCache's tunnel, and an opkg feed on a local
+      HTTP server; the script from PackageCache.install_script() which uses the cache
+      downloads the package list and the packages through the tunnel, as opkg would
+
+    The password and key set by the routerauth coterie are used for later logins, as on a real
+    router. Connections, round trips and bytes of commands, files and output are counted.
+    """
+
+    prompt = "\r\nroot@GL-AR300M:/# "
+    eof_timeout = 5.0  # seconds to wait for a client's EOF before closing an exec channel
+    arch = "mips_24kc"
+    canned = [  # (command regex, stdout) for commands which are not emulated
+        (r"uname\b", "Linux GL-AR300M 4.14.95 #0 Fri Feb 14 15:36:01 2020 mips GNU/Linux\n"),
+        (r"uci get wireless\.@wifi-iface\[0\]\.key$", "goodlife\n"),
+        (r"opkg print-architecture$", "arch all 1\narch noarch 1\narch {} 10\n".format(arch)),
+    ]
+    feed_packages = ["kmod-ipt-filter", "iptables-mod-filter", "openvpn-openssl"]
+    feed_path = "/releases/19.07.7/packages/{}/base".format(arch)
+
+    def __init__(self, latency=0.0, auth_none=False, boot_time=0.5):
+        self.latency = latency
+        self.auth_none = auth_none
+        self.boot_time = boot_time
+        self.booted = time.monotonic()  # ssh connections are dropped until then
+        self.feed = SimulatedRouter._feed()
+        sim = self
+
+        class FeedHandler(http_server.BaseHTTPRequestHandler):
+            def do_GET(self):  # noqa: N802 (name is set by http.server)
+                data = sim.feed.get(self.path)
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        class FeedServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+            daemon_threads = True
+
+        self.feed_server = FeedServer(("127.0.0.1", 0), FeedHandler)
+        self.forwards = dict()  # port: listening socket, for each remote port forward
+        self.files = {
+            "/etc/openwrt_release": (
+                "DISTRIB_ID='OpenWrt'\nDISTRIB_RELEASE='19.07.7'\nDISTRIB_ARCH='mips_24kc'\n"
+            ),
+            "/etc/openwrt_version": "r11306-c4a6851c72\n",  # a revision, as since 18.06
+            "/etc/opkg.conf": "dest root /\ndest ram /tmp\nlists_dir ext /var/opkg-lists\n",
+            "/etc/opkg/distfeeds.conf": "src/gz openwrt_base http://127.0.0.1:{}{}\n".format(
+                self.feed_server.server_address[1], SimulatedRouter.feed_path
+            ),
+            "/etc/shadow": "root::0:0:99999:7:::\ndaemon:*:0:0:99999:7:::\n",
+            "/etc/dropbear/authorized_keys": "",
+            BOOT_ID_PATH: str(uuid.uuid4()) + "\n",
+        }
+        self.lock = threading.Lock()  # protects 'files' and the counters below
+        self.connections = 0
+        self.round_trips = 0
+        self.bytes = 0
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.transports = list()
+        # Server-side errors (e.g. ssh_keyscan() disconnecting) are expected; don't print them
+        logging.getLogger("cleargopher.simulated").addHandler(logging.NullHandler())
+        logging.getLogger("cleargopher.simulated").propagate = False
+        self.ssh_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.ssh_sock.bind(("127.0.0.1", 0))
+        self.ssh_sock.listen(8)
+
+        class TelnetHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                sim.count(connections=1)
+                banner = "\r\nBusyBox v1.30.1 () built-in shell (ash)\r\n"
+                self.wfile.write((banner + SimulatedRouter.prompt).encode())
+                for line in self.rfile:
+                    command = line.decode(errors="replace").strip()
+                    if command == "exit":
+                        break
+                    received = len(line)
+                    heredoc = re.fullmatch(r"sh <<'(\S+)'; echo \"(\S+) \$\?\"", command)
+                    if heredoc:  # from Router.set_password_on_router()
+                        body = ""
+                        for line in self.rfile:
+                            received += len(line)
+                            if line.decode(errors="replace").strip() == heredoc[1]:
+                                break
+                            body += line.decode(errors="replace")
+                        exitc, out, err = sim.shell(body)
+                        out += "{} {}\n".format(heredoc[2], exitc)
+                    else:
+                        __, out, err = sim.shell(command)
+                    reply = (out + err).replace("\n", "\r\n") + SimulatedRouter.prompt
+                    sim.count(round_trips=1, data=received + len(reply))
+                    self.wfile.write(reply.encode())
+
+        class TelnetServer(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+
+        self.telnet = TelnetServer(("127.0.0.1", 0), TelnetHandler)
+
+    @property
+    def ssh_port(self):
+        return self.ssh_sock.getsockname()[1]
+
+    @property
+    def telnet_port(self):
+        return self.telnet.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._accept_ssh, daemon=True).start()
+        threading.Thread(target=self.telnet.serve_forever, daemon=True).start()
+        threading.Thread(target=self.feed_server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.ssh_sock.close()
+        self.telnet.shutdown()
+        self.telnet.server_close()
+        self.feed_server.shutdown()
+        self.feed_server.server_close()
+        self._close_forwards()
+        for t in self.transports:
+            t.close()
+
+    @staticmethod
+    def _feed():
+        """Return the files of an opkg feed with 'feed_packages', as {URL path: bytes}"""
+        feed = dict()
+        index = ""
+        for name in SimulatedRouter.feed_packages:
+            filename = "{}_1.0-1_{}.ipk".format(name, SimulatedRouter.arch)
+            data = sha256(name.encode()).digest() * 128  # 4 KiB stands in for the package
+            feed[SimulatedRouter.feed_path + "/" + filename] = data
+            index += "Package: {}\nVersion: 1.0-1\nFilename: {}\nSize: {}\n\n".format(
+                name, filename, len(data)
+            )
+        feed[SimulatedRouter.feed_path + "/Packages.gz"] = gzip.compress(index.encode())
+        return feed
+
+    def count(self, connections=0, round_trips=0, data=0):
+        with self.lock:
+            self.connections += connections
+            self.round_trips += round_trips
+            self.bytes += data
+
+    def read(self, path):
+        with self.lock:
+            return self.files.get(path)
+
+    def write(self, path, text, append=False):
+        with self.lock:
+            self.files[path] = (self.files.get(path, "") if append else "") + text
+
+    def _accept_ssh(self):
+        while True:
+            try:
+                conn, __ = self.ssh_sock.accept()
+            except OSError:  # closed by stop()
+                return
+            threading.Thread(target=self._serve_ssh, args=(conn,), daemon=True).start()
+
+    def _serve_ssh(self, conn):
+        if time.monotonic() < self.booted:
+            conn.close()
+            return
+        self.count(connections=1)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        transport.set_log_channel("cleargopher.simulated")
+        self.transports.append(transport)
+        try:
+            transport.start_server(server=self._ssh_server(transport))
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+            transport.close()  # e.g. from ssh_keyscan(), which disconnects after key exchange
+
+    def _root_hash(self):
+        for line in self.read("/etc/shadow").splitlines():
+            if line.startswith("root:"):
+                return line.split(":")[1]
+        return "*"
+
+    def _ssh_server(self, transport):
+        sim = self
+
+        class Server(paramiko.ServerInterface):  # defined here so paramiko is imported lazily
+            def get_allowed_auths(self, username):
+                return "publickey,password"
+
+            def check_auth_none(self, username):
+                # Like dropbear, only allow an empty password if explicitly enabled
+                if username == "root" and sim.auth_none and sim._root_hash() == "":
+                    return paramiko.AUTH_SUCCESSFUL
+                return paramiko.AUTH_FAILED
+
+            def check_auth_password(self, username, password):
+                hashed = sim._root_hash()
+                if username == "root" and hashed not in ["", "*"]:
+                    if crypt.crypt(password, hashed) == hashed:
+                        return paramiko.AUTH_SUCCESSFUL
+                return paramiko.AUTH_FAILED
+
+            def check_auth_publickey(self, username, key):
+                authorized = sim.read("/etc/dropbear/authorized_keys").splitlines()
+                if username == "root" and key.get_name() + " " + key.get_base64() in authorized:
+                    return paramiko.AUTH_SUCCESSFUL
+                return paramiko.AUTH_FAILED
+
+            def check_channel_request(self, kind, chanid):
+                if kind == "session":
+                    return paramiko.OPEN_SUCCEEDED
+                return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+            def check_channel_exec_request(self, channel, command):
+                command = command.decode(errors="replace")
+                threading.Thread(target=sim._exec, args=(channel, command), daemon=True).start()
+                return True
+
+            def check_port_forward_request(self, address, port):
+                return sim._forward(transport, port)
+
+            def cancel_port_forward_request(self, address, port):
+                sim._close_forwards([port])
+
+        return Server()
+
+    def _forward(self, transport, port):
+        """Listen on 'port' on the loopback interface (any free port if 0) and forward each
+        connection to the client of 'transport', as dropbear does for 'ssh -R'. Return the
+        port, or False if it is in use."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(("127.0.0.1", port))
+        except OSError:
+            listener.close()
+            return False
+        listener.listen(8)
+        port = listener.getsockname()[1]
+        with self.lock:
+            self.forwards[port] = listener
+
+        def accept():
+            while True:
+                try:
+                    conn, origin = listener.accept()
+                except OSError:  # closed by _close_forwards()
+                    return
+                threading.Thread(
+                    target=self._forward_connection,
+                    args=(transport, conn, origin, port),
+                    daemon=True,
+                ).start()
+
+        threading.Thread(target=accept, daemon=True).start()
+        return port
+
+    def _forward_connection(self, transport, conn, origin, port):
+        with conn:
+            try:
+                channel = transport.open_forwarded_tcpip_channel(origin, ("127.0.0.1", port))
+            except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+                return
+            self.count(round_trips=1, data=relay_channel(conn, channel))
+
+    def _close_forwards(self, ports=None):
+        """Stop forwarding 'ports' (default: all)"""
+        with self.lock:
+            listeners = [self.forwards.pop(p) for p in list(ports or self.forwards)]
+        for listener in listeners:
+            try:
+                listener.shutdown(socket.SHUT_RDWR)  # wakes accept(), which close() does not
+            except OSError:
+                pass
+            listener.close()
+
+    def _exec(self, channel, command):
+        try:
+            if command.startswith("scp -t "):
+                self._scp_sink(channel, shlex.split(command)[-1])
+                return
+            stdin_data = b""
+            if "tar -xzf -" in command:  # archive from Router.put_bundle()
+                while True:
+                    chunk = channel.recv(65536)
+                    if len(chunk) == 0:
+                        break
+                    stdin_data += chunk
+            exitc, out, err = self.shell(command, stdin_data)
+            self.count(round_trips=1, data=len(command) + len(stdin_data) + len(out) + len(err))
+            channel.sendall(out.encode())
+            channel.sendall_stderr(err.encode())
+            channel.send_exit_status(exitc)
+        except (paramiko.ssh_exception.SSHException, EOFError, OSError):
+            pass
+        finally:
+            # Paramiko answers the exec request in its own thread after
+            # check_channel_exec_request() returns, so this thread can get here first. Closing
+            # the channel before the answer is sent makes the client's exec_command() fail with
+            # 'Channel closed'. Clients send EOF (or close) only after the answer arrives, so
+            # read stdin until then, as a real ssh server would.
+            channel.settimeout(SimulatedRouter.eof_timeout)
+            try:
+                while len(channel.recv(65536)) > 0:
+                    pass
+            except OSError:  # including socket.timeout
+                pass
+            channel.close()
+
+    def _scp_sink(self, channel, path):
+        """Receive files as 'scp -t' does"""
+        stream = channel.makefile("rb")
+        channel.sendall(b"\0")
+        while True:
+            header = stream.readline()
+            if len(header) == 0:
+                break
+            if header.startswith(b"C"):  # C<mode> <size> <name>
+                size = int(header.split(b" ")[1])
+                channel.sendall(b"\0")
+                data = stream.read(size)
+                stream.read(1)  # terminating NUL
+                self.write(path, data.decode(errors="replace"))
+                self.count(round_trips=1, data=len(header) + size)
+            channel.sendall(b"\0")  # times, directories need only an acknowledgement
+        channel.send_exit_status(0)
+
+    def shell(self, script, stdin_data=b""):
+        """Run a script in the fake shell; return a tuple (exit status, stdout, stderr)"""
+        if "\n__cg_rc=$?\n" in script:
+            return self._batch(script)
+        if "tar -xzf -" in script:
+            return self._bundle(script, stdin_data)
+        if "opkg -f /tmp/cg-opkg.conf" in script:
+            return self._cached_install(script)
+        exitc, out, err = 0, "", ""
+        for line in script.splitlines():
+            if line.strip() == "exit":
+                break
+            exitc, line_out, line_err = self._command(line)
+            out += line_out
+            err += line_err
+        return exitc, out, err
+
+    def _batch(self, script):
+        """Run a script from batch_script()"""
+        lines = script.split("\n")
+        exitc, out, err = 0, "", ""
+        i = 0
+        while i < len(lines):
+            if lines[i] == "{ :":
+                end = next(
+                    k
+                    for k in range(i + 1, len(lines) - 1)
+                    if lines[k] == "}" and lines[k + 1] == "__cg_rc=$?"
+                )
+                exitc, cmd_out, cmd_err = self.shell("\n".join(lines[i + 1 : end]))
+                out += cmd_out
+                err += cmd_err
+                i = end + 2
+                continue
+            match = re.fullmatch(r"printf '\\n%s %d %d\\n' (\S+) (\d+) \$__cg_rc", lines[i])
+            if match:
+                out += "\n{} {} {}\n".format(match[1], match[2], exitc)
+            match = re.fullmatch(r"printf '\\n%s %d\\n' (\S+) (\d+) >&2", lines[i])
+            if match:
+                err += "\n{} {}\n".format(match[1], match[2])
+            if lines[i] == "[ $__cg_rc -eq 0 ] || exit $__cg_rc" and exitc != 0:
+                break
+            i += 1
+        return exitc, out, err
+
+    def _bundle(self, script, stdin_data):
+        """Run a script from Router.put_bundle(), with its archive"""
+        time.sleep(self.latency)
+        checksums = {n: c for c, n in re.findall(r'echo "([0-9a-f]{64})  \$d/(\d+)"', script)}
+        targets = dict()
+        for n, staged in re.findall(r'else cp "\$d/(\d+)" (.+?) && chmod', script):
+            targets[n] = shlex.split(staged)[0][0 : -len(".cg-new")]
+        files = list()
+        with tarfile.open(fileobj=io.BytesIO(stdin_data), mode="r:gz") as tar:
+            for member in tar.getmembers():
+                data = tar.extractfile(member).read()
+                if sha256(data).hexdigest() != checksums[member.name]:
+                    return 1, "", "sha256sum: WARNING: 1 computed checksum did NOT match\n"
+                files.append((targets[member.name], data.decode(errors="replace")))
+        for path, text in files:
+            self.write(path, text)
+        return 0, "", ""
+
+    def _cached_install(self, script):
+        """Run a script from PackageCache.install_script() which uses the package cache: fetch
+        each feed's package list, then the packages, through the forwarded port, as opkg
+        would. Unlike the script, don't then install directly if that fails, so that a broken
+        cache shows in benchmark-provision."""
+        time.sleep(self.latency)
+        port = re.search(r"http://127\.0\.0\.1:(\d+)/\$DISTRIB_RELEASE/", script)[1]
+        packages = shlex.split(re.search(r"^pkgs=(.*)$", script, re.MULTILINE)[1])[0].split()
+        release = re.match(r"[0-9]*", self.read("/etc/openwrt_version"))[0]
+        for negate, older_than, package in re.findall(
+            r'^if (! )?\[ "\$release" -lt (\d+) \] ; then pkgs="\$pkgs (\S+)" ; fi$',
+            script,
+            re.MULTILINE,
+        ):
+            if (release != "" and int(release) < int(older_than)) != (negate != ""):
+                packages.append(package)
+        release = re.search(r"DISTRIB_RELEASE='(.*)'", self.read("/etc/openwrt_release"))[1]
+        opener = urllib_request.build_opener(urllib_request.ProxyHandler({}))
+        urls = dict()  # package: URL via the cache
+        out = ""
+        try:
+            for line in self.read("/etc/opkg/distfeeds.conf").splitlines():
+                __, name, url = line.split(" ")
+                feed = "http://127.0.0.1:{}/{}/{}/{}".format(
+                    port, release, SimulatedRouter.arch, url.replace("://", "/", 1)
+                )
+                with opener.open(feed + "/Packages.gz", timeout=PACKAGE_FETCH_TIMEOUT) as reply:
+                    index = gzip.decompress(reply.read()).decode()
+                out += "Downloading {}/Packages.gz\n".format(url)
+                out += "Updated list of available packages in /var/opkg-lists/{}\n".format(name)
+                for package, filename in re.findall(
+                    r"^Package: (\S+)\n(?:.+\n)*?Filename: (\S+)$", index, re.MULTILINE
+                ):
+                    urls.setdefault(package, feed + "/" + filename)
+            for package in packages:
+                if package not in urls:
+                    err = " * opkg_install_cmd: Cannot install package {}.\n".format(package)
+                    return 255, out, "Collected errors:\n" + err
+                with opener.open(urls[package], timeout=PACKAGE_FETCH_TIMEOUT) as reply:
+                    reply.read()
+                out += "Installing {} (1.0-1) to root...\nConfiguring {}.\n".format(
+                    package, package
+                )
+                self.write(
+                    "/usr/lib/opkg/status",
+                    "Package: {}\nStatus: install user installed\n\n".format(package),
+                    append=True,
+                )
+        except OSError as err:  # including urllib's URLError and HTTPError
+            return 255, out, "Collected errors:\n * {}\n".format(err)
+        return 0, out, ""
+
+    def _command(self, line):
+        """Run one command line; return a tuple (exit status, stdout, stderr)"""
+        time.sleep(self.latency)
+        for pattern, output in SimulatedRouter.canned:
+            if re.match(pattern, line.strip()):
+                return 0, output, ""
+        quiet = line.rstrip().endswith(" 2>/dev/null")  # the only stderr redirect emulated
+        if quiet:
+            line = line.rstrip()[0 : -len(" 2>/dev/null")]
+        try:
+            lexer = shlex.shlex(line, posix=True, punctuation_chars=True)
+            lexer.whitespace_split = True
+            words = list(lexer)
+        except ValueError:  # e.g. unbalanced quotes
+            return 2, "", "sh: syntax error\n"
+        if len(words) == 0 or words[0].startswith("#"):
+            return 0, "", ""
+        if any(w in ["|", "||", "&&", ";", "&", "(", ")"] for w in words):
+            return 0, "", ""  # compound commands are not emulated
+        redirect = None
+        if len(words) >= 3 and words[-2] in [">", ">>"]:
+            redirect = (words[-1], words[-2] == ">>")
+            words = words[0:-2]
+        exitc, out, err = self._builtin(words)
+        if redirect is not None and exitc == 0:
+            self.write(redirect[0], out, append=redirect[1])
+            out = ""
+        return exitc, out, "" if quiet else err
+
+    def _builtin(self, words):
+        command, args = words[0], [a for a in words[1:] if not a.startswith("-")]
+        if command == "echo":
+            return 0, " ".join(words[1:]) + "\n", ""
+        if command == "false":
+            return 1, "", ""
+        if command == "cat":
+            with self.lock:
+                paths = [sorted(fnmatch.filter(self.files, a)) or [a] for a in args]
+            args = [path for matches in paths for path in matches]  # as the shell expands them
+            texts = [self.read(a) for a in args]
+            if None in texts:
+                return 1, "", "cat: can't open '{}'\n".format(args[texts.index(None)])
+            return 0, "".join(texts), ""
+        if command == "grep" and len(words) == 4 and words[1] == "-v":
+            text = self.read(words[3])
+            if text is None:
+                return 2, "", "grep: {}: No such file or directory\n".format(words[3])
+            kept = [line for line in text.splitlines(True) if not re.search(words[2], line)]
+            return (0 if len(kept) > 0 else 1), "".join(kept), ""
+        if command in ["mv", "cp"] and len(args) == 2:
+            text = self.read(args[0])
+            if text is None:
+                return 1, "", "{}: can't stat '{}'\n".format(command, args[0])
+            self.write(args[1], text)
+            if command == "mv":
+                with self.lock:
+                    del self.files[args[0]]
+            return 0, "", ""
+        if command == "rm":
+            with self.lock:
+                for a in args:
+                    self.files.pop(a, None)
+            return 0, "", ""
+        if command == "reboot":
+            self.write(BOOT_ID_PATH, str(uuid.uuid4()) + "\n")
+            threading.Timer(0.05, self._reboot).start()  # after the reply has been sent
+            return 0, "", ""
+        return 0, "", ""  # anything else succeeds silently
+
+    def _reboot(self):
+        self.booted = time.monotonic() + self.boot_time
+        self._close_forwards()
+        for t in self.transports:
+            t.close()
+
+
+def benchmark_provision(
+    latency, channels, baseline_path, save_baseline, tolerance, modules=None, broker=False
+) -> None:
+    """Provision a SimulatedRouter using the elected coteries and the same code as 'set-up',
+    then report time per phase, round trips and bytes. Results are compared to those saved
+    with --save-baseline (for the same latency and channels); a slowdown beyond 'tolerance'
+    (a fraction), or any increase in round trips or bytes, is an error. With 'broker', the
+    router is reached via a SessionBroker run in this process."""
+    tracing = Tracer.enabled  # i.e. a trace of the whole run was requested
+    if not tracing:
+        Tracer.enable()
+    coteries = Coteries.load(modules)
+    elected = coteries.elected_coteries()
+    sim = SimulatedRouter(latency=latency)
+    sim.start()
+    broker_server = None
+    if broker:
+        broker = SessionBroker(idle_timeout=60, max_connections=1)
+        broker_server = broker.start()
+    package_cache = tempfile.TemporaryDirectory()  # start cold, so results can be compared
+    PackageCache.directory = package_cache.name
+    first_span = len(Tracer.spans)
+    start = time.perf_counter()
+    try:
+        conf = Config()
+        conf.routers = list()
+        conf.default_vpn_username = "benchmark"
+        conf.default_vpn_password = "benchmark"
+        conf.default_vpn_server_host = "benchmark"
+        router = Router(ipaddress.ip_address("127.0.0.1"), "e4:95:6e:40:12:34")
+        router.ssh_port = sim.ssh_port
+        router.telnet_port = sim.telnet_port
+        adopt_router(conf, router, ssid=None)
+        with trace("apply_coteries", "phase", router=router):
+            Coteries.exec_scheduled(elected, router, channels)
+        router.close()
+    finally:
+        if broker_server is not None:
+            broker.stop(broker_server)
+        sim.stop()
+        PackageCache.directory = None
+        package_cache.cleanup()
+        Tracer.enabled = tracing
+    elapsed = time.perf_counter() - start
+    # Via a broker, packages may be installed without the cache, which the simulator lacks
+    packages = broker_server is None and any(c.type == "packages" for c in elected)
+    if sim.read("/etc/dropbear/authorized_keys") == "" or (
+        packages and sim.read("/usr/lib/opkg/status") is None
+    ):
+        raise CGError(_("Benchmark router was not provisioned"))
+    spans = [s for s in Tracer.spans[first_span:] if s["cat"] in ["phase", "coterie"]]
+    print(Tracer.summary(spans=spans))
+    result = {
+        "latency": latency,
+        "channels": channels,
+        "modules": modules,
+        "broker": broker_server is not None,
+        "seconds": round(elapsed, 3),
+        "connections": sim.connections,
+        "round_trips": sim.round_trips,
+        "bytes": sim.bytes,
+    }
+    print(
+        _("Total {seconds:.3f} s, {connections} connections, {round_trips} round trips, ").format(
+            **result
+        )
+        + _("{} bytes").format(result["bytes"])
+    )
+    if save_baseline:
+        with open(baseline_path, "w") as baseline_file:
+            json.dump(result, baseline_file, indent=4)
+        print_msg(1, _("Saved baseline to {}").format(baseline_path))
+        return
+    try:
+        with open(baseline_path, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+    except FileNotFoundError:
+        print_msg(1, _("No baseline to compare with; use --save-baseline to create one"))
+        return
+    if (
+        baseline["latency"],
+        baseline["channels"],
+        baseline.get("modules"),
+        baseline.get("broker", False),
+    ) != (latency, channels, modules, result["broker"]):
+        print_msg(
+            1,
+            _(
+                "Baseline is for different --latency, --channels, --module or --with-broker; "
+                "not compared"
+            ),
+        )
+        return
+    problems = list()
+    if elapsed > baseline["seconds"] * (1 + tolerance):
+        problems.append(
+            _("time {:.3f} s (baseline {:.3f} s)").format(elapsed, baseline["seconds"])
+        )
+    if sim.round_trips > baseline["round_trips"]:
+        problems.append(
+            _("round trips {} (baseline {})").format(sim.round_trips, baseline["round_trips"])
+        )
+    if sim.bytes > baseline["bytes"]:
+        problems.append(_("bytes {} (baseline {})").format(sim.bytes, baseline["bytes"]))
+    if len(problems) > 0:
+        raise CGError(_("Provisioning slower than baseline: {}").format("; ".join(problems)))
+    print_msg(1, _("Within baseline"))
+
+
+# Command lines run by 'startup-benchmark', in the sandbox described in startup_benchmark()
+startup_commands = {
+    "internal-tests": ["internal-tests"],
+    "export-config": ["export-config"],
+    "update": ["update"],
+    "shell": ["shell"],
+    "fleet": ["fleet", "--cidr", "192.0.2.1/32"],  # TEST-NET-1 address; nothing answers
+    "set-up": ["set-up", "--cidr", "192.0.2.1/32"],
+}
+
+
+def startup_benchmark() -> None:
+    """Measure the import cost of each command by running it with 'python -X importtime' in a
+    new process, so the modules counted are those the command really imports. Commands run in
+    a sandbox: a temporary home directory whose configuration has one up-to-date router, a
+    SimulatedRouter, which 'shell' finds at its last known IP, and a D-Bus system bus which
+    does not exist, so 'set-up' stops at its WiFi search. A command which fails is reported
+    with its error; its imports up to the failure are counted."""
+    our_path = Path(sys.argv[0]).resolve()
+    sim = SimulatedRouter()
+    sim.start()
+    try:
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home)
+            env["DBUS_SYSTEM_BUS_ADDRESS"] = "unix:path=" + os.path.join(home, "no-bus")
+            env.pop("DBUS_SESSION_BUS_ADDRESS", None)  # would add test_wifi_scan()
+            startup_sandbox(home, sim)
+            print(
+                "{:<16} {:>10} {:>10}  {}".format(
+                    _("command"), _("import ms"), _("wall ms"), _("top")
+                )
+            )
+            for command, command_line in startup_commands.items():
+                start = time.perf_counter()
+                result = subprocess.run(
+                    [sys.executable, "-X", "importtime", str(our_path)] + command_line,
+                    cwd=str(our_path.parent),
+                    env=env,
+                    input="uname -a\n",  # for 'shell'
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                )
+                wall_ms = (time.perf_counter() - start) * 1000
+                self_us = dict()  # module: microseconds spent importing the module itself
+                errors = list()
+                # Imports in other threads can split a line of output
+                lines = re.split(r"\n|(?=import time:)", result.stderr)
+                for line in lines:
+                    match = re.match(r"import time:\s+(\d+) \|\s+\d+ \| ( *)(\S+)", line)
+                    if match:
+                        self_us[match[3]] = self_us.get(match[3], 0) + int(match[1])
+                    elif not line.startswith("import time:") and line.strip():
+                        errors.append(line.strip())
+                top = sorted(self_us, key=lambda m: self_us[m], reverse=True)[0:3]
+                print(
+                    "{:<16} {:>10.1f} {:>10.1f}  {}".format(
+                        command,
+                        sum(self_us.values()) / 1000,
+                        wall_ms,
+                        ", ".join("{} {:.1f}".format(m, self_us[m] / 1000) for m in top),
+                    )
+                )
+                if result.returncode != 0:
+                    print(
+                        "{:<16} {}".format(
+                            "", _("exit {}: {}").format(result.returncode, (errors or [""])[-1])
+                        )
+                    )
+    finally:
+        sim.stop()
+
+
+def startup_sandbox(home, sim):
+    """Write a configuration for startup_benchmark() to 'home', with one router: 'sim', at the
+    newest version of every elected coterie"""
+    conf = Config()
+    conf.routers = list()
+    conf.default_vpn_username = "benchmark"
+    conf.default_vpn_password = "benchmark"
+    conf.default_vpn_server_host = "benchmark"
+    router = Router(ipaddress.ip_address("127.0.0.1"), "e4:95:6e:40:12:34")
+    router.ssh_port = sim.ssh_port
+    adopt_router(conf, router, ssid=None)
+    router.ip = str(router.ip)
+    sim.write("/etc/dropbear/authorized_keys", "".join(router.ssh_pubkey.split("\n")) + "\n")
+    for c in Coteries.load().elected_coteries():
+        router.version_map[c.id] = max(router.version_map.get(c.id, 0), c.versions()[1])
+    conf_dir = os.path.join(home, ".cleargopher")
+    os.mkdir(conf_dir, mode=0o700)
+    with open(os.path.join(conf_dir, "cleapher.conf"), "w") as conf_file:
+        conf_file.write(yaml.dump(ConfigSaver._snapshot(conf)))
+
+
+def test_wifi_scan(bus_address):
+    """Test wifi_scan() against a fake NetworkManager on the given (non-system) D-Bus"""
+    access_points = {"e4:95:6e:40:12:34": "GL-AR300M-234", "94:b8:6d:00:00:01": "neighbor"}
+
+    async def test():
+        service_bus = await dbus_next_aio.MessageBus(bus_address=bus_address).connect()
+        for path, interface in fake_network_manager(access_points, scan_seconds=0.2):
+            service_bus.export(path, interface)
+        await service_bus.request_name(NM_BUS_NAME)
+        try:
+            start = time.time()
+            macs_found = await wifi_scan(timeout=5, bus_address=bus_address)
+            return macs_found, time.time() - start
+        finally:
+            service_bus.disconnect()
+
+    loop = asyncio.new_event_loop()
+    try:
+        macs_found, seconds = loop.run_until_complete(test())
+    finally:
+        loop.close()
+    assert macs_found == access_points, macs_found
+    assert 0.2 <= seconds < 2, seconds  # completed via signal, not timeout
+
+
+def test_oui_index():
+    """Test OuiIndex with lines in the format of Wireshark's 'manuf' file"""
+    manuf = "\n".join(
+        [
+            "# This file was generated by running ./tools/make-manuf.py.",
+            "",
+            "00:00:0C\tCisco\tCisco Systems, Inc",
+            "08:00:87\tXyplexTe\tXyplex\t# terminal servers",
+            "00:1B:C5:00:00:00/36\tConverge\tConverging Systems Inc.",
+            "E4:95:6E:40:00:00/28\tGL\tGL.iNet",
+            "01:00:0C:CC:CC:CC\tCDP/VTP\t# Cisco Discovery Protocol",
+            "01-80-C2-00-00-00\tSpanning-tree-(for-bridges)",
+            "01:80:C2:00:00:30/45\tOAM-Multicast-DA-Class-1",
+            "01:00:5E:00:00:00/25\tIPv4mcast",
+            "33:33:00:00:00:00/16\tIPv6mcast",
+            "00:00:5E:00:01:00/40\tVRRP-(IPv4)",
+            "09:00:2B:01:00:00/32\tDEC-MUMPS",
+            "CF:00:00:00:00:00/12\tPPP-example",
+        ]
+    )
+    entries = OuiIndex.parse_manuf(manuf)
+    assert entries[(0x080087000000, 24)] == "Xyplex", entries
+    assert (0x01000CCCCCCC, 48) in entries and (0x01000C000000, 24) not in entries, entries
+    index = OuiIndex(OuiIndex.compile(entries))
+    assert index.lookup("08:00:87:12:34:56") == "Xyplex"
+    assert index.lookup("00-00-0C-CC-CC-CC") == "Cisco Systems, Inc"
+    assert index.lookup("01:00:0C:CC:CC:CC") == "CDP/VTP"
+    assert index.lookup("01:00:0C:CC:CC:CD") is None
+    assert index.lookup("01:80:C2:00:00:00") == "Spanning-tree-(for-bridges)"
+    assert index.lookup("01:80:C2:00:00:37") == "OAM-Multicast-DA-Class-1"
+    assert index.lookup("00:1B:C5:00:0F:FF") == "Converging Systems Inc."
+    assert index.lookup("CF:0A:BC:DE:F0:12") == "PPP-example"
+    assert len(index.prefix_lengths) == 10, index.prefix_lengths
+
+
 def parse_args() -> argparse.Namespace:
     # Optional arguments
     parser = argparse.ArgumentParser(description=_("Configures a router as a VPN client"))
@@ -919,6 +4725,117 @@ def parse_args() -> argparse.Namespace:
         dest="verbose",  # mapping: '-q'->0 / default->1 / '-v'->2 / '-vv'->3
         help=_("silence error messages"),
     )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=4,
+        help=_("number of routers to set up at the same time in fleet and update modes"),
+    )
+    parser.add_argument(
+        "--channels",
+        type=int,
+        default=1,
+        help=_("number of independent coteries to run at the same time on each router"),
+    )
+    parser.add_argument(
+        "--cidr",
+        action="append",
+        metavar="NETWORK",
+        help=_("network to scan for routers, e.g. 192.168.8.0/24 (may be repeated)"),
+    )
+    parser.add_argument(
+        "--module",
+        action="append",
+        metavar="NAME",
+        help=_("coterie module to use, by file or display name (may be repeated; default: all)"),
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=int,
+        default=600,
+        help=_("seconds before the connection broker closes an unused connection"),
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=16,
+        help=_("maximum number of connections kept open by the connection broker"),
+    )
+    parser.add_argument(
+        "--key-pool",
+        type=int,
+        default=KeyPool.size,
+        metavar="N",
+        help=_("number of pre-generated ssh keys of each type to keep (0 to disable)"),
+    )
+    parser.add_argument(
+        "--package-cache-size",
+        type=int,
+        default=PACKAGE_CACHE_MB,
+        metavar="MB",
+        help=_("size limit of the local cache of opkg packages"),
+    )
+    parser.add_argument(
+        "--reboot-deadline",
+        type=int,
+        default=REBOOT_DEADLINE,
+        metavar="SECONDS",
+        help=_("time allowed for a router to come back after a reboot coterie"),
+    )
+    parser.add_argument(
+        "--ed25519",
+        action="store_true",
+        help=_("use Ed25519 ssh keys on routers which support them"),
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help=_("record timed spans and write them to PATH as JSON lines"),
+    )
+    parser.add_argument(
+        "--chrome-trace",
+        metavar="PATH",
+        help=_("record timed spans and write them to PATH in Chrome trace event format"),
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help=_("print a table of where the time went at the end of the run"),
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=20,
+        metavar="MS",
+        help=_("simulated time for each router command in benchmark-provision"),
+    )
+    parser.add_argument(
+        "--baseline",
+        metavar="PATH",
+        help=_("results file for benchmark-provision to compare with"),
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help=_("save benchmark-provision results as the new baseline"),
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help=_("fraction by which benchmark-provision may exceed the baseline time"),
+    )
+    parser.add_argument(
+        "--with-broker",
+        action="store_true",
+        help=_("run benchmark-provision via a connection broker started for it"),
+    )
+    parser.add_argument(
+        "--manuf",
+        metavar="PATH",
+        help=_("Wireshark 'manuf' file for rebuild-oui"),
+    )
     parser.add_argument(
         "-y",
         "--yes",
@@ -928,11 +4845,25 @@ def parse_args() -> argparse.Namespace:
     # Mandatory arguments
     parser.add_argument(
         "command",
-        choices=("set-up", "update", "shell", "internal-tests"),
+        choices=(
+            "set-up",
+            "fleet",
+            "update",
+            "shell",
+            "broker",
+            "internal-tests",
+            "startup-benchmark",
+            "rebuild-oui",
+            "oui-benchmark",
+            "fill-key-pool",
+            "export-config",
+            "import-config",
+            "benchmark-provision",
+        ),
         metavar="command",
-        help=_("task to perform: set-up, update, or shell"),
+        help=_("task to perform: set-up, fleet, update, shell, or broker"),
     )
-    # To get a real shell (in step 3 use 'router_password' from ~/.cleargopher/cleapher.conf):
+    # To get a real shell (in step 3 use 'router_password' from cleapher.conf; see export-config):
     # ssh-keygen -t rsa -b 4096 -f ~/.ssh/id_rsa  # if prompted, don't overwrite existing key
     # ssh-keyscan 192.168.8.1 2>/dev/null |perl -pe 's|^[^ ]*|*|' >>~/.ssh/known_hosts
     # cat ~/.ssh/id_rsa.pub |ssh root@192.168.8.1 'cat - >>/etc/dropbear/authorized_keys'
@@ -945,16 +4876,91 @@ def main() -> None:
 
     args = parse_args()
     verbose = args.verbose
+    KeyPool.size = args.key_pool
+    KeyPool.allow_ed25519 = args.ed25519
+    PackageCache.max_bytes = args.package_cache_size * 2**20
+    Coteries.reboot_deadline = args.reboot_deadline
+    if args.trace or args.chrome_trace or args.timing:
+        Tracer.enable()
+    try:
+        run_command(args)
+    except BaseException:
+        if Tracer.enabled:
+            try:
+                Tracer.report(args.trace, args.chrome_trace)
+            except CGError as err:  # don't replace the exception from run_command
+                print_msg(0, err)
+        raise
+    if Tracer.enabled:
+        Tracer.report(args.trace, args.chrome_trace)
 
+
+def run_command(args: argparse.Namespace) -> None:
     if args.command == "set-up":
-        do_router_set_up()
+        do_router_set_up(args.channels, args.cidr, args.module)
+    elif args.command == "fleet":
+        if args.cidr is None:
+            raise CGError(_("fleet needs the networks to scan, given with --cidr"))
+        do_fleet_set_up(args.verbose, args.workers, args.channels, args.cidr, args.module)
+    elif args.command == "update":
+        do_update(args.verbose, args.workers, args.channels, args.module)
     elif args.command == "shell":
-        do_shell(args.verbose)
+        do_shell(args.verbose, args.cidr)
+    elif args.command == "broker":
+        SessionBroker(args.idle_timeout, args.max_connections).serve()
     elif args.command == "internal-tests":
         coteries = Coteries.load()
         first = coteries.modules[1].coteries[0].data  # noqa: F841
-        assert new_nickname("b8:27:eb:12:34:56") == "new Raspberry Pi device"
+        embedded = OuiIndex(OuiIndex.compile(OuiIndex.parse_manuf(OuiIndex.embedded_manuf)))
+        assert new_nickname("b8:27:eb:12:34:56", embedded) == "new Raspberry Pi device"
+        assert new_nickname("E4-95-6E-4A-BC-DE", embedded) == "new GL.iNet device"
+        assert new_nickname("e4:95:6e:50:00:01", embedded) == "new device"
+        test_oui_index()
+        conf = Config()
+        conf.routers = [Router(ipaddress.ip_address("192.0.2.1"), "e4:95:6e:40:12:34")]
+        conf.routers[0].set_hostkey("ssh-ed25519 AAAA")
+        assert conf.router_by_hostkey("ssh-ed25519 AAAA") is conf.routers[0]
+        conf.routers[0].set_hostkey("ssh-ed25519 BBBB")
+        assert conf.router_by_hostkey("ssh-ed25519 AAAA") is None
+        assert conf.router_by_hostkey("ssh-ed25519 BBBB") is conf.routers[0]
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(1)
+            port = listener.getsockname()[1]
+            found = sweep_ports(sweep_targets(["127.0.0.1/32"]), ports=(port,), timeout=1)
+            assert found == {ipaddress.ip_address("127.0.0.1"): {port}}
+        if "DBUS_SESSION_BUS_ADDRESS" in os.environ:  # e.g. dbus-run-session main.py ...
+            test_wifi_scan(os.environ["DBUS_SESSION_BUS_ADDRESS"])
         print_msg(1, _("Internal tests successful"))
+    elif args.command == "startup-benchmark":
+        startup_benchmark()
+    elif args.command == "rebuild-oui":
+        count = OuiIndex.rebuild(args.manuf)
+        print_msg(1, _("Built {} with {} entries").format(OuiIndex.path(), count))
+    elif args.command == "oui-benchmark":
+        oui_benchmark()
+    elif args.command == "benchmark-provision":
+        baseline = args.baseline
+        if baseline is None:
+            baseline = os.path.join(ConfigSaver.conf_dir(), "benchmark-baseline.json")
+        benchmark_provision(
+            args.latency / 1000,
+            args.channels,
+            baseline,
+            args.save_baseline,
+            args.tolerance,
+            args.module,
+            args.with_broker,
+        )
+    elif args.command == "export-config":
+        ConfigSaver.export_yaml(ConfigSaver.load())
+        print_msg(1, _("Exported configuration to {}").format(ConfigSaver._conf_path()))
+    elif args.command == "import-config":
+        ConfigSaver.import_yaml(ConfigSaver._conf_path())
+        print_msg(1, _("Imported configuration from {}").format(ConfigSaver._conf_path()))
+    elif args.command == "fill-key-pool":
+        count = KeyPool.fill()
+        print_msg(1, _("Added {} keys to {}").format(count, KeyPool.path()))
 
 
 if __name__ == "__main__":